@@ -0,0 +1,212 @@
+import threading
+
+import sympy
+from sympy.logic.boolalg import Xnor
+
+
+__all__ = ["BDD"]
+
+
+# How many nodes may one expression add to the store, and how many may the store hold?
+MAX_BDD_NODES_PER_EXPRESSION = 100000
+MAX_BDD_NODES = 1000000
+# How many built expressions should be remembered? Each keeps its whole sympy tree alive, so far fewer than nodes:
+MAX_BDD_EXPRESSIONS = 10000
+
+# The two terminal nodes, and the level below every variable that they are at:
+FALSE = 0
+TRUE = 1
+_TERMINAL_LEVEL = float("inf")
+
+# Binary operations:
+_AND = 0
+_OR = 1
+_XOR = 2
+
+# How to build the node of each logical operator from the nodes of its arguments:
+_OPERATIONS = {
+    sympy.And: lambda bdd, args: bdd._reduce(_AND, args),
+    sympy.Or: lambda bdd, args: bdd._reduce(_OR, args),
+    sympy.Xor: lambda bdd, args: bdd._reduce(_XOR, args),
+    sympy.Not: lambda bdd, args: bdd._not(args[0]),
+    sympy.Nand: lambda bdd, args: bdd._not(bdd._reduce(_AND, args)),
+    sympy.Nor: lambda bdd, args: bdd._not(bdd._reduce(_OR, args)),
+    Xnor: lambda bdd, args: bdd._not(bdd._reduce(_XOR, args)),
+    sympy.Implies: lambda bdd, args: bdd._apply(_OR, bdd._not(args[0]), args[1]),
+    # All the arguments are True, or all are False:
+    sympy.Equivalent: lambda bdd, args: bdd._apply(_OR, bdd._reduce(_AND, args), bdd._not(bdd._reduce(_OR, args))),
+    sympy.ITE: lambda bdd, args: bdd._apply(_OR, bdd._apply(_AND, args[0], args[1]),
+                                            bdd._apply(_AND, bdd._not(args[0]), args[2])),
+}
+
+
+class BDD(object):
+    """A store of reduced ordered binary decision diagrams, which are canonical forms of boolean expressions.
+
+       Every node is unique (hash-consed), so two expressions are equivalent if
+       and only if they have the same node id. Variables are ordered by when
+       they are first seen, which is fixed for the life of the store. The store,
+       and the results of each operation on nodes, are kept between calls; so
+       subexpressions shared between many expressions are only built once.
+       When the store holds more than MAX_BDD_NODES nodes or results, or more
+       than MAX_BDD_EXPRESSIONS remembered expressions, it is emptied before the
+       next expression is built.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        """Forget every node and variable."""
+        with self._lock:
+            self._nodes = [(_TERMINAL_LEVEL, FALSE, FALSE), (_TERMINAL_LEVEL, TRUE, TRUE)]  # (level, low, high)
+            self._unique = {}  # (level, low, high): node id
+            self._computed = {}  # (operation, node id, node id): node id
+            self._expressions = {}  # sympy expression: node id
+            self._symbols = []  # The symbol at each level.
+            self._levels = {}  # symbol: level
+            self._node_limit = MAX_BDD_NODES_PER_EXPRESSION
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def _mk(self, level, low, high):
+        """Return the unique node testing the variable at 'level', with these children."""
+        if low == high:
+            return low
+        key = (level, low, high)
+        node = self._unique.get(key)
+        if node is None:
+            if len(self._nodes) >= self._node_limit:
+                raise TypeError("Too many nodes for a binary decision diagram!")
+            node = len(self._nodes)
+            self._nodes.append(key)
+            self._unique[key] = node
+        return node
+
+    @staticmethod
+    def _shortcut(operation, u, v):
+        """Return the node for a binary operation on two nodes, with u <= v, if it is trivial; otherwise None."""
+        if v <= TRUE:
+            # Both are terminal nodes:
+            return [u & v, u | v, u ^ v][operation]
+        if operation == _AND:
+            if u == FALSE:
+                return FALSE
+            if u == TRUE or u == v:
+                return v
+        elif operation == _OR:
+            if u == TRUE:
+                return TRUE
+            if u == FALSE or u == v:
+                return v
+        elif u == FALSE:
+            return v
+        elif u == v:
+            return FALSE
+        return None
+
+    def _apply(self, operation, u, v):
+        """Return the node for a binary operation on two nodes."""
+        if u > v:
+            # Every operation is commutative:
+            u, v = v, u
+        result = self._shortcut(operation, u, v)
+        if result is not None:
+            return result
+
+        key = (operation, u, v)
+        result = self._computed.get(key)
+        if result is None:
+            u_level, u_low, u_high = self._nodes[u]
+            v_level, v_low, v_high = self._nodes[v]
+            level = min(u_level, v_level)
+            if u_level != level:
+                u_low = u_high = u
+            if v_level != level:
+                v_low = v_high = v
+            result = self._mk(level, self._apply(operation, u_low, v_low), self._apply(operation, u_high, v_high))
+            self._computed[key] = result
+        return result
+
+    def _not(self, node):
+        """Return the node for the negation of a node."""
+        return self._apply(_XOR, node, TRUE)
+
+    def _reduce(self, operation, nodes):
+        result = nodes[0]
+        for node in nodes[1:]:
+            result = self._apply(operation, result, node)
+        return result
+
+    def _variable(self, symbol):
+        """Return the node for a single variable, giving it the next level if it is new."""
+        level = self._levels.get(symbol)
+        if level is None:
+            level = len(self._symbols)
+            self._symbols.append(symbol)
+            self._levels[symbol] = level
+        return self._mk(level, FALSE, TRUE)
+
+    def _build(self, expr):
+        """Return the node for a sympy boolean expression."""
+        node = self._expressions.get(expr)
+        if node is not None:
+            return node
+        if expr is sympy.true:
+            return TRUE
+        if expr is sympy.false:
+            return FALSE
+        if isinstance(expr, sympy.Symbol):
+            return self._variable(expr)
+
+        operation = _OPERATIONS.get(type(expr))
+        if operation is None:
+            raise TypeError("Cannot build a binary decision diagram containing '{}'!".format(type(expr).__name__))
+        node = operation(self, [self._build(arg) for arg in expr.args])
+        self._expressions[expr] = node
+        return node
+
+    def _start(self):
+        """Empty the store if it is full, and set the limit on new nodes."""
+        if max(len(self._nodes), len(self._computed)) > MAX_BDD_NODES or len(self._expressions) > MAX_BDD_EXPRESSIONS:
+            self.clear()
+        self._node_limit = len(self._nodes) + MAX_BDD_NODES_PER_EXPRESSION
+
+    def node(self, expr):
+        """Return the id of the canonical node of a boolean expression.
+
+           Two expressions are equivalent exactly when their node ids are equal.
+           Raises a TypeError if the expression contains anything other than
+           symbols, True, False and logical operators, or if it would need more
+           than MAX_BDD_NODES_PER_EXPRESSION new nodes.
+            - 'expr' should be a sympy boolean expression.
+        """
+        with self._lock:
+            self._start()
+            return self._build(expr)
+
+    def difference(self, test_expr, target_expr):
+        """Compare two boolean expressions using their binary decision diagrams.
+
+           Returns None if the expressions are equivalent, otherwise a dict of one
+           assignment of their symbols to True or False for which they differ.
+           Raises a TypeError in the same cases as node(...), where the limit on
+           new nodes is for both expressions together.
+            - 'test_expr' should be the untrusted sympy expression to check.
+            - 'target_expr' should be the trusted sympy expression to match against.
+        """
+        with self._lock:
+            self._start()
+            test_node = self._build(test_expr)
+            target_node = self._build(target_expr)
+            if test_node == target_node:
+                return None
+            assignment = {symbol: False for symbol in test_expr.free_symbols | target_expr.free_symbols}
+            # Any path to the TRUE node of their XOR is an assignment where they differ:
+            node = self._apply(_XOR, test_node, target_node)
+            while node > TRUE:
+                level, low, high = self._nodes[node]
+                assignment[self._symbols[level]] = high != FALSE
+                node = high if high != FALSE else low
+            return assignment
@@ -0,0 +1,268 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import sympy
+
+from .utils import EqualityType
+
+
+__all__ = ["LRUCache", "SQLiteCache", "known_pairs_cache", "response_cache"]
+
+
+# Where to store known pairs so that all processes on a host can share them and
+# they survive restarts. If this is not set, each process only keeps them in memory.
+KNOWN_PAIRS_PATH = os.environ.get("EQUALITY_CHECKER_KNOWN_PAIRS_PATH")
+# How many known pairs should each process keep in memory?
+KNOWN_PAIRS_MAX_SIZE = 10000
+# Optionally, roughly how much memory (in bytes) may they use?
+KNOWN_PAIRS_MAX_BYTES = None
+# Optionally, for how many seconds should a known pair be remembered?
+KNOWN_PAIRS_TTL = None
+# How many seconds apart should expired pairs be deleted from the shared store on disk?
+KNOWN_PAIRS_PURGE_INTERVAL = 600
+
+# How many responses to identical requests should each process remember?
+RESPONSE_CACHE_MAX_SIZE = 10000
+
+# A rough estimate of the memory used by each node of a sympy expression tree:
+_BYTES_PER_NODE = 200
+
+
+def approximate_size(obj):
+    """Roughly estimate the memory used by a sympy object, or a tuple of them, in bytes."""
+    if isinstance(obj, tuple):
+        return sum(approximate_size(o) for o in obj)
+    if isinstance(obj, sympy.Basic):
+        return _BYTES_PER_NODE * sum(1 for _ in sympy.preorder_traversal(obj))
+    return _BYTES_PER_NODE
+
+
+class LRUCache(object):
+    """A size-bounded, least recently used cache with optional expiry.
+
+       This can be used in place of a dict for caches that would otherwise grow
+       without limit. When full, the least recently used entries are evicted.
+       Hits, misses and evictions are counted, see 'stats()'.
+        - 'max_size' is the maximum number of entries to keep.
+        - 'max_bytes' optionally limits the total 'sizeof' of the entries.
+        - 'ttl' optionally is the number of seconds after which entries expire.
+        - 'sizeof' is a function estimating the size of a (key, value) pair in bytes,
+          only used if 'max_bytes' is set.
+        - 'backend' is an optional slower, larger store (like an SQLiteCache) to
+          read from on a miss and to write all new entries through to. If 'ttl'
+          is set, entries also expire from the backend, which must then have a
+          'get_entry' method like that of SQLiteCache, giving their age.
+    """
+    def __init__(self, max_size, *, max_bytes=None, ttl=None, sizeof=None, backend=None):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof if sizeof is not None else (lambda key, value: approximate_size(key))
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._bytes = 0
+        self._entries = OrderedDict()  # key: (value, size, expiry time)
+        self._lock = threading.RLock()
+
+    def _lookup(self, key):
+        """Return the entry for a key, removing it if it has expired."""
+        entry = self._entries.get(key)
+        if entry is not None and entry[2] is not None and entry[2] < time.monotonic():
+            self._remove(key)
+            return None
+        return entry
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def _store(self, key, value, age=0):
+        """Store an entry in memory, evicting others if necessary.
+
+           An entry read from the backend is 'age' seconds old, so expires sooner.
+        """
+        if key in self._entries:
+            self._remove(key)
+        size = self.sizeof(key, value) if self.max_bytes is not None else 0
+        expiry = time.monotonic() + self.ttl - age if self.ttl is not None else None
+        self._entries[key] = (value, size, expiry)
+        self._bytes += size
+        while len(self._entries) > self.max_size or (self.max_bytes is not None and self._bytes > self.max_bytes and len(self._entries) > 1):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _backend_lookup(self, key):
+        """Return the value for a key from the backend and its age, or (None, None) if missing or expired."""
+        if self.ttl is None:
+            return self.backend.get(key), 0
+        entry = self.backend.get_entry(key)
+        if entry is None or entry[1] >= self.ttl:
+            return None, None
+        return entry
+
+    def get(self, key, default=None):
+        """Return the value for a key, or 'default' if it is not cached."""
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if self.backend is not None:
+                value, age = self._backend_lookup(key)
+                if value is not None:
+                    self._store(key, value, age)
+                    self.hits += 1
+                    return value
+            self.misses += 1
+            return default
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        with self._lock:
+            if self._lookup(key) is not None:
+                return True
+        return self.backend is not None and self._backend_lookup(key)[0] is not None
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._store(key, value)
+        if self.backend is not None:
+            self.backend[key] = value
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """Forget everything in memory (but not in the backend) and reset the counts."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Return a dict of the cache's size and hit, miss and eviction counts."""
+        return dict(size=len(self._entries), bytes=self._bytes, hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+
+class SQLiteCache(object):
+    """An on-disk store of known pairs, shared between processes using SQLite.
+
+       This can be used in place of the dict passed to known_equal_pair(...):
+       keys are (target_expr, test_expr) pairs of sympy objects and values are
+       EqualityTypes. Keys are stored using 'srepr' which, like '==', compares
+       the exact structure of the expressions, with the time each was stored.
+       The database uses write-ahead logging so that many Gunicorn workers can
+       read whilst one writes.
+        - 'path' is the filename of the database, which is created if necessary.
+        - 'namespace' separates the pairs of different checkers in one database.
+        - 'ttl' is how many seconds pairs are wanted for, or None to keep them
+          for ever. Older pairs in this namespace are deleted on the first write,
+          and then on writes at least KNOWN_PAIRS_PURGE_INTERVAL seconds apart.
+    """
+    def __init__(self, path, namespace, ttl=None):
+        self.path = path
+        self.namespace = namespace
+        self.ttl = ttl
+        self._last_purge = None
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+
+    def _connect(self):
+        """Return a connection to the database for this process.
+
+           SQLite connections must not be used across a fork, so each process
+           opens its own connection when first needed.
+        """
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS known_pairs (namespace TEXT NOT NULL, pair TEXT NOT NULL, "
+                               "equality_type TEXT NOT NULL, stored_at REAL NOT NULL DEFAULT 0, "
+                               "PRIMARY KEY (namespace, pair))")
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(known_pairs)")]
+            if "stored_at" not in columns:
+                # A database from before pairs were timed, whose pairs will count as very old:
+                connection.execute("ALTER TABLE known_pairs ADD COLUMN stored_at REAL NOT NULL DEFAULT 0")
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    @staticmethod
+    def _key(pair):
+        """Serialise a pair of sympy objects into a string key."""
+        return sympy.srepr(pair)
+
+    def get(self, pair, default=None):
+        """Return the EqualityType of a known pair, or 'default' if unknown."""
+        entry = self.get_entry(pair)
+        if entry is None:
+            return default
+        return entry[0]
+
+    def get_entry(self, pair):
+        """Return the EqualityType of a known pair and how many seconds ago it was stored, or None if unknown."""
+        with self._lock:
+            row = self._connect().execute("SELECT equality_type, stored_at FROM known_pairs WHERE namespace = ? AND pair = ?",
+                                          (self.namespace, self._key(pair))).fetchone()
+        if row is None:
+            return None
+        return EqualityType(row[0]), time.time() - row[1]
+
+    def __getitem__(self, pair):
+        equality_type = self.get(pair)
+        if equality_type is None:
+            raise KeyError(pair)
+        return equality_type
+
+    def __contains__(self, pair):
+        return self.get(pair) is not None
+
+    def __setitem__(self, pair, equality_type):
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            connection.execute("INSERT OR REPLACE INTO known_pairs (namespace, pair, equality_type, stored_at) "
+                               "VALUES (?, ?, ?, ?)", (self.namespace, self._key(pair), equality_type.value, now))
+            if self.ttl is not None and (self._last_purge is None or now - self._last_purge >= KNOWN_PAIRS_PURGE_INTERVAL):
+                self._last_purge = now
+                connection.execute("DELETE FROM known_pairs WHERE namespace = ? AND stored_at < ?",
+                                   (self.namespace, now - self.ttl))
+
+    def __len__(self):
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM known_pairs WHERE namespace = ?",
+                                           (self.namespace,)).fetchone()[0]
+
+    def clear(self):
+        """Forget all the known pairs in this namespace."""
+        with self._lock:
+            self._connect().execute("DELETE FROM known_pairs WHERE namespace = ?", (self.namespace,))
+
+
+def known_pairs_cache(namespace):
+    """Return the store of known pairs to use for a checker.
+
+       This is a bounded LRUCache private to this process; but if KNOWN_PAIRS_PATH
+       is set, it is backed by a store on disk shared between processes.
+        - 'namespace' should be the name of the checker, e.g. "maths".
+    """
+    backend = SQLiteCache(KNOWN_PAIRS_PATH, namespace, ttl=KNOWN_PAIRS_TTL) if KNOWN_PAIRS_PATH else None
+    return LRUCache(KNOWN_PAIRS_MAX_SIZE, max_bytes=KNOWN_PAIRS_MAX_BYTES, ttl=KNOWN_PAIRS_TTL, backend=backend)
+
+
+def response_cache():
+    """Return a bounded cache for whole responses of a checker, keyed by input strings."""
+    return LRUCache(RESPONSE_CACHE_MAX_SIZE)
@@ -0,0 +1,229 @@
+import functools
+
+import numpy
+import sympy
+from sympy.utilities.lambdify import NUMPY_TRANSLATIONS
+
+from .cache import LRUCache
+from .logs import get_logger
+from .metrics import mark_cache
+
+
+__all__ = ["NUMPY_MISSING_FN", "NUMPY_COMPLEX_FN", "CompiledExpression", "compile_expression", "sample_points"]
+
+
+_log = get_logger("maths.numeric")
+
+# Hack to fix a bug with lambdify and complex infinity ('zoo') when transforming
+# to NumPy for evaluation. Map complex infinity to Not a Number ('nan').
+NUMPY_TRANSLATIONS["zoo"] = "nan"
+
+# Numpy (understandably) doesn't have all 24 trig functions defined. Define those missing for completeness. (No hyperbolic inverses for now!)
+NUMPY_MISSING_FN = {"csc": lambda x: 1/numpy.sin(x), "sec": lambda x: 1/numpy.cos(x), "cot": lambda x: 1/numpy.tan(x),
+                    "acsc": lambda x: numpy.arcsin(numpy.float_power(x, -1)), "asec": lambda x: numpy.arccos(numpy.float_power(x, -1)),
+                    "acot": lambda x: numpy.arctan(numpy.float_power(x, -1)),
+                    "asinh": lambda x: numpy.arcsinh(x), "acosh": lambda x: numpy.arccosh(x), "atanh": lambda x: numpy.arctanh(x),
+                    "csch": lambda x: 1/numpy.sinh(x), "sech": lambda x: 1/numpy.cosh(x), "coth": lambda x: 1/numpy.tanh(x),
+                    "acsch": lambda x: numpy.arcsinh(numpy.float_power(x, -1)), "asech": lambda x: numpy.arccosh(numpy.float_power(x, -1)),
+                    "acoth": lambda x: numpy.arctanh(numpy.float_power(x, -1))}
+# Make a complex form of the above for no-variable cases of numeric evaluation.
+# (Late Binding means that can't just use NUMPY_MISSING_FN[k] since this isn't evaluated in
+# the for loop properly. But adding it as a default argument to the lambda *does* cause the
+# evaluation and so the two effects cancel out. Neat!)
+NUMPY_COMPLEX_FN = {k: lambda x, f=NUMPY_MISSING_FN[k]: f(x + 0j) for k in list(NUMPY_MISSING_FN.keys())}
+
+# How many compiled expressions should be remembered?
+COMPILED_CACHE_SIZE = 1024
+COMPILED_EXPRESSIONS = LRUCache(COMPILED_CACHE_SIZE)
+
+# The seed for the random shift of the sample points, so that every process uses the same points:
+SAMPLE_SEED = 20240917
+# How many sets of sample points should be remembered?
+SAMPLE_CACHE_SIZE = 64
+
+# The NumPy functions for sympy functions not in NUMPY_MISSING_FN, as lambdify would use:
+_NUMPY_FUNCTIONS = {"sin": numpy.sin, "cos": numpy.cos, "tan": numpy.tan,
+                    "asin": numpy.arcsin, "acos": numpy.arccos, "atan": numpy.arctan,
+                    "sinh": numpy.sinh, "cosh": numpy.cosh, "tanh": numpy.tanh,
+                    "exp": numpy.exp, "Abs": numpy.absolute}
+# Functions whose values are real even for complex arguments:
+_REAL_FUNCTIONS = {"Abs"}
+# The values of constants which float(...) cannot convert:
+_SPECIAL_CONSTANTS = {sympy.zoo: numpy.nan, sympy.nan: numpy.nan, sympy.I: 1j}
+
+# Kinds of operand: a constant, one of the arguments, or a value on the real or complex stack:
+_CONSTANT = 0
+_ARGUMENT = 1
+_REAL = 2
+_COMPLEX = 3
+
+
+def _assign(function):
+    """Wrap a function which is not a ufunc so that, like one, it can write to an 'out' array."""
+    def assign(*operands, out):
+        out[...] = function(*operands)
+    return assign
+
+
+class CompiledExpression(object):
+    """A sympy expression compiled into a flat postfix program of NumPy ufunc calls.
+
+       Each instruction applies one function to constants, arguments or earlier
+       results, and writes its result into a row of a buffer which is allocated
+       once per call; so there is no code generation, and no temporary arrays.
+       Results are real unless the arguments are complex or the expression
+       contains the imaginary unit, exactly as for lambdify(...). Raises a
+       TypeError for any expression containing a function it cannot compile.
+        - 'expr' should be the sympy expression to compile.
+        - 'variables' should be the list of symbols which are its arguments.
+        - 'complexify' says whether the arguments will be complex, when the
+          functions of NUMPY_COMPLEX_FN are used rather than NUMPY_MISSING_FN.
+    """
+    def __init__(self, expr, variables, *, complexify=False):
+        self._arguments = {variable: i for i, variable in enumerate(variables)}
+        self._missing_functions = NUMPY_COMPLEX_FN if complexify else NUMPY_MISSING_FN
+        self._complexify = complexify
+        self._instructions = []  # (function, operands, output kind, output row)
+        self._n_rows = 0
+        self._result = self._compile(expr, 0)
+        if self._result[0] in (_CONSTANT, _ARGUMENT):
+            # Always return a new array, broadcast to the shape of the arguments:
+            self._emit(_assign(lambda value: value), [self._result], self._kind([self._result]), 0)
+
+    def _kind(self, operands):
+        """The kind of a result computed from these operands."""
+        complex_operands = any(kind == _COMPLEX or (kind == _CONSTANT and isinstance(value, complex)) for kind, value in operands)
+        return _COMPLEX if self._complexify or complex_operands else _REAL
+
+    def _emit(self, function, operands, kind, row):
+        self._instructions.append((function, operands, kind, row))
+        self._n_rows = max(self._n_rows, row + 1)
+        self._result = (kind, row)
+        return self._result
+
+    def _constant(self, expr):
+        if expr in _SPECIAL_CONSTANTS:
+            value = _SPECIAL_CONSTANTS[expr]
+        else:
+            try:
+                value = float(expr)
+            except TypeError:
+                value = complex(expr)
+        # Constants must be complex too for complex arguments, so that powers of negative numbers are defined:
+        return (_CONSTANT, complex(value) if self._complexify else value)
+
+    def _fold(self, ufunc, args, row):
+        """Combine the arguments of an n-ary operation pairwise, using rows from 'row' upwards."""
+        result = self._compile(args[0], row)
+        for arg in args[1:]:
+            operands = [result, self._compile(arg, row + 1)]
+            result = self._emit(ufunc, operands, self._kind(operands), row)
+        return result
+
+    def _function(self, expr):
+        """Return the NumPy function to apply for an expression, and the arguments to apply it to."""
+        if isinstance(expr, sympy.Pow):
+            if expr.exp == sympy.S.Half:
+                return numpy.sqrt, [expr.base]
+            return numpy.power, [expr.base, expr.exp]
+        if isinstance(expr, sympy.log) and len(expr.args) == 2:
+            return _assign(lambda x, base: numpy.log(x) / numpy.log(base)), expr.args
+        if not (isinstance(expr, sympy.Function) and len(expr.args) == 1):
+            raise TypeError("Cannot compile '{}'!".format(type(expr).__name__))
+        name = type(expr).__name__
+        if name in self._missing_functions:
+            return _assign(self._missing_functions[name]), expr.args
+        if name in _NUMPY_FUNCTIONS or name == "log":
+            return _NUMPY_FUNCTIONS.get(name, numpy.log), expr.args
+        raise TypeError("Cannot compile the function '{}'!".format(name))
+
+    def _compile(self, expr, row):
+        """Emit the instructions to evaluate an expression, returning the operand holding its value.
+
+           The value is held in the buffer row 'row', unless it is a constant or an
+           argument; rows above 'row' are free for working.
+        """
+        if expr in self._arguments:
+            return (_ARGUMENT, self._arguments[expr])
+        if expr.is_Atom:
+            if expr.free_symbols:
+                raise TypeError("Cannot compile '{}', which is not an argument!".format(expr))
+            return self._constant(expr)
+        if isinstance(expr, sympy.Add):
+            return self._fold(numpy.add, expr.args, row)
+        if isinstance(expr, sympy.Mul):
+            return self._fold(numpy.multiply, expr.args, row)
+        function, args = self._function(expr)
+        operands = [self._compile(arg, row + i) for i, arg in enumerate(args)]
+        kind = _REAL if type(expr).__name__ in _REAL_FUNCTIONS and not self._complexify else self._kind(operands)
+        return self._emit(function, operands, kind, row)
+
+    def __call__(self, *args):
+        """Evaluate the expression for NumPy arrays (or scalars) of argument values."""
+        shape = numpy.broadcast_shapes(*[numpy.shape(arg) for arg in args])
+        buffers = [None, args, numpy.empty((self._n_rows,) + shape), numpy.empty((self._n_rows,) + shape, dtype=complex)]
+        for function, operands, kind, row in self._instructions:
+            function(*[value if operand_kind == _CONSTANT else buffers[operand_kind][value] for operand_kind, value in operands],
+                     out=buffers[kind][row, ...])
+        kind, row = self._result
+        return buffers[kind][row]
+
+
+def compile_expression(expr, variables, *, complexify=False):
+    """Return a function evaluating a sympy expression with NumPy, for arrays of values of the variables.
+
+       The expression is compiled by CompiledExpression if possible, and otherwise
+       by sympy's lambdify(...) with the same functions. Compiled expressions are
+       cached by the structure of the expression, the variables and 'complexify',
+       so the cost of compiling a target or common answer is only paid once.
+        - 'expr' should be the sympy expression to evaluate.
+        - 'variables' should be the list of symbols which are the function's arguments.
+        - 'complexify' says whether the arguments will be complex, see CompiledExpression.
+    """
+    key = (expr, tuple(variables), complexify)
+    compiled = COMPILED_EXPRESSIONS.get(key)
+    mark_cache("compiled_expressions", compiled is not None)
+    if compiled is None:
+        try:
+            compiled = CompiledExpression(expr, variables, complexify=complexify)
+        except TypeError as e:
+            _log.debug("%s Using lambdify instead.", e)
+            compiled = sympy.lambdify(variables, expr, [NUMPY_COMPLEX_FN if complexify else NUMPY_MISSING_FN, "numpy"])
+        COMPILED_EXPRESSIONS[key] = compiled
+    return compiled
+
+
+def _radical_inverse(indices, base):
+    """Reflect the digits of each index in the given base about the point, e.g. 6 = 110b to 0.011b."""
+    values = numpy.zeros(len(indices))
+    indices = numpy.array(indices)
+    scale = 1.0 / base
+    while numpy.any(indices > 0):
+        values += scale * (indices % base)
+        indices //= base
+        scale /= base
+    return values
+
+
+@functools.lru_cache(maxsize=SAMPLE_CACHE_SIZE)
+def sample_points(n_dimensions, n_points):
+    """Return a deterministic, low-discrepancy set of sample points in [0, 1).
+
+       Uses the Halton sequence, which covers the unit cube much more evenly
+       than independent random points, with the k-th dimension using the k-th
+       prime as a base. Each dimension is shifted (modulo 1) by an amount drawn
+       from a generator seeded by SAMPLE_SEED and the dimension, so that points
+       avoid simple fractions like 1/2 where many expressions are singular, but
+       every process and every call uses the same points. The points for fewer
+       dimensions are the same as the first dimensions of those for more.
+       Returns a read-only array of shape (n_dimensions, n_points).
+        - 'n_dimensions' should be the number of variables.
+        - 'n_points' should be the number of points.
+    """
+    indices = numpy.arange(1, n_points + 1)
+    points = numpy.empty((n_dimensions, n_points))
+    for dimension in range(n_dimensions):
+        shift = numpy.random.default_rng([SAMPLE_SEED, dimension]).random()
+        points[dimension] = (_radical_inverse(indices, sympy.prime(dimension + 1)) + shift) % 1.0
+    points.setflags(write=False)
+    return points
@@ -0,0 +1,197 @@
+import math
+import random
+from fractions import Fraction
+
+import sympy
+
+
+__all__ = ["rational_identity"]
+
+
+# How many independent samples to take, and the largest chance of error allowed for each:
+IDENTITY_SAMPLES = 3
+MAX_SAMPLE_ERROR = 1E-6
+# After how many samples in a row with a zero denominator should checking give up?
+MAX_IDENTITY_RESAMPLES = 10
+
+# Primes are chosen uniformly from [2**61, 2**62), which contains more than 2**61 / 60 of them:
+_PRIME_BITS = 61
+_MIN_PRIME = 2 ** _PRIME_BITS
+_PRIME_COUNT = 2 ** _PRIME_BITS // 60
+# Miller-Rabin testing with these bases is exact for every number below 3.3E24:
+_MILLER_RABIN_BASES = [2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37]
+
+# The primes and sample points must not be predictable from earlier requests:
+_random = random.SystemRandom()
+
+
+def _is_prime(n):
+    """Decide whether an integer below 3.3E24 is prime."""
+    for base in _MILLER_RABIN_BASES:
+        if n % base == 0:
+            return n == base
+    d, s = n - 1, 0
+    while d % 2 == 0:
+        d, s = d // 2, s + 1
+    for base in _MILLER_RABIN_BASES:
+        x = pow(base, d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for _ in range(s - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def _random_prime():
+    """Return a prime chosen uniformly at random from [2**61, 2**62)."""
+    while True:
+        n = _random.randrange(_MIN_PRIME, 2 * _MIN_PRIME) | 1
+        if _is_prime(n):
+            return n
+
+
+def _integer_exponent(expr):
+    """Return the value of a constant integer exponent, which may be an unevaluated sum or product."""
+    if isinstance(expr, sympy.Rational):
+        value = Fraction(int(expr.p), int(expr.q))
+    elif isinstance(expr, sympy.Add):
+        value = sum(Fraction(_integer_exponent(arg)) for arg in expr.args)
+    elif isinstance(expr, sympy.Mul):
+        value = math.prod(Fraction(_integer_exponent(arg)) for arg in expr.args)
+    else:
+        raise TypeError("Exponent '{}' is not a constant integer!".format(expr))
+    if value.denominator != 1:
+        raise TypeError("Exponent '{}' is not an integer!".format(expr))
+    return int(value)
+
+
+def _bounds(expr, memo):
+    """Bound the numerator and denominator of a rational function written as a single fraction.
+
+       Returns (numerator degree, denominator degree, numerator bits, denominator
+       bits), where the bits bound the logarithm of the sum of the absolute values
+       of the coefficients. Raises a TypeError if the expression is not a rational
+       function of its symbols with rational coefficients.
+    """
+    if expr in memo:
+        return memo[expr]
+    if expr.is_Symbol:
+        result = (1, 0, 0, 0)
+    elif isinstance(expr, sympy.Rational):
+        result = (0, 0, abs(int(expr.p)).bit_length(), int(expr.q).bit_length())
+    elif isinstance(expr, sympy.Mul):
+        result = tuple(map(sum, zip(*[_bounds(arg, memo) for arg in expr.args])))
+    elif isinstance(expr, sympy.Add):
+        # Over a common denominator, the numerator is a sum of each numerator times the other denominators:
+        args = [_bounds(arg, memo) for arg in expr.args]
+        den_degree = sum(arg[1] for arg in args)
+        den_bits = sum(arg[3] for arg in args)
+        num_degree = max(arg[0] + den_degree - arg[1] for arg in args)
+        num_bits = max(arg[2] + den_bits - arg[3] for arg in args) + len(args).bit_length()
+        result = (num_degree, den_degree, num_bits, den_bits)
+    elif isinstance(expr, sympy.Pow):
+        exponent = _integer_exponent(expr.exp)
+        num_degree, den_degree, num_bits, den_bits = _bounds(expr.base, memo)
+        if exponent < 0:
+            num_degree, den_degree, num_bits, den_bits = den_degree, num_degree, den_bits, num_bits
+        n = abs(exponent)
+        result = (n * num_degree, n * den_degree, n * num_bits, n * den_bits)
+    else:
+        raise TypeError("'{}' is not a rational function!".format(type(expr).__name__))
+    memo[expr] = result
+    return result
+
+
+def _sample_error(degree, bits):
+    """Bound the chance that a nonzero polynomial vanishes at one random sample.
+
+       The polynomial, of total degree 'degree' with integer coefficients below
+       2**bits, is zero modulo the random prime at the random point with chance
+       at most degree / p by the Schwartz-Zippel lemma; or its coefficients may
+       all be divisible by the prime, but at most bits / 61 of the primes can
+       divide them.
+    """
+    divisors = bits // _PRIME_BITS
+    if degree >= _MIN_PRIME or divisors >= _PRIME_COUNT:
+        return 1.0
+    return float(Fraction(degree, _MIN_PRIME) + Fraction(divisors, _PRIME_COUNT))
+
+
+def _evaluate(expr, p, point, memo):
+    """Evaluate a rational function modulo a prime, raising a ZeroDivisionError if a denominator is zero."""
+    if expr in memo:
+        return memo[expr]
+    if expr.is_Symbol:
+        return point[expr]
+    if isinstance(expr, sympy.Rational):
+        denominator = int(expr.q) % p
+        if denominator == 0:
+            raise ZeroDivisionError
+        result = int(expr.p) * pow(denominator, -1, p) % p
+    elif isinstance(expr, sympy.Mul):
+        result = 1
+        for arg in expr.args:
+            result = result * _evaluate(arg, p, point, memo) % p
+    elif isinstance(expr, sympy.Add):
+        result = sum(_evaluate(arg, p, point, memo) for arg in expr.args) % p
+    else:
+        base = _evaluate(expr.base, p, point, memo)
+        exponent = _integer_exponent(expr.exp)
+        if exponent < 0:
+            if base == 0:
+                raise ZeroDivisionError
+            base, exponent = pow(base, -1, p), -exponent
+        result = pow(base, exponent, p)
+    memo[expr] = result
+    return result
+
+
+def rational_identity(test_expr, target_expr):
+    """Decide whether two rational functions are identical, using exact arithmetic at random points.
+
+       Both expressions are evaluated modulo a random 62 bit prime, at a random
+       point, with every symbol independent. Different values prove that the
+       expressions differ. Equal values are repeated IDENTITY_SAMPLES times, with a
+       new prime and point each time, and the chance that the expressions differ
+       despite this is bounded using the degree and coefficients of their
+       difference. Choosing the prime at random stops inputs being constructed
+       whose difference happens to vanish modulo any fixed prime.
+       Returns a tuple of whether the expressions are identical and the bound on
+       the chance that this is wrong. Raises a TypeError if either expression is
+       not a polynomial or rational function of its symbols with rational
+       coefficients, if the degree or coefficients are too large for a useful
+       bound, or if a denominator is zero at every sample.
+        - 'test_expr' should be the untrusted sympy expression to check.
+        - 'target_expr' should be the trusted sympy expression to match against.
+    """
+    test_num_degree, test_den_degree, test_num_bits, test_den_bits = _bounds(test_expr, {})
+    target_num_degree, target_den_degree, target_num_bits, target_den_bits = _bounds(target_expr, {})
+    # The difference is a fraction with this numerator and denominator:
+    numerator_error = _sample_error(max(test_num_degree + target_den_degree, target_num_degree + test_den_degree),
+                                    max(test_num_bits + target_den_bits, target_num_bits + test_den_bits) + 1)
+    denominator_error = _sample_error(test_den_degree + target_den_degree, test_den_bits + target_den_bits)
+    if max(numerator_error, denominator_error) > MAX_SAMPLE_ERROR:
+        raise TypeError("Degree or coefficients too large to test identity!")
+    # Samples where a denominator is zero are rejected, so the chance of error is conditional on this not happening:
+    sample_error = numerator_error / (1 - denominator_error)
+
+    symbols = sorted(test_expr.free_symbols | target_expr.free_symbols, key=str)
+    for _ in range(IDENTITY_SAMPLES):
+        for _ in range(MAX_IDENTITY_RESAMPLES):
+            p = _random_prime()
+            point = {symbol: _random.randrange(p) for symbol in symbols}
+            try:
+                test_value = _evaluate(test_expr, p, point, {})
+                target_value = _evaluate(target_expr, p, point, {})
+                break
+            except ZeroDivisionError:
+                continue
+        else:
+            raise TypeError("A denominator is zero at every sample!")
+        if test_value != target_value:
+            return False, 0.0
+    return True, sample_error ** IDENTITY_SAMPLES
@@ -1,16 +1,38 @@
 import sympy
 
-from .utils import known_equal_pair, contains_incorrect_symbols
+from .utils import known_equal_pair, known_unequal_pair, contains_incorrect_symbols, response_cache_key, echo_request
 from .utils import EqualityType
+from .logs import get_logger
+from .metrics import StageTimer, RequestTimings, mark_cache, count_decision
+from .cache import known_pairs_cache, response_cache
+from .truth_tables import truth_table_difference, MAX_TRUTH_TABLE_VARIABLES
+from .bdd import BDD
+from .sat import sat_difference
 from .parsing import logic_parser, UnsafeInputException
 
 
 __all__ = ["check"]
 
+_log = get_logger("logic")
+_parse_log = get_logger("logic.parse")
+_exact_log = get_logger("logic.exact")
+_symbolic_log = get_logger("logic.symbolic")
 
-KNOWN_PAIRS = dict()
 
+KNOWN_PAIRS = known_pairs_cache("logic")
+KNOWN_UNEQUAL_PAIRS = known_pairs_cache("logic_unequal")
+RESPONSE_CACHE = response_cache()
+# Binary decision diagrams are kept between checks, since targets and many answers share parts:
+BINARY_DECISION_DIAGRAMS = BDD()
 
+# Truth tables are used for few variables, then binary decision diagrams, but
+# these can grow exponentially for large expressions; so above these limits, a
+# SAT solver is used instead:
+MAX_BDD_VARIABLES = 24
+MAX_BDD_EXPRESSION_SIZE = 500
+
+
+@StageTimer("logic.parse")
 def parse_expression(expression_str, *, local_dict=None):
     """Take a string containing a mathematical expression and return a sympy expression.
 
@@ -23,11 +45,11 @@ def parse_expression(expression_str, *, local_dict=None):
     try:
         return logic_parser.parse_expr(expression_str, local_dict=local_dict)
     except logic_parser.ParsingException:
-        print("Incorrectly formatted expression.")
-        print("Fail: '{}'.".format(expression_str))
+        _parse_log.info("Incorrectly formatted expression: '%s'.", expression_str)
         return None
 
 
+@StageTimer("logic.exact")
 def exact_match(test_expr, target_expr):
     """Test if the entered expression exactly matches the known expression.
 
@@ -40,45 +62,89 @@ def exact_match(test_expr, target_expr):
         - 'test_expr' should be the untrusted sympy expression to check.
         - 'target_expr' should be the trusted sympy expression to match against.
     """
-    print("[EXACT TEST]")
     if test_expr == target_expr:
-        print("Exact Match (with '==')")
+        _exact_log.debug("Exact Match (with '==')")
         return True
     elif sympy.srepr(test_expr) == sympy.srepr(target_expr):
         # This is a (perfectly acceptable) hack for ordering the atoms of each
         # term, but a more explicit method may be preferable in the future.
-        print("Exact Match (with 'srepr')")
+        _exact_log.debug("Exact Match (with 'srepr')")
         return True
     else:
         return False
 
 
-def symbolic_equality(test_expr, target_expr):
+def equivalence_method(test_expr, target_expr):
+    """Choose the method to decide whether two boolean expressions are equivalent.
+
+       Returns the name of the method, a key of _EQUIVALENCE_METHODS, based on
+       the number of variables and the size of the expressions.
+        - 'test_expr' should be the untrusted sympy expression to check.
+        - 'target_expr' should be the trusted sympy expression to match against.
+    """
+    n_variables = len(test_expr.free_symbols | target_expr.free_symbols)
+    if n_variables <= MAX_TRUTH_TABLE_VARIABLES:
+        return "truth tables"
+    size = sum(1 for _ in sympy.preorder_traversal(test_expr)) + sum(1 for _ in sympy.preorder_traversal(target_expr))
+    if n_variables <= MAX_BDD_VARIABLES and size <= MAX_BDD_EXPRESSION_SIZE:
+        return "binary decision diagrams"
+    return "SAT solver"
+
+
+# Each method returns None if the expressions are equivalent, or an assignment of
+# the symbols for which they differ; or raises a TypeError if it cannot decide:
+_EQUIVALENCE_METHODS = {
+    "truth tables": truth_table_difference,
+    "binary decision diagrams": BINARY_DECISION_DIAGRAMS.difference,
+    "SAT solver": sat_difference,
+}
+
+
+@StageTimer("logic.symbolic")
+def symbolic_equality(test_expr, target_expr, *, method="truth tables"):
     """Test if two expressions are symbolically equivalent.
 
-       Use the sympy 'simplify_logic' function to simplify the two boolean
-       expressions as much as possible. Two equilvalent expressions MUST simplify
-       to the same thing, and then they can be tested for equivalence again.
+       Decide if the two boolean expressions are equivalent using 'method',
+       which should be a key of _EQUIVALENCE_METHODS. If it cannot, try each
+       later method in turn. If none can, use the sympy 'simplify_logic'
+       function to simplify the two boolean expressions as much as possible
+       instead. Two equilvalent expressions MUST simplify to the same thing,
+       and then they can be tested for equivalence again.
 
-       Returns True if sympy can determine that the two expressions are equal,
-       and returns False if they are not equal.
+       Returns True if the two expressions are equal, and returns False if they
+       are not equal.
 
         - 'test_expr' should be the untrusted sympy expression to check.
         - 'target_expr' should be the trusted sympy expression to match against.
+        - 'method' is the first method to try, see equivalence_method(...).
     """
-    print("[SYMBOLIC TEST]")
+    methods = list(_EQUIVALENCE_METHODS)
+    for method in methods[methods.index(method):]:
+        try:
+            difference = _EQUIVALENCE_METHODS[method](test_expr, target_expr)
+        except TypeError as e:
+            _symbolic_log.debug("%s - Can't use %s.", e, method)
+            continue
+        if difference is None:
+            _symbolic_log.debug("Symbolic match (with %s).", method)
+            _symbolic_log.debug("Adding known pair (%s, %s)", target_expr, test_expr)
+            KNOWN_PAIRS[(target_expr, test_expr)] = EqualityType.SYMBOLIC
+            return True
+        _symbolic_log.debug("Expressions differ when: %s", difference)
+        return False
+    _symbolic_log.debug("Using 'simplify_logic' instead.")
     try:
         simplified_target = sympy.simplify_logic(target_expr)
         simplified_test = sympy.simplify_logic(test_expr)
         if simplified_target == simplified_test or sympy.srepr(simplified_target) == sympy.srepr(simplified_test):
-            print("Symbolic match.")
-            print("INFO: Adding known pair ({0}, {1})".format(target_expr, test_expr))
+            _symbolic_log.debug("Symbolic match.")
+            _symbolic_log.debug("Adding known pair (%s, %s)", target_expr, test_expr)
             KNOWN_PAIRS[(target_expr, test_expr)] = EqualityType.SYMBOLIC
             return True
         else:
             return False
     except NotImplementedError as e:
-        print("{0}: {1} - Can't check symbolic equality!".format(type(e).__name__, str(e).capitalize()))
+        _symbolic_log.debug("%s: %s - Can't check symbolic equality!", type(e).__name__, str(e).capitalize())
         return False
 
 
@@ -86,7 +152,8 @@ def expr_equality(test_expr, target_expr):
     """Given two sympy expressions: test for exact, symbolic and numeric equality.
 
        Check two sympy expressions for equality, throwing a TypeError if either
-       of the provided sympy objects is not an expression.
+       of the provided sympy objects is not an expression. The method used to
+       test symbolic equality is chosen by equivalence_method(...).
         - 'test_expr' should be the untrusted sympy expression to check.
         - 'target_expr' should be the trusted sympy expression to match against.
     """
@@ -95,7 +162,7 @@ def expr_equality(test_expr, target_expr):
     if not equal:
         # Then try checking for symbolic equality:
         equality_type = EqualityType.SYMBOLIC
-        equal = symbolic_equality(test_expr, target_expr)
+        equal = symbolic_equality(test_expr, target_expr, method=equivalence_method(test_expr, target_expr))
     return equal, equality_type
 
 
@@ -105,17 +172,25 @@ def general_equality(test_expr, target_expr):
         - 'test_expr' should be the untrusted sympy object to check.
         - 'target_expr' should be the trusted sympy object to match against.
     """
-    equal, equality_type = known_equal_pair(KNOWN_PAIRS, test_expr, target_expr)
+    with StageTimer("logic.known_pairs"):
+        equal, equality_type = known_equal_pair(KNOWN_PAIRS, test_expr, target_expr)
+    mark_cache("known_pairs", equal)
     # If this is a known pair: return immediately:
     if equal:
         return equal, equality_type
+    # Likewise if this is a known unequal pair:
+    with StageTimer("logic.known_pairs"):
+        unequal, equality_type = known_unequal_pair(KNOWN_UNEQUAL_PAIRS, test_expr, target_expr)
+    mark_cache("known_unequal_pairs", unequal)
+    if unequal:
+        return False, equality_type
     else:
-        print("[[EXPRESSION CHECK]]")
         return expr_equality(test_expr, target_expr)
 
 
+@StageTimer("logic.check")
 def check(test_str, target_str, *, symbols=None, check_symbols=True, description=None,
-          _quiet=False):
+          timings=False, _quiet=False):
     """The main checking function, calls each of the equality checking functions as required.
 
        Returns a dict describing the equality; with important keys being 'equal',
@@ -130,66 +205,93 @@ def check(test_str, target_str, *, symbols=None, check_symbols=True, description
           expression are exactly the same or not; setting this to False will
           allow symbols which cancel out to be included (probably don't want this
           in questions).
-        - 'description' is an optional description to print before the checker's
-          output to stdout which can be used to improve logging.
-        - '_quiet' is an internal argument used to suppress some output when
+        - 'description' is an optional description to log before the checker's
+          other messages, which can be used to improve logging.
+        - 'timings' says whether to add the key 'timings' to the dict, giving how
+          long each stage took and which caches were hit, see RequestTimings.
+        - '_quiet' is an internal argument used to suppress some logging when
           this function is called from plus_minus_checker().
     """
+    if timings:
+        with RequestTimings() as request_timings:
+            response = check.__wrapped__(test_str, target_str, symbols=symbols, check_symbols=check_symbols,
+                                         description=description, _quiet=_quiet)
+            response["timings"] = request_timings.as_dict()
+        return response
 
-    # Suppress this output if necessary:
-    if not _quiet:
-        print("=" * 50)
-        # For logging purposes, if we have a description: print it!
-        if description is not None:
-            print(description)
-            print("=" * 50)
-        print("[LOGIC]")
+    # For logging purposes, if we have a description: log it!
+    if description is not None and not _quiet:
+        _log.info("Description: %s", description)
 
     # If nothing to parse, fail. On server, this will be caught in check_endpoint()
     if (target_str == "") or (test_str == ""):
-        print("ERROR: No input provided!")
-        if not _quiet:
-            print("=" * 50)
+        _log.info("No input provided!")
         return dict(error="Empty string as argument.")
 
+    # If exactly this request has been seen before, the response will be the same:
+    cache_key = response_cache_key(test_str, target_str, None, check_symbols)  # Symbols are not used for logic.
+    cached_response = RESPONSE_CACHE.get(cache_key) if cache_key is not None else None
+    if cache_key is not None:
+        mark_cache("responses", cached_response is not None)
+    if cached_response is not None:
+        _log.info("Known response from identical request! Equality: %s", cached_response.get("equal"))
+        return echo_request(cached_response, test_str, target_str, logic_parser.cleanup_string)
+
+    response = _check_uncached(test_str, target_str, check_symbols=check_symbols, _quiet=_quiet)
+    if cache_key is not None:
+        RESPONSE_CACHE[cache_key] = dict(response)
+    return response
+
+
+def _check_uncached(test_str, target_str, *, check_symbols, _quiet):
+    """Do the cleanup, parsing and checking for check(...), which caches the result."""
     # Cleanup the strings before anything is done to them:
     error_is_test = False
     try:
-        target_str = logic_parser.cleanup_string(target_str, reject_unsafe_input=True)
-        error_is_test = True
-        test_str = logic_parser.cleanup_string(test_str, reject_unsafe_input=True)
+        with StageTimer("logic.cleanup"):
+            target_str = logic_parser.cleanup_string(target_str, reject_unsafe_input=True)
+            error_is_test = True
+            test_str = logic_parser.cleanup_string(test_str, reject_unsafe_input=True)
     except UnsafeInputException:
-        print("ERROR: Input contained non-whitelisted characters!")
         result = dict(error="Bad input provided!")
         if error_is_test:
-            print("Test string: '{}'".format(test_str))
+            _log.info("Test string contained non-whitelisted characters: '%s'", test_str)
             result["syntax_error"] = str(True).lower()
-        if not _quiet:
-            print("=" * 50)
+        else:
+            _log.error("Target string contained non-whitelisted characters!")
         return result
 
-    print("Target string: '{}'".format(target_str))
-    print("Test string: '{}'".format(test_str))
+    if not _quiet:
+        _log.info("Target string: '%s'", target_str)
+    _log.info("Test string: '%s'", test_str)
 
-    print("[[PARSE EXPRESSIONS]]")
     # Parse the trusted target expression:
     target_expr = parse_expression(target_str)
     # Parse the untrusted test expression:
     test_expr = parse_expression(test_str)
 
+    return check_parsed(test_str, test_expr, target_str, target_expr, check_symbols=check_symbols)
+
+
+def check_parsed(test_str, test_expr, target_str, target_expr, *, check_symbols=True):
+    """Check the equivalence of an already parsed test and target expression.
+
+       This does the checking part of check(...), after the strings have been
+       cleaned up and parsed, and returns the same dict.
+        - 'test_str' and 'target_str' should be the cleaned up input strings.
+        - 'test_expr' and 'target_expr' should be the results of parse_expression(...)
+          on those strings, which may be None if parsing failed.
+        - 'check_symbols' is as for check(...).
+    """
     result = dict(target=target_str, test=test_str)
 
     if target_expr is None:
-        print("ERROR: TRUSTED EXPRESSION CANNOT BE PARSED!")
-        if not _quiet:
-            print("=" * 50)
+        _log.error("TRUSTED EXPRESSION CANNOT BE PARSED!")
         result["error"] = "Parsing TARGET Expression Failed!"
         result["code"] = 400  # This is fatal!
         return result
     if test_expr is None:
-        print("Incorrectly formatted ToCheck expression.")
-        if not _quiet:
-            print("=" * 50)
+        _log.info("Incorrectly formatted ToCheck expression.")
         result["error"] = "Parsing Test Expression Failed!"
         result["syntax_error"] = str(True).lower()
         return result
@@ -199,14 +301,14 @@ def check(test_str, target_str, *, symbols=None, check_symbols=True, description
 
     # Now check for symbol match and equality:
     try:
-        print("Parsed Target: {0}\nParsed ToCheck: {1}".format(target_expr, test_expr))
+        _log.debug("Parsed Target: %s", target_expr)
+        _log.debug("Parsed ToCheck: %s", test_expr)
         if check_symbols:  # Do we have same set of symbols in each?
-            incorrect_symbols = contains_incorrect_symbols(test_expr, target_expr)
+            with StageTimer("logic.symbols"):
+                incorrect_symbols = contains_incorrect_symbols(test_expr, target_expr)
             if incorrect_symbols is not None:
-                print("[[RESULT]]\nEquality: False")
-                if not _quiet:
-                    print("=" * 50)
-
+                _log.info("Equality: False")
+                count_decision("logic", EqualityType.SYMBOLIC, False)
                 result["equal"] = str(False).lower()
                 result["equality_type"] = EqualityType.SYMBOLIC.value
                 result["incorrect_symbols"] = incorrect_symbols
@@ -214,19 +316,18 @@ def check(test_str, target_str, *, symbols=None, check_symbols=True, description
         # Then check for equality proper:
         equal, equality_type = general_equality(test_expr, target_expr)
     except (SyntaxError, TypeError, AttributeError) as e:
-        print("Error when comparing expressions: '{}'.".format(e))
-        if not _quiet:
-            print("=" * 50)
+        _log.warning("Error when comparing expressions: '%s'.", e)
         result["error"] = "Comparison of expressions failed: '{}'".format(e)
         return result
 
-    print("[[RESULT]]")
     if equal and (equality_type is not EqualityType.EXACT) and ((target_expr, test_expr) not in KNOWN_PAIRS):
-        print("INFO: Adding known pair ({0}, {1})".format(target_expr, test_expr))
+        _log.debug("Adding known pair (%s, %s)", target_expr, test_expr)
         KNOWN_PAIRS[(target_expr, test_expr)] = equality_type
-    print("Equality: {}".format(equal))
-    if not _quiet:
-        print("=" * 50)
+    elif not equal and ((target_expr, test_expr) not in KNOWN_UNEQUAL_PAIRS):
+        _log.debug("Adding known unequal pair (%s, %s)", target_expr, test_expr)
+        KNOWN_UNEQUAL_PAIRS[(target_expr, test_expr)] = equality_type
+    _log.info("Equality: %s (%s)", equal, equality_type.value)
+    count_decision("logic", equality_type, equal)
     result["equal"] = str(equal).lower()
     result["equality_type"] = equality_type.value
     return result
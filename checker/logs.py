@@ -0,0 +1,145 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+
+__all__ = ["get_logger", "configure_logging", "flush_logging"]
+
+
+# The level of messages to log from every stage of checking, such as "DEBUG" to
+# see every value computed, or "INFO" for just each request and its result:
+LOG_LEVEL = os.environ.get("EQUALITY_CHECKER_LOG_LEVEL", "INFO")
+# Levels for particular stages overriding LOG_LEVEL, such as "maths.numeric=DEBUG,logic=WARNING":
+STAGE_LOG_LEVELS = os.environ.get("EQUALITY_CHECKER_STAGE_LOG_LEVELS", "")
+# In quiet mode only warnings and errors are logged, whatever the levels above; these
+# never contain expressions, so that no time is spent converting them to strings:
+QUIET = os.environ.get("EQUALITY_CHECKER_QUIET", "false").lower() == "true"
+
+LOG_FORMAT = "%(process)d %(levelname)s [%(name)s] %(message)s"
+
+# All loggers are below this one, so that it alone needs a handler:
+_ROOT_NAME = "checker"
+_listener = None
+_paused_for_fork = False
+_configured_stages = set()
+
+
+def get_logger(stage):
+    """Return the logger for a stage of checking, like "maths.numeric".
+
+       Messages should be logged with arguments rather than formatted first, as
+       in 'logger.debug("Parsed: %s", expr)', so that expressions are only
+       converted to strings if the message is actually logged.
+        - 'stage' should be the name of the stage, whose level can be set in
+          STAGE_LOG_LEVELS; stages are nested by dots, like module names.
+    """
+    return logging.getLogger("{}.{}".format(_ROOT_NAME, stage))
+
+
+def _parse_stage_levels(stage_levels):
+    """Turn a string like "maths.numeric=DEBUG,logic=WARNING" into a dict."""
+    levels = dict()
+    for item in stage_levels.split(","):
+        if "=" in item:
+            stage, level = item.split("=", 1)
+            levels[stage.strip()] = level.strip().upper()
+    return levels
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """A QueueHandler which queues records as they are, so that the writing thread formats them.
+
+       Messages are logged with arguments like expressions, which never change,
+       so formatting them later gives the same message.
+    """
+    def prepare(self, record):
+        return record
+
+
+def _start_listener(handler):
+    """Start a thread writing queued messages out, returning the handler to queue them."""
+    global _listener
+    # A Queue rather than a SimpleQueue, so that flush_logging() can wait for it to be emptied:
+    message_queue = queue.Queue()
+    _listener = logging.handlers.QueueListener(message_queue, handler)
+    _listener.start()
+    return _DeferredQueueHandler(message_queue)
+
+
+def _stop_listener():
+    """Write out any messages still queued, and stop the writing thread."""
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
+
+
+def _pause_listener_for_fork():
+    """Stop the writing thread before forking, so that no lock it holds is copied, still held, into the child.
+
+       The queue is emptied too, so the child does not write out a copy of it.
+    """
+    global _paused_for_fork
+    _paused_for_fork = _listener is not None and _listener._thread is not None
+    _stop_listener()
+
+
+def _resume_listener_after_fork():
+    """Start a writing thread again after forking, in both the parent and the child, which does not inherit threads."""
+    global _paused_for_fork
+    if _paused_for_fork:
+        _listener.start()
+    _paused_for_fork = False
+
+
+def flush_logging():
+    """Wait until every message logged so far has been written out.
+
+       Processes which end with os._exit(...), like forked subprocesses, must
+       call this first or lose their last messages. (Forking itself needs no
+       flush: the writing thread is stopped, emptying the queue, for every fork.)
+       The writing thread carries on; this just waits for it to empty the queue.
+    """
+    if _listener is not None and _listener._thread is not None:
+        _listener.queue.join()
+    for handler in (_listener.handlers if _listener is not None else []):
+        handler.flush()
+
+
+def configure_logging(*, level=None, stage_levels=None, quiet=None, stream=None):
+    """Set the levels of the checker's loggers and start writing their messages out.
+
+       Messages are put on a queue and written by a background thread, so that
+       checking never waits for output. Forked processes start their own thread.
+       The library never calls this itself; servers and scripts using the checker
+       should call it once. Calling it again just replaces the levels.
+        - 'level', 'stage_levels' and 'quiet' default to LOG_LEVEL, STAGE_LOG_LEVELS
+          and QUIET; 'stage_levels' may be a dict or a string like STAGE_LOG_LEVELS.
+        - 'stream' is where to write messages, by default standard output.
+    """
+    level = LOG_LEVEL if level is None else level
+    stage_levels = STAGE_LOG_LEVELS if stage_levels is None else stage_levels
+    quiet = QUIET if quiet is None else quiet
+    if isinstance(stage_levels, str):
+        stage_levels = _parse_stage_levels(stage_levels)
+
+    root = logging.getLogger(_ROOT_NAME)
+    root.setLevel(logging.WARNING if quiet else level)
+    for stage in _configured_stages:
+        get_logger(stage).setLevel(logging.NOTSET)
+    _configured_stages.clear()
+    if not quiet:
+        for stage, stage_level in stage_levels.items():
+            get_logger(stage).setLevel(stage_level)
+            _configured_stages.add(stage)
+
+    if _listener is None:
+        handler = logging.StreamHandler(sys.stdout if stream is None else stream)
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        root.addHandler(_start_listener(handler))
+        root.propagate = False
+        atexit.register(_stop_listener)
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(before=_pause_listener_for_fork, after_in_parent=_resume_listener_after_fork,
+                                after_in_child=_resume_listener_after_fork)
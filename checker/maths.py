@@ -1,43 +1,96 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import functools
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
 import numpy
 import sympy
-
-from .utils import known_equal_pair, eq_type_order, contains_incorrect_symbols
-from .utils import EqualityType
+from sympy.core.evalf import PrecisionExhausted
+
+from .utils import known_equal_pair, known_unequal_pair, eq_type_order, contains_incorrect_symbols, response_cache_key
+from .utils import echo_request
+from .utils import EqualityType, TimeLimit, TimeLimitException
+from .logs import get_logger, flush_logging
+from .metrics import StageTimer, RequestTimings, mark_cache, count_decision, count_timeout, disable_recording
+from .cache import LRUCache, known_pairs_cache, response_cache
+from .identity import rational_identity
+from .evaluator import compile_expression, sample_points
 from .parsing import maths_parser, UnsafeInputException
 
 
-# Hack to fix a bug with lambdify and complex infinity ('zoo') when transforming
-# to NumPy for evaluation. Map complex infinity to Not a Number ('nan').
-from sympy.utilities.lambdify import NUMPY_TRANSLATIONS
-NUMPY_TRANSLATIONS["zoo"] = "nan"
-
 # Silence NumPy warnings:
 numpy.seterr(all="ignore")
 
 
-__all__ = ["check"]
-
-
-KNOWN_PAIRS = dict()
-
-# Numpy (understandably) doesn't have all 24 trig functions defined. Define those missing for completeness. (No hyperbolic inverses for now!)
-NUMPY_MISSING_FN = {"csc": lambda x: 1/numpy.sin(x), "sec": lambda x: 1/numpy.cos(x), "cot": lambda x: 1/numpy.tan(x),
-                    "acsc": lambda x: numpy.arcsin(numpy.float_power(x, -1)), "asec": lambda x: numpy.arccos(numpy.float_power(x, -1)), "acot": lambda x: numpy.arctan(numpy.float_power(x, -1)),
-                    "asinh": lambda x: numpy.arcsinh(x), "acosh": lambda x: numpy.arccosh(x), "atanh": lambda x: numpy.arctanh(x),
-                    "csch": lambda x: 1/numpy.sinh(x), "sech": lambda x: 1/numpy.cosh(x), "coth": lambda x: 1/numpy.tanh(x),
-                    "acsch": lambda x: numpy.arcsinh(numpy.float_power(x, -1)), "asech": lambda x: numpy.arccosh(numpy.float_power(x, -1)), "acoth": lambda x: numpy.arctanh(numpy.float_power(x, -1))}
-# Make a complex form of the above for no-variable cases of numeric evaluation.
-# (Late Binding means that can't just use NUMPY_MISSING_FN[k] since this isn't evaluated in
-# the for loop properly. But adding it as a default argument to the lambda *does* cause the
-# evaluation and so the two effects cancel out. Neat!)
-NUMPY_COMPLEX_FN = {k: lambda x, f=NUMPY_MISSING_FN[k]: f(x + 0j) for k in list(NUMPY_MISSING_FN.keys())}
+__all__ = ["check", "check_batch"]
+
+_log = get_logger("maths")
+_parse_log = get_logger("maths.parse")
+_exact_log = get_logger("maths.exact")
+_identity_log = get_logger("maths.identity")
+_symbolic_log = get_logger("maths.symbolic")
+_numeric_log = get_logger("maths.numeric")
+_answers_log = get_logger("maths.answers")
+
+KNOWN_PAIRS = known_pairs_cache("maths")
+KNOWN_UNEQUAL_PAIRS = known_pairs_cache("maths_unequal")
+RESPONSE_CACHE = response_cache()
+
+# How many points to compare values at for numeric equality, and how many targets'
+# values at those points should be remembered:
+NUMERIC_SAMPLE_POINTS = 25
+TARGET_VALUES_CACHE_SIZE = 1000
+TARGET_VALUES = LRUCache(TARGET_VALUES_CACHE_SIZE)
+# How many significant figures of those values to keep in a fingerprint, and how many
+# questions' indexes of anticipated wrong answers should be remembered:
+FINGERPRINT_DIGITS = 6
+ANSWER_INDEX_CACHE_SIZE = 1000
+ANSWER_INDEXES = LRUCache(ANSWER_INDEX_CACHE_SIZE)
+# How many registered targets' canonical forms should be remembered, and how many
+# seconds each of expanding and simplifying a target to register may take:
+REGISTERED_TARGETS_CACHE_SIZE = 1000
+REGISTERED_TARGETS = LRUCache(REGISTERED_TARGETS_CACHE_SIZE)
+TARGET_FORMS_TIME_LIMIT = 0.5
 
 # Whether to allow derivative simplification.
 # FIXME: this should be a parameter of the check(...) method.
 SIMPLIFY_DERIVATIVES = False
 
+# Whether to reject expressions which clearly differ at a few points before
+# trying symbolic equality, how many points to use, how large a difference
+# relative to the target's values is clear, and how many seconds to spend:
+NUMERIC_PRESCREEN = True
+PRESCREEN_SAMPLE_POINTS = 4
+PRESCREEN_TOLERANCE = 1E-8
+PRESCREEN_TIME_LIMIT = 0.05
+
+# The stages of symbolic simplification, cheapest first, ending with the full
+# 'simplify'; and how often each stage has settled a pair:
+SYMBOLIC_STAGES = [
+    ("expand", lambda expr: sympy.expand(expr)),
+    ("cancel", lambda expr: sympy.cancel(sympy.together(expr))),
+    ("powsimp", lambda expr: sympy.powsimp(sympy.expand_log(expr))),
+    ("trigsimp", lambda expr: sympy.trigsimp(expr)),
+    ("simplify", lambda expr: sympy.simplify(expr, doit=False)),
+]
+SYMBOLIC_STAGE_COUNTS = collections.Counter()
+# How many seconds may all the stages before 'simplify' take together, and at most what
+# share of the time left before the request's deadline (see TimeLimit.remaining())?
+SYMBOLIC_STAGES_TIME_LIMIT = 0.5
+SYMBOLIC_STAGES_DEADLINE_SHARE = 0.25
+
+# Whether to run symbolic equality in a subprocess at the same time as numeric
+# equality, rather than one after the other. (This needs os.fork(), so is ignored
+# on Windows; and only helps if there is a spare CPU core.)
+CONCURRENT_EQUALITY = False
+# How often, in seconds, a symbolic equality subprocess checks it is still wanted:
+_ORPHAN_CHECK_INTERVAL = 1
+
 
 class NumericRangeException(Exception):
     """An exception to be raised when numeric values are rejected."""
@@ -49,6 +102,7 @@ class EquationTypeMismatch(TypeError):
     pass
 
 
+@StageTimer("maths.parse")
 def parse_expression(expression_str, *, local_dict=None):
     """Take a string containing a mathematical expression and return a sympy expression.
 
@@ -61,8 +115,7 @@ def parse_expression(expression_str, *, local_dict=None):
     try:
         return maths_parser.parse_expr(expression_str, local_dict=local_dict)
     except maths_parser.ParsingException:
-        print("Incorrectly formatted expression.")
-        print("Fail: '{}'.".format(expression_str))
+        _parse_log.info("Incorrectly formatted expression: '%s'.", expression_str)
         return None
 
 
@@ -105,9 +158,9 @@ def simplify_derivative(derivative):
     # Undo swapping Symbols to Functions:
     # d = d.subs(reverse)
     d = d.xreplace(reverse)
-    # Then for logging print the simplification:
+    # Then log the simplification:
     if derivative != d:
-        print("Simplified '{0}' to '{1}'!".format(derivative, d))
+        _symbolic_log.debug("Simplified '%s' to '%s'!", derivative, d)
     return d
 
 
@@ -126,6 +179,7 @@ def simplify_derivatives(expr):
     return expr
 
 
+@StageTimer("maths.exact")
 def exact_match(test_expr, target_expr):
     """Test if the entered expression exactly matches the known expression.
 
@@ -145,28 +199,72 @@ def exact_match(test_expr, target_expr):
         - 'test_expr' should be the untrusted sympy expression to check.
         - 'target_expr' should be the trusted sympy expression to match against.
     """
-    print("[EXACT TEST]")
     if test_expr == target_expr:
-        print("Exact Match (with '==')")
+        _exact_log.debug("Exact Match (with '==')")
         return True
     elif sympy.srepr(test_expr) == sympy.srepr(target_expr):
         # This is a (perfectly acceptable) hack for ordering the atoms of each
         # term, but a more explicit method may be preferable in the future.
-        print("Exact Match (with 'srepr')")
+        _exact_log.debug("Exact Match (with 'srepr')")
         return True
     else:
         return False
 
 
+@StageTimer("maths.identity")
+def identity_equality(test_expr, target_expr):
+    """Test if two polynomials or rational functions are identical.
+
+       Evaluate both expressions exactly, modulo a random prime, at random points
+       using rational_identity(...). This is far faster than simplifying their
+       difference, and decides the question either way: different values prove the
+       expressions are not equal, and the chance that identical values are wrong
+       is bounded and negligible.
+
+       Returns True if the expressions are identical, False if they are definitely
+       not equal, and None if this cannot be decided because an expression is not
+       a polynomial or rational function with rational coefficients.
+
+        - 'test_expr' should be the untrusted sympy expression to check.
+        - 'target_expr' should be the trusted sympy expression to match against.
+    """
+    try:
+        identical, error_bound = rational_identity(test_expr, target_expr)
+    except TypeError as e:
+        _identity_log.debug("%s - Can't check identity!", e)
+        return None
+    if identical:
+        _identity_log.debug("Identity match, with chance of error below %.1E.", error_bound)
+        _identity_log.debug("Adding known pair (%s, %s)", target_expr, test_expr)
+        KNOWN_PAIRS[(target_expr, test_expr)] = EqualityType.IDENTITY
+        return True
+    else:
+        _identity_log.debug("Not identical.")
+        return False
+
+
+@StageTimer("maths.symbolic")
 def symbolic_equality(test_expr, target_expr):
     """Test if two expressions are symbolically equivalent.
 
-       Use the sympy 'simplify' function to test if the difference between two
-       expressions is symbolically zero. This is known to be impossible in the general
-       case, but should work well enough for most cases likely to be used on Isaac.
-       A return value of 'False' thus does not necessarily mean the two expressions
-       are not equal (sympy assumes complex number variables; so some simlifications
-       may not occur).
+       Use sympy to test if the difference between two expressions is symbolically
+       zero. This is known to be impossible in the general case, but should work
+       well enough for most cases likely to be used on Isaac. A return value of
+       'False' thus does not necessarily mean the two expressions are not equal
+       (sympy assumes complex number variables; so some simlifications may not
+       occur).
+
+       Most differences which are zero are shown to be so by a cheap rewrite like
+       'expand' or 'cancel', long before the full 'simplify' would finish; so the
+       stages of SYMBOLIC_STAGES are tried in turn, each on the result of the last,
+       stopping at the first to reach zero. The stages before 'simplify' share one
+       budget, see _cheap_symbolic_stages(...), so that they never cost much on
+       top of it; and the last stage, 'simplify', carries on from where they got
+       to, which is usually quicker than starting again. The stage which settled
+       each pair is counted in SYMBOLIC_STAGE_COUNTS.
+       If the target has been registered, its canonical forms from TargetForms are
+       used; so only the test is expanded, and the expansions are compared before
+       trying the later stages, with 'simplify' using the simplified target.
 
        Returns True if sympy can determine that the two expressions are equal,
        and returns False if this cannot be determined OR if the two expressions
@@ -175,24 +273,213 @@ def symbolic_equality(test_expr, target_expr):
         - 'test_expr' should be the untrusted sympy expression to check.
         - 'target_expr' should be the trusted sympy expression to match against.
     """
-    print("[SYMBOLIC TEST]")
     # Here we make the assumption that all variables are real and positive to
     # aid the simplification process. Since we do this for numeric checking anyway,
     # it doesn't seem like much of an issue. Removing 'sympy.posify()' below will
     # stop this.
+    forms = REGISTERED_TARGETS.get(target_expr)
+    mark_cache("registered_targets", forms is not None)
+    if forms is None:
+        expr, settled_by, skipped = sympy.posify(test_expr - target_expr)[0], None, set()
+    else:
+        # Only the test needs normalising; and since 'expand' is linear, this is
+        # the expanded difference:
+        _symbolic_log.debug("Using canonical forms of registered target.")
+        posified_test = positive_symbols(test_expr)
+        expr = sympy.expand(posified_test) - forms.expanded
+        settled_by, skipped = "canonical" if expr == 0 else None, {"expand"}
+
+    if settled_by is None:
+        settled_by, expr = _cheap_symbolic_stages(expr, skipped)
+    if settled_by is None:
+        name, rewrite = SYMBOLIC_STAGES[-1]
+        try:
+            if rewrite(expr if forms is None else posified_test - forms.simplified) == 0:
+                settled_by = name
+        except NotImplementedError as e:
+            _symbolic_log.debug("%s: %s - Can't check symbolic equality with '%s'!", type(e).__name__, str(e).capitalize(), name)
+
+    SYMBOLIC_STAGE_COUNTS[settled_by or "none"] += 1
+    if settled_by is None:
+        return False
+    _symbolic_log.debug("Symbolic match after '%s'.", settled_by)
+    _symbolic_log.debug("Adding known pair (%s, %s)", target_expr, test_expr)
+    KNOWN_PAIRS[(target_expr, test_expr)] = EqualityType.SYMBOLIC
+    return True
+
+
+def _cheap_symbolic_stages(expr, skipped):
+    """Rewrite a difference with each stage of SYMBOLIC_STAGES before 'simplify' in turn, until it is zero.
+
+       All the stages share a budget of SYMBOLIC_STAGES_TIME_LIMIT seconds, or
+       SYMBOLIC_STAGES_DEADLINE_SHARE of the time left before the request's
+       deadline if that is less, so that 'simplify' keeps most of the time.
+       Once the budget is spent, the remaining stages are not tried.
+       Returns a tuple of the name of the stage which reached zero, or None, and
+       the difference as far as it was rewritten.
+        - 'expr' should be the posified difference, perhaps already rewritten.
+        - 'skipped' should be the names of any stages already applied to it.
+    """
+    budget = SYMBOLIC_STAGES_TIME_LIMIT
+    if TimeLimit.remaining() is not None:
+        budget = min(budget, SYMBOLIC_STAGES_DEADLINE_SHARE * TimeLimit.remaining())
+    deadline = time.monotonic() + budget
+    for name, rewrite in SYMBOLIC_STAGES[:-1]:
+        if name in skipped:
+            continue
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            with TimeLimit(remaining):
+                expr = rewrite(expr)
+        except TimeLimitException:
+            break
+        except NotImplementedError as e:
+            _symbolic_log.debug("%s: %s - Can't check symbolic equality with '%s'!", type(e).__name__, str(e).capitalize(), name)
+            continue
+        if expr == 0:
+            return name, expr
+    else:
+        return None, expr
+    _symbolic_log.info("Symbolic stages took longer than %.2f second(s), stopped at '%s'!", budget, name)
+    return None, expr
+
+
+def positive_symbols(expr):
+    """Replace each symbol in an expression with a positive symbol of the same name.
+
+       This is like sympy's 'posify', but always uses the same positive symbols,
+       so that separately posified expressions can be compared or combined.
+        - 'expr' should be the sympy expression.
+    """
+    return expr.xreplace({s: sympy.Symbol(s.name, positive=True) for s in expr.free_symbols
+                          if isinstance(s, sympy.Symbol) and s.is_positive is None})
+
+
+class TargetForms(object):
+    """The canonical forms of a trusted target expression, to reuse in symbolic_equality(...).
+
+       Its symbols are all made positive by positive_symbols(...), and it is both
+       expanded and simplified. These are computed once, when the target is
+       registered by register_target(...). Each may take TARGET_FORMS_TIME_LIMIT
+       seconds: if expanding takes longer a TimeLimitException is raised, but if
+       simplifying does the target is just left unsimplified.
+        - 'target_expr' should be the trusted sympy expression.
+    """
+    def __init__(self, target_expr):
+        self.posified = positive_symbols(target_expr)
+        with TimeLimit(TARGET_FORMS_TIME_LIMIT):
+            self.expanded = sympy.expand(self.posified)
+        try:
+            with TimeLimit(TARGET_FORMS_TIME_LIMIT):
+                self.simplified = sympy.simplify(self.posified, doit=False)
+        except TimeLimitException:
+            _symbolic_log.info("Simplifying target took longer than %s second(s)!", TARGET_FORMS_TIME_LIMIT)
+            self.simplified = self.posified
+
+
+def replace_derivatives(test_expr, target_expr):
+    """Replace the derivatives in two expressions with symbols, for numeric evaluation.
+
+       Each derivative is treated as a new variable, independent of the variables it
+       involves. To avoid naming clashes, these are just named in ascending numeric
+       order by length of arguments. This ordering helps ensure something like
+       d^2y/dx^2 gets substituted before the implicit inner dy/dx gets replaced and
+       breaks things.
+       Returns the new test and target expressions.
+        - 'test_expr' and 'target_expr' should be the sympy expressions to compare.
+    """
+    derivatives = target_expr.atoms(sympy.Derivative).union(test_expr.atoms(sympy.Derivative))
+    for d, derivative in enumerate(sorted(derivatives, key=lambda d: len(d.args), reverse=True)):
+        derivative_symbol = sympy.Symbol("Derivative_{}".format(d))
+        _numeric_log.debug("Swapping '%s' into variable '%s' for numeric evaluation!", derivative, derivative_symbol)
+        target_expr = target_expr.subs(derivative, derivative_symbol)
+        test_expr = test_expr.subs(derivative, derivative_symbol)
+    return test_expr, target_expr
+
+
+def _prescreen_values(test_expr, target_expr, f_test, f_target, sample):
+    """Return the values of the test and target expressions at a sample point, or None if they cannot be trusted.
+
+       The compiled 'f_test' and 'f_target' first check in floating point that
+       evaluating each expression stays finite, and then 'evalf' evaluates both
+       accurately at the exact rational point.
+        - 'sample' should map each variable to its floating point value.
+    """
     try:
-        if sympy.simplify(sympy.posify(test_expr - target_expr)[0], doit=False) == 0:
-            print("Symbolic match.")
-            print("INFO: Adding known pair ({0}, {1})".format(target_expr, test_expr))
-            KNOWN_PAIRS[(target_expr, test_expr)] = EqualityType.SYMBOLIC
-            return True
-        else:
-            return False
-    except NotImplementedError as e:
-        print("{0}: {1} - Can't check symbolic equality!".format(type(e).__name__, str(e).capitalize()))
+        with numpy.errstate(over="raise", divide="raise", invalid="raise"):
+            f_target(*sample.values()), f_test(*sample.values())
+        point = {variable: sympy.Rational(value) for variable, value in sample.items()}
+        target_value = complex(target_expr.evalf(15, subs=point, strict=True))
+        test_value = complex(test_expr.evalf(15, subs=point, strict=True))
+    except (FloatingPointError, PrecisionExhausted, TypeError, ValueError, ArithmeticError, NotImplementedError):
+        return None
+    if not (numpy.isfinite(target_value) and numpy.isfinite(test_value)):
+        return None
+    return test_value, target_value
+
+
+@StageTimer("maths.prescreen")
+def numeric_prescreen(test_expr, target_expr):
+    """Test if two expressions clearly differ at a few sample points.
+
+       Most wrong answers differ from the target almost everywhere, so evaluating
+       both expressions at a handful of points can reject them without the cost
+       of 'simplify'. The points are the first of those for numeric equality,
+       but as exact rationals; and each expression is evaluated to 15
+       significant figures by 'evalf', which raises its working precision as
+       needed to avoid cancellation errors, or gives up. So values which differ
+       by more than PRESCREEN_TOLERANCE of the largest target value really do
+       differ. Points where either expression cannot be evaluated accurately, or
+       is undefined, are ignored; as are any points not reached within
+       PRESCREEN_TIME_LIMIT seconds, since this must stay cheap next to what it saves.
+
+       Returns False if the two expressions clearly differ, and True if they may
+       be equal and need checking properly.
+
+        - 'test_expr' should be the untrusted sympy expression to check.
+        - 'target_expr' should be the trusted sympy expression to match against.
+    """
+    test_expr_n, target_expr_n = replace_derivatives(test_expr, target_expr)
+    if len(target_expr_n.free_symbols.difference(test_expr_n.free_symbols)) > 0:
+        _numeric_log.debug("Test expression doesn't contain all target expression variables! Can't prescreen.")
+        return True
+
+    variables = sorted(test_expr_n.free_symbols, key=str)
+    domain = sample_points(len(variables), PRESCREEN_SAMPLE_POINTS).T
+    # The 'evalf' of anything astronomically large can take practically forever, so
+    # only use points where every step of evaluating both expressions in floating point
+    # stays finite. (NumPy's log(x) takes one argument, see numeric_equality(...).)
+    target_values, test_values = [], []
+    try:
+        with TimeLimit(PRESCREEN_TIME_LIMIT):
+            f_target = compile_expression(sympy.expand_log(target_expr_n), variables)
+            f_test = compile_expression(sympy.expand_log(test_expr_n), variables)
+            for sample in domain:
+                values = _prescreen_values(test_expr_n, target_expr_n, f_test, f_target, dict(zip(variables, sample)))
+                if values is not None:
+                    test_values.append(values[0])
+                    target_values.append(values[1])
+    except TimeLimitException:
+        _numeric_log.debug("Prescreen took longer than %s second(s)!", PRESCREEN_TIME_LIMIT)
+    except (TypeError, ValueError, NotImplementedError) as e:
+        _numeric_log.debug("%s: %s - Can't prescreen!", type(e).__name__, e)
+        return True
+    if len(target_values) == 0:
+        _numeric_log.debug("Neither expression could be evaluated accurately!")
+        return True
+
+    target_values, test_values = numpy.array(target_values), numpy.array(test_values)
+    largest_diff = numpy.max(numpy.abs(target_values - test_values))
+    _numeric_log.debug("Prescreen at %d point(s): largest difference of %.6E", len(target_values), largest_diff)
+    if largest_diff > PRESCREEN_TOLERANCE * numpy.max(numpy.abs(target_values)):
+        _numeric_log.debug("Expressions clearly differ.")
         return False
+    return True
 
 
+@StageTimer("maths.numeric")
 def numeric_equality(test_expr, target_expr, *, complexify=False):
     """Test if two expressions are numerically equivalent to one another.
 
@@ -203,6 +490,8 @@ def numeric_equality(test_expr, target_expr, *, complexify=False):
        cases where these parameters make no difference). Testing is performed on
        the interval [0, 1) and if 'complexify' is set then complex values are
        allowed, but the samples are still in the interval [0, 1) on the real line.
+       The sample points are the same every time, see sample_points(...), so the
+       values of each target are only calculated once and kept in TARGET_VALUES.
 
        Returns True if the two expressions are equal for the sampled points, and
        False otherwise.
@@ -212,79 +501,61 @@ def numeric_equality(test_expr, target_expr, *, complexify=False):
         - 'complexify' is a boolean flag for sampling in the complex plane rather
           than just over the reals.
     """
-    print("[NUMERIC TEST]" if not complexify else "[NUMERIC TEST (COMPLEX)]")
-    SAMPLE_POINTS = 25
-    lambdify_modules = [NUMPY_MISSING_FN, "numpy"]
+    _numeric_log.debug("Sampling %s values.", "complex" if complexify else "real")
 
     # Leave original expressions unchanged, and expand logarithms!
     # NumPy has a log(x) function that takes only one argument, whereas SymPy
-    # has a log(x, base) function which would break when calling lambdify if it
+    # has a log(x, base) function which would be evaluated differently if it
     # was left unexpanded.
     target_expr_n = sympy.expand_log(target_expr)
     test_expr_n = sympy.expand_log(test_expr)
 
-    # Replace any derivatives that exist with new dummy symbols, and treat them
-    # as independent from the variables they involve. To avoid naming clashes,
-    # just name them in ascending numeric order by length of arguments.
-    # This ordering helps ensure something like d^2y/dx^2 gets substituted before
-    # the implicit inner dy/dx gets replaced and breaks things.
-    derivatives = target_expr.atoms(sympy.Derivative).union(test_expr.atoms(sympy.Derivative))
-    for d, derivative in enumerate(sorted(derivatives, key=lambda d: len(d.args), reverse=True)):
-        derivative_symbol = sympy.Symbol("Derivative_{}".format(d))
-        print("Swapping '{0}' into variable '{1}' for numeric evaluation!".format(derivative, derivative_symbol))
-        target_expr_n = target_expr_n.subs(derivative, derivative_symbol)
-        test_expr_n = test_expr_n.subs(derivative, derivative_symbol)
+    # Treat any derivatives as independent variables:
+    test_expr_n, target_expr_n = replace_derivatives(test_expr_n, target_expr_n)
 
     # If target has variables not in test, then test cannot possibly be equal.
     # This introduces an asymmetry; target is trusted to only contain necessary symbols,
     # but test is not.
     if len(target_expr_n.free_symbols.difference(test_expr_n.free_symbols)) > 0:
-        print("Test expression doesn't contain all target expression variables! Can't be numerically tested.")
+        _numeric_log.debug("Test expression doesn't contain all target expression variables! Can't be numerically tested.")
         return False
 
-    # Evaluate over a domain, but if the test domain is larger; add in extra dimensions
-    # i.e. if target is f(x) but test is g(x, y) then we need to sample over y too
-    # in case it has no effect on the result [say g(x,y) = (y/y) * f(x) , which is
-    # mathematically identical to f(x) but may have been missed by the symbolic part.]
-    domain_target = numpy.random.random_sample((len(target_expr_n.free_symbols), SAMPLE_POINTS))
-    extra_test_freedom = numpy.random.random_sample((len(test_expr_n.free_symbols) - len(target_expr_n.free_symbols), SAMPLE_POINTS))
-    domain_test = numpy.concatenate((domain_target, extra_test_freedom))
-
-    # If we're trying the samples in the complex plane, make these arrays complex
-    # in the simplest way possible: adding 0 of the imaginary unit.
-    # Also use the complex versions of the missing numpy functions (for cases
-    # where there are no variables, only constants, this is essential!)
-    if complexify:
-        domain_target = domain_target + 0j
-        domain_test = domain_test + 0j
-        lambdify_modules = [NUMPY_COMPLEX_FN, "numpy"]
-
-    # Make sure that the arguments are given in the same order to lambdify for target and test
+    # Make sure that the arguments are given in the same order for target and test
     # to ensure that when numbers are blindly passed in, the same number goes to the same
     # symbol when evaluated for both test and target.
-    shared_variables = list(target_expr_n.free_symbols)  # We ensured above that all symbols in target are in test also
-    extra_test_variables = list(test_expr_n.free_symbols.difference(target_expr_n.free_symbols))
+    shared_variables = sorted(target_expr_n.free_symbols, key=str)  # We ensured above that all symbols in target are in test also
+    extra_test_variables = sorted(test_expr_n.free_symbols.difference(target_expr_n.free_symbols), key=str)
     test_variables = shared_variables + extra_test_variables
 
+    # Evaluate over a domain, but if the test domain is larger; add in extra dimensions
+    # i.e. if target is f(x) but test is g(x, y) then we need to sample over y too
+    # in case it has no effect on the result [say g(x,y) = (y/y) * f(x) , which is
+    # mathematically identical to f(x) but may have been missed by the symbolic part.]
+    # The sample points are always the same, and the target's are the first dimensions
+    # of the test's; so the values of the target only ever need evaluating once.
     try:
-        # Make the target expression into something numpy can evaluate, then evaluate
+        # Compile the target expression into something numpy can evaluate, then evaluate
         # for the sample points. This *should* now be safe, but still could be dangerous.
-        f_target = sympy.lambdify(shared_variables, target_expr_n, lambdify_modules)
-        eval_f_target = f_target(*domain_target)
+        cache_key = (target_expr_n, complexify)
+        eval_f_target = TARGET_VALUES.get(cache_key)
+        mark_cache("target_values", eval_f_target is not None)
+        if eval_f_target is None:
+            eval_f_target = numpy.array(sample_values(target_expr_n, shared_variables, complexify=complexify))
+            eval_f_target.setflags(write=False)
+            TARGET_VALUES[cache_key] = eval_f_target
+        else:
+            _numeric_log.debug("Known target function value(s).")
 
-        # Repeat for the test expression, to get an array of containing SAMPLE_POINTS
+        # Repeat for the test expression, to get an array of containing NUMERIC_SAMPLE_POINTS
         # values of test_expr_n to be compared to target_expr_n
-        f_test = sympy.lambdify(test_variables, test_expr_n, lambdify_modules)
-        eval_f_test = f_test(*domain_test)
+        eval_f_test = sample_values(test_expr_n, test_variables, complexify=complexify)
     except OverflowError as e:
         raise NumericRangeException(e)
 
     # Output the function values at the sample points for debugging?
-    # The actual domain arrays are probably too long to be worth ever printing.
-    print("Target function value(s):")
-    print(eval_f_target)
-    print("Test function value(s):")
-    print(eval_f_test)
+    # The actual domain arrays are probably too long to be worth ever logging.
+    _numeric_log.debug("Target function value(s):\n%s", eval_f_target)
+    _numeric_log.debug("Test function value(s):\n%s", eval_f_test)
 
     # Can we safely cast the values to 64 bit floats (2 x 64 bits for complex values)?
     # Real values that can be safely cast to 'float64' can always be cast to 'complex128'
@@ -299,8 +570,9 @@ def numeric_equality(test_expr, target_expr, *, complexify=False):
     if not (numpy.all(numpy.isfinite(eval_f_target)) and numpy.all(numpy.isfinite(eval_f_test))):
         # If have not tried using complex numbers, try using those:
         if not complexify:
-            print("A function appears to be undefined in the interval [0,1). Trying again with complex values!")
-            return numeric_equality(test_expr, target_expr, complexify=True)
+            _numeric_log.debug("A function appears to be undefined in the interval [0,1). Trying again with complex values!")
+            with StageTimer("maths.numeric_complex"):
+                return numeric_equality.__wrapped__(test_expr, target_expr, complexify=True)
         else:
             # If have tried using complex numbers, can't evaluate and have gone badly wrong:
             raise NumericRangeException("A function in the test or target expression is undefined in the interval [0,1).")
@@ -319,17 +591,174 @@ def numeric_equality(test_expr, target_expr, *, complexify=False):
     # the largest value in the target function; the two things are probably equal!
     # This will cope perfectly with complex numbers too!
     diff = numpy.sum(numpy.abs(eval_f_target - eval_f_test))
-    print("Numeric Equality Tested: absolute difference of {:.6E}".format(diff))
+    _numeric_log.debug("Numeric Equality Tested: absolute difference of %.6E", diff)
     if diff <= (1E-10 * numpy.max(numpy.abs(eval_f_target))):
-        print("INFO: Adding known pair ({0}, {1})".format(target_expr, test_expr))
+        _numeric_log.debug("Adding known pair (%s, %s)", target_expr, test_expr)
         KNOWN_PAIRS[(target_expr, test_expr)] = EqualityType.NUMERIC
         return True
     else:
         return False
 
 
+def sample_values(expr, variables, *, complexify=False):
+    """Evaluate an expression at the sample points used for numeric equality.
+
+       Returns an array of NUMERIC_SAMPLE_POINTS values, or a single value if
+       the expression has no variables.
+        - 'expr' should be the sympy expression, with logarithms expanded and
+          derivatives replaced as in numeric_equality(...).
+        - 'variables' should be the list of its symbols; the values used for each
+          depend only on its position in the list.
+        - 'complexify' says whether to evaluate with complex values, although the
+          sample points are still in the interval [0, 1) on the real line.
+    """
+    # If we're trying the samples in the complex plane, make these arrays complex
+    # in the simplest way possible: adding 0 of the imaginary unit.
+    # The expression is then compiled to use the complex versions of the missing numpy
+    # functions (for cases where there are no variables, only constants, this is essential!)
+    domain = sample_points(len(variables), NUMERIC_SAMPLE_POINTS)
+    if complexify:
+        domain = domain + 0j
+    with StageTimer("maths.numeric_compile"):
+        compiled = compile_expression(expr, variables, complexify=complexify)
+    with StageTimer("maths.numeric_evaluate"):
+        return compiled(*domain)
+
+
+def numeric_fingerprint(expr):
+    """Return a hashable fingerprint of the values of an expression at the numeric sample points.
+
+       The values are those numeric_equality(...) would compare, using complex
+       values only if real values are undefined, rounded to FINGERPRINT_DIGITS
+       significant figures relative to the largest of them. So expressions which
+       are numerically equal almost always have the same fingerprint, unless a
+       value happens to lie right on a rounding boundary, and any which do not
+       almost always have different fingerprints. A fingerprint only ever
+       suggests a match; it must be confirmed by checking properly.
+       Returns None if the expression cannot be evaluated at every point.
+        - 'expr' should be the sympy expression.
+    """
+    if not isinstance(expr, sympy.Expr):
+        return None
+    expr_n, _ = replace_derivatives(sympy.expand_log(expr), sympy.S.Zero)
+    variables = sorted(expr_n.free_symbols, key=str)
+    for complexify in [False, True]:
+        try:
+            values = numpy.broadcast_to(sample_values(expr_n, variables, complexify=complexify), NUMERIC_SAMPLE_POINTS)
+        except (OverflowError, TypeError, ValueError, AttributeError, SyntaxError):
+            return None
+        if numpy.all(numpy.isfinite(values)):
+            break
+    else:
+        return None
+
+    largest = numpy.max(numpy.abs(values))
+    exponent = int(numpy.floor(numpy.log10(largest))) if largest > 0 else 0
+    digits = numpy.round(values / 10.0**exponent * 10**(FINGERPRINT_DIGITS - 1))
+    return (tuple(str(v) for v in variables), complexify, exponent,
+            tuple(int(d) for d in digits.real), tuple(int(d) for d in digits.imag) if numpy.iscomplexobj(digits) else None)
+
+
+def _symbolic_equality_subprocess(test_expr, target_expr, connection, parent_pid):
+    """Run symbolic_equality(...) in a forked subprocess, sending the result down a pipe.
+
+       The subprocess exits if its parent dies, since it would otherwise run on
+       with nobody waiting for the answer.
+    """
+    def exit_if_orphaned():
+        while os.getppid() == parent_pid:
+            threading.Event().wait(_ORPHAN_CHECK_INTERVAL)
+        os._exit(1)
+    threading.Thread(target=exit_if_orphaned, daemon=True).start()
+    # The parent times the concurrent tests as a whole:
+    disable_recording()
+    try:
+        result = (True, symbolic_equality(test_expr, target_expr))
+    except Exception as e:
+        result = (False, e)
+    try:
+        connection.send(result)
+    except Exception:
+        # The exception could not be pickled:
+        connection.send((False, RuntimeError(repr(result[1]))))
+    flush_logging()
+
+
+def _fork_symbolic_equality(test_expr, target_expr):
+    """Start symbolic_equality(...) in a forked subprocess, returning its pid and the pipe it will answer down."""
+    parent_connection, child_connection = multiprocessing.Pipe(duplex=False)
+    parent_pid = os.getpid()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            parent_connection.close()
+            _symbolic_equality_subprocess(test_expr, target_expr, child_connection, parent_pid)
+        finally:
+            os._exit(0)
+    child_connection.close()
+    return pid, parent_connection
+
+
+def _receive_symbolic_equality(connection):
+    """Wait for the result of a symbolic equality subprocess, re-raising any exception it raised.
+
+       A subprocess which died without answering counts as finding no match.
+    """
+    try:
+        success, symbolic_equal = connection.recv()
+    except EOFError:
+        _log.warning("Symbolic test subprocess died unexpectedly!")
+        return False
+    if not success:
+        raise symbolic_equal
+    return symbolic_equal
+
+
+@StageTimer("maths.concurrent")
+def concurrent_equality(test_expr, target_expr):
+    """Test for symbolic and numeric equality at the same time, taking the first conclusive result.
+
+       Symbolic equality runs in a forked subprocess whilst numeric equality,
+       which is cheap and uses this process's caches, runs here. A symbolic
+       match or a numeric match is conclusive, and the other test is abandoned:
+       the symbolic subprocess is killed if numeric equality matches first. But
+       a symbolic failure is not conclusive, and nor is a numeric failure since
+       symbolic equality can succeed where numeric equality cannot; so then the
+       other result is awaited and the result is the same as trying symbolic then
+       numeric equality in turn. The winning test is recorded in KNOWN_PAIRS.
+       Returns a tuple of whether the expressions are equal, and the EqualityType.
+        - 'test_expr' should be the untrusted sympy expression to check.
+        - 'target_expr' should be the trusted sympy expression to match against.
+    """
+    _log.debug("Running symbolic and numeric tests concurrently.")
+    pid, parent_connection = _fork_symbolic_equality(test_expr, target_expr)
+    try:
+        try:
+            numeric_equal, numeric_error = numeric_equality(test_expr, target_expr), None
+        except NumericRangeException as e:
+            numeric_equal, numeric_error = False, e
+        if numeric_equal:
+            _log.debug("Numeric test matched first; stopping symbolic test.")
+            return True, EqualityType.NUMERIC
+
+        if _receive_symbolic_equality(parent_connection):
+            _log.debug("Symbolic test matched.")
+            KNOWN_PAIRS[(target_expr, test_expr)] = EqualityType.SYMBOLIC
+            return True, EqualityType.SYMBOLIC
+        if numeric_error is not None:
+            raise numeric_error
+        return False, EqualityType.NUMERIC
+    finally:
+        parent_connection.close()
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        os.waitpid(pid, 0)
+
+
 def expr_equality(test_expr, target_expr):
-    """Given two sympy expressions: test for exact, symbolic and numeric equality.
+    """Given two sympy expressions: test for exact, identity, symbolic and numeric equality.
 
        Check two sympy expressions for equality, throwing a TypeError if either
        of the provided sympy objects is not an expression.
@@ -343,9 +772,18 @@ def expr_equality(test_expr, target_expr):
     if not equal:
         # Now is the best time to simplify any derivatives:
         if SIMPLIFY_DERIVATIVES and (target_expr.has(sympy.Derivative) or test_expr.has(sympy.Derivative)):
-            print("[SIMPLIFY DERIVATIVES]")
+            _symbolic_log.debug("Simplifying derivatives.")
             target_expr = simplify_derivatives(target_expr)
             test_expr = simplify_derivatives(test_expr)
+        # Polynomials and rational functions can be decided without simplifying:
+        equal = identity_equality(test_expr, target_expr)
+        if equal is not None:
+            return equal, EqualityType.IDENTITY
+        # Most wrong answers can be rejected without simplifying:
+        if NUMERIC_PRESCREEN and not numeric_prescreen(test_expr, target_expr):
+            return False, EqualityType.NUMERIC
+        if CONCURRENT_EQUALITY and hasattr(os, "fork"):
+            return concurrent_equality(test_expr, target_expr)
         # Then try checking for symbolic equality:
         equality_type = EqualityType.SYMBOLIC
         equal = symbolic_equality(test_expr, target_expr)
@@ -361,50 +799,53 @@ def general_equality(test_expr, target_expr):
         - 'test_expr' should be the untrusted sympy object to check.
         - 'target_expr' should be the trusted sympy object to match against.
     """
-    equal, equality_type = known_equal_pair(KNOWN_PAIRS, test_expr, target_expr)
+    with StageTimer("maths.known_pairs"):
+        equal, equality_type = known_equal_pair(KNOWN_PAIRS, test_expr, target_expr)
+    mark_cache("known_pairs", equal)
     # If this is a known pair: return immediately:
     if equal:
         return equal, equality_type
+    # Likewise if this is a known unequal pair:
+    with StageTimer("maths.known_pairs"):
+        unequal, equality_type = known_unequal_pair(KNOWN_UNEQUAL_PAIRS, test_expr, target_expr)
+    mark_cache("known_unequal_pairs", unequal)
+    if unequal:
+        return False, equality_type
     # Dealing with an equation?
     if target_expr.is_Equality:
-        print("[[EQUATION CHECK]]")
         if not test_expr.is_Equality:
             raise EquationTypeMismatch("Expected an equation!")
-        print("[LHS == LHS]")
+        _log.debug("Comparing LHS with LHS.")
         equal_lhs, equality_type_lhs = expr_equality(test_expr.lhs, target_expr.lhs)
-        print("[RHS == RHS]")
+        _log.debug("Comparing RHS with RHS.")
         equal_rhs, equality_type_rhs = expr_equality(test_expr.rhs, target_expr.rhs)
         equal = equal_lhs and equal_rhs
         equality_type = eq_type_order([equality_type_lhs, equality_type_rhs])
         if not equal:
-            print("[CROSS SIDE CHECK]")
-            print("[LHS == RHS]")
+            _log.debug("Comparing LHS with RHS.")
             equal_lhs, equality_type_lhs = expr_equality(test_expr.rhs, target_expr.lhs)
-            print("[RHS == LHS]")
+            _log.debug("Comparing RHS with LHS.")
             equal_rhs, equality_type_rhs = expr_equality(test_expr.lhs, target_expr.rhs)
             equal = equal_lhs and equal_rhs
             equality_type = eq_type_order([equality_type_lhs, equality_type_rhs])
         return equal, equality_type
     # Dealing with an inequality?
     elif target_expr.is_Relational:
-        print("[[INEQUALITY CHECK]]")
         if not test_expr.is_Relational:
             raise EquationTypeMismatch("Expected an inequality!")
-        print("[LTS == LTS]")
+        _log.debug("Comparing lesser sides.")
         equal_lts, equality_type_lts = expr_equality(test_expr.lts, target_expr.lts)
-        print("[GTS == GTS]")
+        _log.debug("Comparing greater sides.")
         equal_gts, equality_type_gts = expr_equality(test_expr.gts, target_expr.gts)
         # Ensure that if one is strict inequlity, they both are. Or if one isn't, the other isn't.
         equal_rel = not (("Strict" in target_expr.func.__name__) != ("Strict" in test_expr.func.__name__))  # NOT XOR
-        print("[INEQUALITY TYPE CHECK]")
         if not equal_rel:
-            print("Strict vs Non-Strict Inequality Mismatch!")
+            _log.debug("Strict vs Non-Strict Inequality Mismatch!")
         equal = equal_lts and equal_gts and equal_rel
         equality_type = eq_type_order([equality_type_lts, equality_type_gts])
         return equal, equality_type
     # Else assume an expression:
     else:
-        print("[[EXPRESSION CHECK]]")
         if test_expr.is_Equality or test_expr.is_Relational:
             raise EquationTypeMismatch("Expected an expression!")
         return expr_equality(test_expr, target_expr)
@@ -426,19 +867,16 @@ def plus_minus_checker(test_str, target_str, *, symbols=None, check_symbols=True
           allow symbols which cancel out to be included (probably don't want this
           in questions).
     """
-    print("[[PLUS-OR-MINUS CHECKING]]")
     if not (('±' in target_str) and ('±' in test_str)):
-        print("Plus-or-Minus mismatch between test and target! Can't be equal!")
-        print("[[OVERALL RESULT]]")
-        print("Equality: False")
-        print("=" * 50)
+        _log.info("Plus-or-Minus mismatch between test and target! Can't be equal!")
+        _log.info("Equality: False")
         return dict(
             target=target_str,
             test=test_str,
             equal=str(False).lower(),
             equality_type=EqualityType.SYMBOLIC.value,
             )
-    print("[[Multi-Valued: Case Using +ve Value]]")
+    _log.debug("Multi-Valued: Case Using +ve Value")
     plus = check(test_str.replace('±', '+'), target_str.replace('±', '+'),
                  symbols=symbols, check_symbols=check_symbols, _quiet=True)
     if "error" in plus:
@@ -446,9 +884,8 @@ def plus_minus_checker(test_str, target_str, *, symbols=None, check_symbols=True
         plus["target"] = target_str
         plus["test"] = test_str
         plus["case"] = "+"
-        print("=" * 50)
         return plus
-    print("[[Multi-Valued: Case Using -ve Value]]")
+    _log.debug("Multi-Valued: Case Using -ve Value")
     minus = check(test_str.replace('±', '-'), target_str.replace('±', '-'),
                   symbols=symbols, check_symbols=check_symbols, _quiet=True)
     if "error" in minus:
@@ -456,13 +893,10 @@ def plus_minus_checker(test_str, target_str, *, symbols=None, check_symbols=True
         minus["target"] = target_str
         minus["test"] = test_str
         minus["case"] = "-"
-        print("=" * 50)
         return minus
     equal = (plus["equal"] == "true" and minus["equal"] == "true")
     equality_type = eq_type_order([EqualityType(t) for t in [plus["equality_type"], minus["equality_type"]]])
-    print("[[OVERALL RESULT]]")
-    print("Equality: {}".format(equal))
-    print("=" * 50)
+    _log.info("Equality: %s", equal)
     # We'll return only the strictly positive parsed target and test values for now:
     return dict(
                 target=target_str,
@@ -474,97 +908,191 @@ def plus_minus_checker(test_str, target_str, *, symbols=None, check_symbols=True
             )
 
 
-def check(test_str, target_str, *, symbols=None, check_symbols=True, description=None,
-          _quiet=False):
-    """The main checking function, calls each of the equality checking functions as required.
-
-       Returns a dict describing the equality; with important keys being 'equal',
-       and 'equality_type'. The key 'error' is added if something went wrong, and
-       this should always be checked for first.
+def parse_symbols(symbols):
+    """Turn a list of symbol names into a local dictionary for the parser.
 
-        - 'test_str' should be the untrusted string for sympy to parse.
-        - 'target_str' should be the trusted string to parse and match against.
-        - 'symbols' should be a string list or comma separated string of symbols
-           not to split during parsing.
-        - 'check_symbols' indicates whether to verfiy the symbols used in each
-          expression are exactly the same or not; setting this to False will
-          allow symbols which cancel out to be included (probably don't want this
-          in questions).
-        - 'description' is an optional description to print before the checker's
-          output to stdout which can be used to improve logging.
-        - '_quiet' is an internal argument used to suppress some output when
-          this function is called from plus_minus_checker().
+       Returns a dict of (name, sympy.Symbol(...)) pairs suitable for passing
+       as 'local_dict' to parse_expression(...), so that these symbols are
+       not split up during parsing.
+        - 'symbols' should be a string list or comma separated string of symbols,
+          or None.
     """
-
-    # Suppress this output if necessary:
-    if not _quiet:
-        print("=" * 50)
-        # For logging purposes, if we have a description: print it!
-        if description is not None:
-            print(description)
-            print("=" * 50)
-        print("[MATHS]")
-
-    # If nothing to parse, fail. On server, this will be caught in check_endpoint()
-    if (target_str == "") or (test_str == ""):
-        print("ERROR: No input provided!")
-        if not _quiet:
-            print("=" * 50)
-        return dict(error="Empty string as argument.")
-
-    # Cleanup the strings before anything is done to them:
-    error_is_test = False
-    try:
-        target_str = maths_parser.cleanup_string(target_str, reject_unsafe_input=True)
-        error_is_test = True
-        test_str = maths_parser.cleanup_string(test_str, reject_unsafe_input=True)
-    except UnsafeInputException:
-        print("ERROR: Input contained non-whitelisted characters!")
-        result = dict(error="Bad input provided!")
-        if error_is_test:
-            print("Test string: '{}'".format(test_str))
-            result["syntax_error"] = str(True).lower()
-        if not _quiet:
-            print("=" * 50)
-        return result
-
-    print("Target string: '{}'".format(target_str))
-    print("Test string: '{}'".format(test_str))
-
-    # If the input contains a plus-or-minus sign, we need to do things differently:
-    if (('±' in target_str) or ('±' in test_str)):
-        return plus_minus_checker(test_str, target_str, symbols=symbols, check_symbols=check_symbols)
-
     # Prevent splitting of known symbols (symbols with underscores are left alone by default anyway):
     local_dict = {}
     if symbols is not None:
-        if isinstance(symbols, str) or isinstance(symbols, str):
+        if isinstance(symbols, str):
             symbols = symbols.split(",")
         for s in symbols:
             s = s.strip()
             if maths_parser.is_valid_symbol(s):
                 # Only want symbols here, not functions or operators!
                 local_dict[s] = sympy.Symbol(s)
+    return local_dict
 
-    print("[[PARSE EXPRESSIONS]]")
-    # Parse the trusted target expression:
-    target_expr = parse_expression(target_str, local_dict=local_dict)
-    # Parse the untrusted test expression:
-    test_expr = parse_expression(test_str, local_dict=local_dict)
 
+class AnswerIndex(object):
+    """An index of the anticipated wrong answers to a question, by numeric fingerprint.
+
+       Finding which of many anticipated answers a test expression matches would
+       need a full check against each one. But matching expressions almost always
+       have the same numeric_fingerprint(...), so the few answers which could match
+       are found by looking up the test's fingerprint, and only those are checked.
+       Answers which have no fingerprint, like equations, are always candidates.
+        - 'wrong_answers' should be a dict of trusted answer strings to feedback tags.
+        - 'local_dict' should be the symbols to parse them with, see parse_symbols(...).
+    """
+    def __init__(self, wrong_answers, local_dict):
+        self.answers = []  # (answer string, parsed expression, feedback tag)
+        self._unindexed = []
+        self._index = {}  # fingerprint: list of answers
+        for answer_str, feedback in wrong_answers.items():
+            try:
+                answer_expr = parse_expression(maths_parser.cleanup_string(answer_str, reject_unsafe_input=True),
+                                               local_dict=local_dict)
+            except UnsafeInputException:
+                _answers_log.warning("Anticipated answer '%s' contained non-whitelisted characters!", answer_str)
+                continue
+            if answer_expr is None:
+                _answers_log.warning("Anticipated answer '%s' cannot be parsed!", answer_str)
+                continue
+            answer = (answer_str, answer_expr, feedback)
+            self.answers.append(answer)
+            fingerprint = numeric_fingerprint(answer_expr)
+            if fingerprint is None:
+                self._unindexed.append(answer)
+            else:
+                self._index.setdefault(fingerprint, []).append(answer)
+
+    def candidates(self, test_expr):
+        """Return the answers which a parsed test expression could match."""
+        fingerprint = numeric_fingerprint(test_expr)
+        if fingerprint is None:
+            return self.answers
+        return self._index.get(fingerprint, []) + self._unindexed
+
+
+def match_wrong_answer(test_str, test_expr, wrong_answers, *, symbols=None, check_symbols=True):
+    """Find which anticipated wrong answer, if any, a parsed test expression matches.
+
+       The index of the answers for each question is built once and remembered
+       in ANSWER_INDEXES. Returns a dict with keys 'matched_answer' and 'feedback'
+       for the first candidate answer confirmed equal by check_parsed(...), or an
+       empty dict if there is none.
+        - 'test_str' and 'test_expr' should be the cleaned up and parsed test.
+        - 'wrong_answers', 'symbols' and 'check_symbols' are as for check(...).
+    """
+    local_dict = parse_symbols(symbols)
+    index_key = (tuple(sorted(local_dict)), tuple((answer_str, str(feedback)) for answer_str, feedback in wrong_answers.items()))
+    index = ANSWER_INDEXES.get(index_key)
+    if index is None:
+        index = ANSWER_INDEXES[index_key] = AnswerIndex(wrong_answers, local_dict)
+
+    candidates = index.candidates(test_expr)
+    _answers_log.debug("Checking %d of %d anticipated answer(s).", len(candidates), len(index.answers))
+    for answer_str, answer_expr, feedback in candidates:
+        response = check_parsed(test_str, test_expr, answer_str, answer_expr, check_symbols=check_symbols, _quiet=True)
+        if response.get("equal") == "true":
+            _answers_log.info("Matched anticipated answer '%s'.", answer_str)
+            return dict(matched_answer=answer_str, feedback=feedback)
+    return dict()
+
+
+def register_target(target_str, *, symbols=None):
+    """Compute and remember the canonical forms of a target which will be checked against often.
+
+       Later checks against the target reuse these, see symbolic_equality(...).
+       For an equation or inequality, each side is registered. Returns a dict like
+       that of check(...), with the key 'registered'; or with the key 'error' if
+       something went wrong.
+        - 'target_str' should be the trusted string to parse and register.
+        - 'symbols' should be the symbols not to split during parsing, exactly as
+          they will be given to check(...).
+    """
+    result, forms = prepare_target(target_str, symbols=symbols)
+    if forms is not None:
+        install_target_forms(forms)
+    return result
+
+
+def install_target_forms(forms):
+    """Remember canonical forms computed by prepare_target(...), which is quick."""
+    for side, side_forms in forms.items():
+        REGISTERED_TARGETS[side] = side_forms
+
+
+def _compared_sides(target_expr):
+    """Return the expressions general_equality(...) compares for a target: the sides of a relation, or the target itself."""
+    if target_expr.is_Equality:
+        return [target_expr.lhs, target_expr.rhs]
+    elif target_expr.is_Relational:
+        return [target_expr.lts, target_expr.gts]
+    return [target_expr]
+
+
+def prepare_target(target_str, *, symbols=None):
+    """Compute the canonical forms of a target for register_target(...), without remembering them.
+
+       This is the slow part of registering, so that it can be done once and its
+       results given to install_target_forms(...) in other processes. Returns the
+       dict register_target(...) would, and a dict of the TargetForms of each side
+       of the target, or None if something went wrong.
+        - the arguments are as for register_target(...).
+    """
+    if target_str == "":
+        _log.error("No target provided to register!")
+        return dict(error="Empty string as argument."), None
+    try:
+        target_str = maths_parser.cleanup_string(target_str, reject_unsafe_input=True)
+    except UnsafeInputException:
+        _log.error("Target to register contained non-whitelisted characters!")
+        return dict(error="Bad input provided!"), None
+    _log.info("Registering target: '%s'", target_str)
+
+    local_dict = parse_symbols(symbols)
+    # A plus-or-minus target is checked as two separate cases:
+    case_strs = [target_str.replace('±', '+'), target_str.replace('±', '-')] if '±' in target_str else [target_str]
+    result = dict(target=target_str)
+    forms = dict()
+    for case_str in case_strs:
+        target_expr = parse_expression(case_str, local_dict=local_dict)
+        if target_expr is None:
+            _log.error("TRUSTED EXPRESSION CANNOT BE PARSED!")
+            result["error"] = "Parsing TARGET Expression Failed!"
+            return result, None
+        result.setdefault("parsed_target", str(target_expr))
+        for side in _compared_sides(target_expr):
+            if isinstance(side, sympy.Expr) and side not in forms:
+                _symbolic_log.debug("Precomputing canonical forms of '%s'.", side)
+                try:
+                    forms[side] = REGISTERED_TARGETS.get(side) or TargetForms(side)
+                except TimeLimitException:
+                    _log.error("Target took longer than %s second(s) to expand!", TARGET_FORMS_TIME_LIMIT)
+                    result["error"] = "Target too complex to register!"
+                    return result, None
+    result["registered"] = str(True).lower()
+    return result, forms
+
+
+def check_parsed(test_str, test_expr, target_str, target_expr, *, check_symbols=True,
+                 _quiet=False):
+    """Check the equivalence of an already parsed test and target expression.
+
+       This does the checking part of check(...), after the strings have been
+       cleaned up and parsed, and returns the same dict.
+        - 'test_str' and 'target_str' should be the cleaned up input strings.
+        - 'test_expr' and 'target_expr' should be the results of parse_expression(...)
+          on those strings, which may be None if parsing failed.
+        - 'check_symbols', '_quiet' are as for check(...).
+    """
     result = dict(target=target_str, test=test_str)
 
     if target_expr is None:
-        print("ERROR: TRUSTED EXPRESSION CANNOT BE PARSED!")
-        if not _quiet:
-            print("=" * 50)
+        _log.error("TRUSTED EXPRESSION CANNOT BE PARSED!")
         result["error"] = "Parsing TARGET Expression Failed!"
         result["code"] = 400  # This is fatal!
         return result
     if test_expr is None:
-        print("Incorrectly formatted ToCheck expression.")
-        if not _quiet:
-            print("=" * 50)
+        _log.info("Incorrectly formatted ToCheck expression.")
         result["error"] = "Parsing Test Expression Failed!"
         result["syntax_error"] = str(True).lower()
         return result
@@ -574,14 +1102,14 @@ def check(test_str, target_str, *, symbols=None, check_symbols=True, description
 
     # Now check for symbol match and equality:
     try:
-        print("Parsed Target: {0}\nParsed ToCheck: {1}".format(target_expr, test_expr))
+        _log.debug("Parsed Target: %s", target_expr)
+        _log.debug("Parsed ToCheck: %s", test_expr)
         if check_symbols:  # Do we have same set of symbols in each?
-            incorrect_symbols = contains_incorrect_symbols(test_expr, target_expr)
+            with StageTimer("maths.symbols"):
+                incorrect_symbols = contains_incorrect_symbols(test_expr, target_expr)
             if incorrect_symbols is not None:
-                print("[[RESULT]]\nEquality: False")
-                if not _quiet:
-                    print("=" * 50)
-
+                _log.info("Equality: False")
+                count_decision("maths", EqualityType.SYMBOLIC, False)
                 result["equal"] = str(False).lower()
                 result["equality_type"] = "symbolic"
                 result["incorrect_symbols"] = incorrect_symbols
@@ -589,23 +1117,210 @@ def check(test_str, target_str, *, symbols=None, check_symbols=True, description
         # Then check for equality proper:
         equal, equality_type = general_equality(test_expr, target_expr)
     except EquationTypeMismatch:
-        print("Equation/Expression Type Mismatch: can't be equal!")
+        _log.debug("Equation/Expression Type Mismatch: can't be equal!")
         equal = False
         equality_type = EqualityType.SYMBOLIC
     except (SyntaxError, TypeError, AttributeError, NumericRangeException) as e:
-        print("Error when comparing expressions: '{}'.".format(e))
-        if not _quiet:
-            print("=" * 50)
+        _log.warning("Error when comparing expressions: '%s'.", e)
         result["error"] = "Comparison of expressions failed: '{}'".format(e)
         return result
 
-    print("[[RESULT]]")
     if equal and (equality_type is not EqualityType.EXACT) and ((target_expr, test_expr) not in KNOWN_PAIRS):
-        print("INFO: Adding known pair ({0}, {1})".format(target_expr, test_expr))
+        _log.debug("Adding known pair (%s, %s)", target_expr, test_expr)
         KNOWN_PAIRS[(target_expr, test_expr)] = equality_type
-    print("Equality: {}".format(equal))
-    if not _quiet:
-        print("=" * 50)
+    elif not equal and ((target_expr, test_expr) not in KNOWN_UNEQUAL_PAIRS):
+        _log.debug("Adding known unequal pair (%s, %s)", target_expr, test_expr)
+        KNOWN_UNEQUAL_PAIRS[(target_expr, test_expr)] = equality_type
+    _log.info("Equality: %s (%s)", equal, equality_type.value)
+    count_decision("maths", equality_type, equal)
     result["equal"] = str(equal).lower()
     result["equality_type"] = equality_type.value
     return result
+
+
+@StageTimer("maths.check")
+def check(test_str, target_str, *, symbols=None, check_symbols=True, description=None,
+          wrong_answers=None, timings=False, _quiet=False):
+    """The main checking function, calls each of the equality checking functions as required.
+
+       Returns a dict describing the equality; with important keys being 'equal',
+       and 'equality_type'. The key 'error' is added if something went wrong, and
+       this should always be checked for first.
+
+        - 'test_str' should be the untrusted string for sympy to parse.
+        - 'target_str' should be the trusted string to parse and match against.
+        - 'symbols' should be a string list or comma separated string of symbols
+           not to split during parsing.
+        - 'check_symbols' indicates whether to verfiy the symbols used in each
+          expression are exactly the same or not; setting this to False will
+          allow symbols which cancel out to be included (probably don't want this
+          in questions).
+        - 'description' is an optional description to log before the checker's
+          other messages, which can be used to improve logging.
+        - 'wrong_answers' is an optional dict of anticipated wrong answer strings
+          to feedback tags. If the test is not equal to the target but matches one
+          of these, the keys 'matched_answer' and 'feedback' are added to the dict.
+        - 'timings' says whether to add the key 'timings' to the dict, giving how
+          long each stage took and which caches were hit, see RequestTimings.
+        - '_quiet' is an internal argument used to suppress some logging when
+          this function is called from plus_minus_checker().
+    """
+    if timings:
+        with RequestTimings() as request_timings:
+            response = check.__wrapped__(test_str, target_str, symbols=symbols, check_symbols=check_symbols,
+                                         description=description, wrong_answers=wrong_answers, _quiet=_quiet)
+            response["timings"] = request_timings.as_dict()
+        return response
+
+    # For logging purposes, if we have a description: log it!
+    if description is not None and not _quiet:
+        _log.info("Description: %s", description)
+
+    # If nothing to parse, fail. On server, this will be caught in check_endpoint()
+    if (target_str == "") or (test_str == ""):
+        _log.info("No input provided!")
+        return dict(error="Empty string as argument.")
+
+    # If exactly this request has been seen before, the response will be the same:
+    wrong_answers_key = tuple((str(k), str(v)) for k, v in wrong_answers.items()) if wrong_answers else None
+    cache_key = response_cache_key(test_str, target_str, symbols, check_symbols, SIMPLIFY_DERIVATIVES, NUMERIC_PRESCREEN,
+                                   CONCURRENT_EQUALITY, wrong_answers_key)
+    cached_response = RESPONSE_CACHE.get(cache_key) if cache_key is not None else None
+    if cache_key is not None:
+        mark_cache("responses", cached_response is not None)
+    if cached_response is not None:
+        _log.info("Known response from identical request! Equality: %s", cached_response.get("equal"))
+        return echo_request(cached_response, test_str, target_str, maths_parser.cleanup_string)
+
+    response = _check_uncached(test_str, target_str, symbols=symbols, check_symbols=check_symbols,
+                               wrong_answers=wrong_answers, _quiet=_quiet)
+    if cache_key is not None:
+        RESPONSE_CACHE[cache_key] = dict(response)
+    return response
+
+
+def _check_uncached(test_str, target_str, *, symbols, check_symbols, wrong_answers, _quiet):
+    """Do the cleanup, parsing and checking for check(...), which caches the result."""
+    # Cleanup the strings before anything is done to them:
+    error_is_test = False
+    try:
+        with StageTimer("maths.cleanup"):
+            target_str = maths_parser.cleanup_string(target_str, reject_unsafe_input=True)
+            error_is_test = True
+            test_str = maths_parser.cleanup_string(test_str, reject_unsafe_input=True)
+    except UnsafeInputException:
+        result = dict(error="Bad input provided!")
+        if error_is_test:
+            _log.info("Test string contained non-whitelisted characters: '%s'", test_str)
+            result["syntax_error"] = str(True).lower()
+        else:
+            _log.error("Target string contained non-whitelisted characters!")
+        return result
+
+    if not _quiet:
+        _log.info("Target string: '%s'", target_str)
+    _log.info("Test string: '%s'", test_str)
+
+    # If the input contains a plus-or-minus sign, we need to do things differently:
+    if (('±' in target_str) or ('±' in test_str)):
+        return plus_minus_checker(test_str, target_str, symbols=symbols, check_symbols=check_symbols)
+
+    local_dict = parse_symbols(symbols)
+
+    # Parse the trusted target expression:
+    target_expr = parse_expression(target_str, local_dict=local_dict)
+    # Parse the untrusted test expression:
+    test_expr = parse_expression(test_str, local_dict=local_dict)
+
+    if not wrong_answers:
+        return check_parsed(test_str, test_expr, target_str, target_expr, check_symbols=check_symbols, _quiet=_quiet)
+
+    # Only look for an anticipated wrong answer if the test is definitely wrong:
+    response = check_parsed(test_str, test_expr, target_str, target_expr, check_symbols=check_symbols, _quiet=True)
+    if response.get("equal") == "false":
+        response.update(match_wrong_answer(test_str, test_expr, wrong_answers, symbols=symbols, check_symbols=check_symbols))
+    return response
+
+
+def _check_batch_test(test_str, target_str, target_expr, *, original_target_str, local_dict, symbols, check_symbols):
+    """Check one test string of a batch against its already cleaned up and parsed target, for check_batch(...)."""
+    if test_str == "":
+        _log.info("No input provided!")
+        return dict(error="Empty string as argument.")
+    cache_key = response_cache_key(test_str, original_target_str, symbols, check_symbols, SIMPLIFY_DERIVATIVES,
+                                   NUMERIC_PRESCREEN, CONCURRENT_EQUALITY, None)
+    cached_response = RESPONSE_CACHE.get(cache_key) if cache_key is not None else None
+    if cached_response is not None:
+        _log.info("Known response from identical request! Equality: %s", cached_response.get("equal"))
+        return echo_request(cached_response, test_str, original_target_str, maths_parser.cleanup_string)
+    try:
+        with StageTimer("maths.cleanup"):
+            test_str = maths_parser.cleanup_string(test_str, reject_unsafe_input=True)
+    except UnsafeInputException:
+        _log.info("Test string contained non-whitelisted characters: '%s'", test_str)
+        return dict(error="Bad input provided!", syntax_error=str(True).lower())
+    _log.info("Test string: '%s'", test_str)
+    if '±' in test_str:
+        return plus_minus_checker(test_str, target_str, symbols=symbols, check_symbols=check_symbols)
+    test_expr = parse_expression(test_str, local_dict=local_dict)
+    response = check_parsed(test_str, test_expr, target_str, target_expr, check_symbols=check_symbols, _quiet=True)
+    if cache_key is not None:
+        RESPONSE_CACHE[cache_key] = dict(response)
+    return response
+
+
+def check_batch(test_strs, target_str, *, symbols=None, check_symbols=True, description=None, time_limit=None):
+    """Check many test strings against a single target string.
+
+       Returns a list containing one dict per test string, each exactly as
+       check(...) would have returned. The trusted target is only cleaned up and
+       parsed once, though each test's symbols are still checked against it; so
+       this is faster than calling check(...) repeatedly when regrading many
+       answers to the same question.
+
+        - 'test_strs' should be a list of untrusted strings for sympy to parse.
+        - 'target_str' should be the trusted string to parse and match against.
+        - 'symbols', 'check_symbols' and 'description' are as for check(...).
+        - 'time_limit' is how many seconds each test may take, or None for no
+          limit. A test which takes longer gets an error instead, as a single
+          request to the server would, and the rest are still checked.
+    """
+    # For logging purposes, if we have a description: log it!
+    if description is not None:
+        _log.info("Description: %s", description)
+    _log.info("Checking a batch of %d test strings.", len(test_strs))
+
+    # If the target is unusable then every result is the same error:
+    original_target_str = target_str
+    if target_str == "":
+        _log.error("No target provided!")
+        return [dict(error="Empty string as argument.") for _ in test_strs]
+    try:
+        with StageTimer("maths.cleanup"):
+            target_str = maths_parser.cleanup_string(target_str, reject_unsafe_input=True)
+    except UnsafeInputException:
+        _log.error("Target string contained non-whitelisted characters!")
+        return [dict(error="Bad input provided!") for _ in test_strs]
+
+    _log.info("Target string: '%s'", target_str)
+
+    # A plus-or-minus target requires each case to be parsed separately:
+    if '±' in target_str:
+        check_test = functools.partial(check, target_str=target_str, symbols=symbols, check_symbols=check_symbols, _quiet=True)
+    else:
+        local_dict = parse_symbols(symbols)
+        check_test = functools.partial(_check_batch_test, target_str=target_str,
+                                       target_expr=parse_expression(target_str, local_dict=local_dict),
+                                       original_target_str=original_target_str, local_dict=local_dict,
+                                       symbols=symbols, check_symbols=check_symbols)
+
+    results = []
+    for test_str in test_strs:
+        try:
+            with TimeLimit(time_limit):
+                results.append(check_test(test_str))
+        except TimeLimitException:
+            _log.error("Test string took longer than %s second(s) to check: '%s'", time_limit, test_str)
+            count_timeout()
+            results.append(dict(target=original_target_str, test=test_str, error="Request took too long to process!"))
+    return results
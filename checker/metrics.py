@@ -0,0 +1,249 @@
+import atexit
+import bisect
+import collections
+import functools
+import glob
+import os
+import shutil
+import tempfile
+import time
+
+import numpy
+
+
+__all__ = ["StageTimer", "RequestTimings", "observe", "mark_cache", "count_decision", "count_timeout",
+           "configure_metrics", "disable_recording", "collect", "prometheus_text"]
+
+
+# Where each process keeps its metrics, so that those of all the server's processes
+# can be added up. If this is not set, the server creates a temporary directory; it
+# should be emptied whenever the server is started.
+METRICS_DIR = os.environ.get("EQUALITY_CHECKER_METRICS_DIR")
+
+# The stages of checking which are timed:
+STAGES = (
+    "maths.check", "maths.cleanup", "maths.parse", "maths.symbols", "maths.known_pairs", "maths.exact",
+    "maths.identity", "maths.prescreen", "maths.symbolic", "maths.concurrent", "maths.numeric",
+    "maths.numeric_compile", "maths.numeric_evaluate", "maths.numeric_complex",
+    "logic.check", "logic.cleanup", "logic.parse", "logic.symbols", "logic.known_pairs", "logic.exact",
+    "logic.symbolic",
+)
+# The upper bounds, in seconds, of the buckets of the histogram of each stage's durations:
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Checks are counted by which checker decided them, the EqualityType that did, and the result:
+CHECKERS = ("maths", "logic")
+EQUALITY_TYPES = ("known", "numeric", "identity", "symbolic", "exact")
+
+# Each process's metrics are one array of numbers: for each stage, the count in each
+# bucket (including an unbounded last bucket), the total duration and the count; then
+# the count of each kind of decision; then the count of timeouts.
+_STAGE_SIZE = len(BUCKETS) + 3
+_STAGE_OFFSETS = {stage: i * _STAGE_SIZE for i, stage in enumerate(STAGES)}
+_DECISIONS_OFFSET = len(STAGES) * _STAGE_SIZE
+_DECISION_OFFSETS = {(checker, equality_type, equal): _DECISIONS_OFFSET + i
+                     for i, (checker, equality_type, equal) in enumerate(
+                         (c, t, e) for c in CHECKERS for t in EQUALITY_TYPES for e in (True, False))}
+_TIMEOUTS_OFFSET = _DECISIONS_OFFSET + len(_DECISION_OFFSETS)
+_SIZE = _TIMEOUTS_OFFSET + 1
+
+_directory = METRICS_DIR
+_values = None
+_values_pid = None
+_recording = True
+# The timings of the request being checked, if they were asked for, and how many
+# times each stage is running, so that a stage within itself is not counted twice:
+_request_timings = None
+_running_stages = collections.Counter()
+
+
+def _process_values():
+    """Return the array holding this process's metrics, creating it if necessary.
+
+       A forked process must not add to its parent's array, so gets its own. If
+       there is a directory for metrics, the array is a memory mapped file there,
+       named for the process; and since the files are added up, a process reusing
+       the pid of one which has died just carries on adding to its file.
+    """
+    global _values, _values_pid
+    pid = os.getpid()
+    if _values_pid != pid:
+        if _directory is None:
+            _values = numpy.zeros(_SIZE)
+        else:
+            path = os.path.join(_directory, "{}.metrics".format(pid))
+            reuse = os.path.exists(path) and os.path.getsize(path) == _SIZE * numpy.dtype(numpy.float64).itemsize
+            _values = numpy.memmap(path, dtype=numpy.float64, mode="r+" if reuse else "w+", shape=(_SIZE,))
+        _values_pid = pid
+    return _values
+
+
+def observe(stage, duration):
+    """Record that a stage of checking took 'duration' seconds."""
+    if not _recording:
+        return
+    values = _process_values()
+    offset = _STAGE_OFFSETS[stage]
+    values[offset + bisect.bisect_left(BUCKETS, duration)] += 1
+    values[offset + len(BUCKETS) + 1] += duration
+    values[offset + len(BUCKETS) + 2] += 1
+
+
+def mark_cache(cache, hit):
+    """Note whether the request being checked found what it wanted in a cache, for its timings."""
+    if _request_timings is not None:
+        _request_timings.caches.setdefault(cache, set()).add(bool(hit))
+
+
+def count_decision(checker, equality_type, equal):
+    """Count a check by the checker, like "maths", the EqualityType that decided it and the result."""
+    if _recording:
+        _process_values()[_DECISION_OFFSETS[(checker, equality_type.value, bool(equal))]] += 1
+
+
+def count_timeout():
+    """Count a check which took too long and was abandoned."""
+    if _recording:
+        _process_values()[_TIMEOUTS_OFFSET] += 1
+
+
+class StageTimer(object):
+    """Time a stage of checking, as a 'with' block or as a decorator of a function.
+
+       The duration is recorded by observe(...), even if an exception is raised.
+        - 'stage' should be one of STAGES.
+    """
+    def __init__(self, stage):
+        self.stage = stage
+        self._start = None
+
+    def __enter__(self):
+        _running_stages[self.stage] += 1
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, _type, value, traceback):
+        duration = time.perf_counter() - self._start
+        _running_stages[self.stage] -= 1
+        observe(self.stage, duration)
+        if _request_timings is not None and _running_stages[self.stage] == 0:
+            _request_timings.add(self.stage, duration)
+
+    def __call__(self, function):
+        @functools.wraps(function)
+        def timed_function(*args, **kwargs):
+            # A new timer each call, so that recursive calls are timed correctly:
+            with StageTimer(self.stage):
+                return function(*args, **kwargs)
+        return timed_function
+
+
+class RequestTimings(object):
+    """Collect how long each stage of checking one request took, and which caches it hit.
+
+       Inside a 'with' block, every stage timed by StageTimer is added up, and
+       every cache noted by mark_cache(...) is remembered; only one request at
+       a time can be timed.
+    """
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        self.caches = collections.OrderedDict()
+        self._start = None
+        self._previous = None
+
+    def __enter__(self):
+        global _request_timings
+        self._previous, _request_timings = _request_timings, self
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, _type, value, traceback):
+        global _request_timings
+        _request_timings = self._previous
+
+    def add(self, stage, duration):
+        """Add to the time taken by a stage, like "maths.parse"."""
+        self.stages[stage] = self.stages.get(stage, 0) + duration
+
+    def as_dict(self):
+        """Return the timings so far for a response, with durations in whole microseconds.
+
+           Stages are named without the checker, like "parse"; "total" is the time
+           since the 'with' block started. Each cache is "hit", "miss", or "partial"
+           if it was used more than once and only sometimes hit.
+        """
+        stages = collections.OrderedDict((stage.split(".", 1)[-1], int(round(duration * 1E6)))
+                                         for stage, duration in self.stages.items())
+        stages["total"] = int(round((time.perf_counter() - self._start) * 1E6))
+        caches = collections.OrderedDict((cache, "partial" if len(hits) > 1 else "hit" if True in hits else "miss")
+                                         for cache, hits in self.caches.items())
+        return dict(stages=stages, caches=caches)
+
+
+def disable_recording():
+    """Stop recording metrics in this process, such as a short lived subprocess timed by its parent."""
+    global _recording
+    _recording = False
+
+
+def configure_metrics(directory=None):
+    """Keep metrics in files in a directory, so that those of every process can be added up.
+
+       This must be called before forking the processes to be added up. If no
+       directory is given, METRICS_DIR is used; and if that is not set, a new
+       temporary directory is created, and removed when this process exits.
+    """
+    global _directory, _values_pid
+    directory = METRICS_DIR if directory is None else directory
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix="equality-checker-metrics-")
+        creator_pid = os.getpid()
+        # Forked processes inherit exit handlers, but must leave the directory alone:
+        atexit.register(lambda: os.getpid() == creator_pid and shutil.rmtree(directory, ignore_errors=True))
+    os.makedirs(directory, exist_ok=True)
+    _directory = directory
+    _values_pid = None
+
+
+def collect():
+    """Return the sum of the metrics of every process, as an array like that of each process."""
+    if _directory is None:
+        return numpy.array(_process_values())
+    total = numpy.zeros(_SIZE)
+    for path in glob.glob(os.path.join(_directory, "*.metrics")):
+        try:
+            values = numpy.fromfile(path, dtype=numpy.float64)
+        except OSError:
+            continue
+        # Ignore files with a different layout, left by another version:
+        if values.shape == total.shape:
+            total += values
+    return total
+
+
+def _format_number(value):
+    return repr(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def prometheus_text(values=None):
+    """Return the metrics of every process in the Prometheus text exposition format."""
+    values = collect() if values is None else values
+    lines = ["# HELP checker_stage_duration_seconds How long each stage of checking took.",
+             "# TYPE checker_stage_duration_seconds histogram"]
+    for stage, offset in _STAGE_OFFSETS.items():
+        cumulative = numpy.cumsum(values[offset:offset + len(BUCKETS) + 1])
+        for bound, count in zip([repr(float(b)) for b in BUCKETS] + ["+Inf"], cumulative):
+            lines.append('checker_stage_duration_seconds_bucket{{stage="{}",le="{}"}} {}'.format(
+                stage, bound, _format_number(count)))
+        lines.append('checker_stage_duration_seconds_sum{{stage="{}"}} {}'.format(
+            stage, _format_number(values[offset + len(BUCKETS) + 1])))
+        lines.append('checker_stage_duration_seconds_count{{stage="{}"}} {}'.format(
+            stage, _format_number(values[offset + len(BUCKETS) + 2])))
+    lines += ["# HELP checker_decisions_total Checks completed, by the type of equality which decided them.",
+              "# TYPE checker_decisions_total counter"]
+    for (checker, equality_type, equal), offset in _DECISION_OFFSETS.items():
+        lines.append('checker_decisions_total{{checker="{}",equality_type="{}",equal="{}"}} {}'.format(
+            checker, equality_type, str(equal).lower(), _format_number(values[offset])))
+    lines += ["# HELP checker_timeouts_total Checks abandoned for taking too long.",
+              "# TYPE checker_timeouts_total counter",
+              "checker_timeouts_total {}".format(_format_number(values[_TIMEOUTS_OFFSET]))]
+    return "\n".join(lines) + "\n"
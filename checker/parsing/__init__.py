@@ -1,5 +1,5 @@
 
-__all__ = ["UnsafeInputException", "ParsingException"]
+__all__ = ["UnsafeInputException", "ParsingException", "ExpressionTooComplexException"]
 
 
 class ParsingException(ValueError):
@@ -9,4 +9,9 @@ class ParsingException(ValueError):
 
 class UnsafeInputException(ValueError):
     """An exception to be raised when unexpected input is provided."""
-    pass
\ No newline at end of file
+    pass
+
+
+class ExpressionTooComplexException(ParsingException):
+    """An exception to be raised when an expression is too large or complex to parse safely."""
+    pass
@@ -1,13 +1,16 @@
-import re
+import functools
 import tokenize
 import sympy
 from sympy.parsing import sympy_parser
 
-from . import ParsingException, UnsafeInputException
-from .utils import process_unicode_chars, auto_symbol, fix_booleans, evaluateFalse
+from ..logs import get_logger
+from . import ParsingException, ExpressionTooComplexException
+from .utils import normalise_unicode, StringCleaner, auto_symbol, fix_booleans, evaluateFalse
 
 __all__ = ["cleanup_string", "parse_expr"]
 
+_log = get_logger("logic.parse")
+
 
 # We need to be able to sanitise user input. Whitelist allowed characters:
 ALLOWED_CHARACTER_LIST = ["\x20",            # space
@@ -25,8 +28,8 @@ ALLOWED_CHARACTER_LIST = ["\x20",            # space
 
 # Join these into a regular expression that matches everything except allowed characters:
 UNSAFE_CHARACTERS_REGEX = r"[^" + "".join(ALLOWED_CHARACTER_LIST) + r"]+"
-# Match all non-ASCII characters:
-NON_ASCII_CHAR_REGEX = r"[^\x00-\x7F]+"
+# A compiled version of all of the cleanup of allowed characters:
+_STRING_CLEANER = StringCleaner(ALLOWED_CHARACTER_LIST)
 
 
 #####
@@ -43,20 +46,10 @@ def cleanup_string(string, *, reject_unsafe_input):
     if not isinstance(string, str):
         string = str(string.decode('utf-8'))  # We'll hope it's UTF-8
     # Swap any known safe Unicode characters with their ASCII equivalents:
-    string = re.sub(NON_ASCII_CHAR_REGEX, process_unicode_chars, string)
-    # Replace all non-whitelisted characters in the input:
-    string = re.sub(UNSAFE_CHARACTERS_REGEX, '?', string)
-    if reject_unsafe_input:
-        # If we have non-whitelisted characters, raise an exception:
-        if "?" in string:
-            # We replaced all non-whitelisted characters with '?' (and '?' is not whitelisted)
-            # so if any '?' characters exist the string must have contained bad input.
-            raise UnsafeInputException("Unexpected input characters provided!")
-    else:
-        # otherwise just swap the blacklisted characters for spaces and proceed.
-        string = string.replace("?", " ")
-    # Further cleanup, because some allowed characters are only allowed in certain circumstances:
-    string = re.sub(r'(?<![=<>])=(?![=<>])', '==', string)  # Replace all single equals signs with double equals
+    string = normalise_unicode(string)
+    # In one pass: reject or replace all non-whitelisted characters, and replace
+    # single equals signs with double:
+    string = _STRING_CLEANER.clean(string, reject_unsafe_input=reject_unsafe_input)
     return string
 
 
@@ -81,6 +74,10 @@ _GLOBAL_DICT = {
     "true": sympy.true, "false": sympy.false
 }
 
+# How many parsed expressions should be remembered? Targets are parsed over and
+# over again, and since sympy expressions are immutable they can be reused.
+PARSE_CACHE_SIZE = 1024
+
 _PARSE_HINTS = {}
 
 
@@ -106,11 +103,29 @@ def parse_expr(expression_str, *, local_dict=None, hints=None):
     if local_dict is None or not isinstance(local_dict, dict):
         local_dict = {}
 
-    # If there are parse hints, add them to the local dictionary:
+    # Ensure the hints are valid:
     if hints is not None and isinstance(hints, (list, tuple)):
-        for hint in hints:
-            if hint in _PARSE_HINTS:
-                local_dict.update(_PARSE_HINTS[hint])
+        hints = tuple(hints)
+    else:
+        hints = ()
+
+    return _parse_expr_cached(expression_str, frozenset(local_dict.items()), hints)
+
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_expr_cached(expression_str, local_items, hints):
+    """Parse an expression for parse_expr(...), remembering the result.
+
+       The arguments must all be hashable: 'local_items' should be a frozenset of
+       the local dictionary's items and 'hints' should be a tuple. Failed parses
+       raise an exception, and so are not remembered.
+    """
+    local_dict = dict(local_items)
+
+    # If there are parse hints, add them to the local dictionary:
+    for hint in hints:
+        if hint in _PARSE_HINTS:
+            local_dict.update(_PARSE_HINTS[hint])
 
     try:
         code = sympy_parser.stringify_expr(expression_str, local_dict, _GLOBAL_DICT, _TRANSFORMS)
@@ -118,5 +133,8 @@ def parse_expr(expression_str, *, local_dict=None, hints=None):
         code_compiled = compile(ef_code, '<string>', 'eval')
         return sympy_parser.eval_expr(code_compiled, local_dict, _GLOBAL_DICT)
     except (tokenize.TokenError, SyntaxError, TypeError, AttributeError, sympy.SympifyError) as e:
-        print(("ERROR: {0} - {1}".format(type(e).__name__, str(e))).strip(":- "))
+        _log.info("%s: %s", type(e).__name__, e)
         raise ParsingException
+    except ExpressionTooComplexException as e:
+        _log.info("%s", e)
+        raise
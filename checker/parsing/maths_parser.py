@@ -1,3 +1,4 @@
+import functools
 import re
 import tokenize
 import sympy
@@ -5,11 +6,15 @@ import sympy.abc
 from sympy.parsing import sympy_parser
 from sympy.core.numbers import Integer, Float, Rational
 
-from . import ParsingException, UnsafeInputException
-from .utils import process_unicode_chars, auto_symbol, evaluateFalse
+from ..logs import get_logger
+from . import ParsingException, ExpressionTooComplexException
+from .utils import normalise_unicode, StringCleaner, auto_symbol, evaluateFalse
+from .native_parser import parse_native
 
 __all__ = ["cleanup_string", "is_valid_symbol", "parse_expr"]
 
+_log = get_logger("maths.parse")
+
 
 # We need to be able to sanitise user input. Whitelist allowed characters:
 ALLOWED_CHARACTER_LIST = ["\x20",            # space
@@ -24,8 +29,8 @@ ALLOWED_CHARACTER_LIST = ["\x20",            # space
 
 # Join these into a regular expression that matches everything except allowed characters:
 UNSAFE_CHARACTERS_REGEX = r"[^" + "".join(ALLOWED_CHARACTER_LIST) + r"]+"
-# Match all non-ASCII characters:
-NON_ASCII_CHAR_REGEX = r"[^\x00-\x7F]+"
+# A compiled version of all of the cleanup of allowed characters:
+_STRING_CLEANER = StringCleaner(ALLOWED_CHARACTER_LIST, fix_dots_and_keywords=True)
 # Symbols may only contain 0-9, A-Z, a-z and underscores:
 NON_SYMBOL_REGEX = r"[^\x30-\x39\x41-\x5A\x61-\x7A\x5F]+"
 
@@ -44,25 +49,12 @@ def cleanup_string(string, *, reject_unsafe_input):
     if not isinstance(string, str):
         string = str(string.decode('utf-8'))  # We'll hope it's UTF-8
     # Swap any known safe Unicode characters with their ASCII equivalents:
-    string = re.sub(NON_ASCII_CHAR_REGEX, process_unicode_chars, string)
-    # Replace all non-whitelisted characters in the input:
-    string = re.sub(UNSAFE_CHARACTERS_REGEX, '?', string)
-    if reject_unsafe_input:
-        # If we have non-whitelisted characters, raise an exception:
-        if "?" in string:
-            # We replaced all non-whitelisted characters with '?' (and '?' is not whitelisted)
-            # so if any '?' characters exist the string must have contained bad input.
-            raise UnsafeInputException("Unexpected input characters provided!")
-    else:
-        # otherwise just swap the blacklisted characters for spaces and proceed.
-        string = string.replace("?", " ")
-    # Further cleanup, because some allowed characters are only allowed in certain circumstances:
-    string = re.sub(r'([^0-9])\.([^0-9])', r'\g<1> \g<2>', string)  # Don't allow the . character between non-numbers
-    string = re.sub(r'(.?)\.([^0-9])', r'\g<1> \g<2>', string)  # Don't allow the . character before a non-numeric character,
-    #                                                            but have to allow it after for cases like (.5) which are valid.
-    string = string.replace("lambda", "lamda").replace("Lambda", "Lamda")  # We can't override the built-in keyword
-    string = string.replace("__", " ")  # We don't need double underscores, exploits do
-    string = re.sub(r'(?<![=<>])=(?![=<>])', '==', string)  # Replace all single equals signs with double equals
+    string = normalise_unicode(string)
+    # In one pass: reject or replace all non-whitelisted characters, don't allow
+    # the . character except before or between numbers, replace 'lambda' as we
+    # can't override the built-in keyword, remove double underscores, which we
+    # don't need but exploits do, and replace single equals signs with double:
+    string = _STRING_CLEANER.clean(string, reject_unsafe_input=reject_unsafe_input)
     return string
 
 
@@ -174,6 +166,14 @@ _GLOBAL_DICT = {
     "true": True, "false": False
 }
 
+# How many parsed expressions should be remembered? Targets are parsed over and
+# over again, and since sympy expressions are immutable they can be reused.
+PARSE_CACHE_SIZE = 1024
+
+# Should expressions be parsed directly by parse_native(...), rather than by
+# generating Python code, compiling it and evaluating it?
+USE_NATIVE_PARSER = False
+
 _PARSE_HINTS = {
     "constant_pi": {"pi": sympy.pi},
     "constant_e": {"e": sympy.E},
@@ -183,7 +183,7 @@ _PARSE_HINTS = {
 }
 
 
-def parse_expr(expression_str, *, local_dict=None, hints=None):
+def parse_expr(expression_str, *, local_dict=None, hints=None, native=None):
     """A copy of sympy.sympy_parser.parse_expr(...) which prevents all evaluation.
 
        Arbitrary untrusted input should be cleaned using "cleanup_string" before
@@ -195,6 +195,9 @@ def parse_expr(expression_str, *, local_dict=None, hints=None):
        'evaluate' arguments of the original function.
        Hints can be provided to choose between ambiguous parsings, like 'i' being
        either a letter or sqrt(-1). These should be values from _PARSE_HINTS.
+       If 'native' is True, the expression is parsed by parse_native(...) which
+       gives the same result without using 'eval'; if None, USE_NATIVE_PARSER
+       decides.
     """
     if not isinstance(expression_str, str):
         return None
@@ -205,11 +208,32 @@ def parse_expr(expression_str, *, local_dict=None, hints=None):
     if local_dict is None or not isinstance(local_dict, dict):
         local_dict = {}
 
-    # If there are parse hints, add them to the local dictionary:
+    # Ensure the hints are valid:
     if hints is not None and isinstance(hints, (list, tuple)):
-        for hint in hints:
-            if hint in _PARSE_HINTS:
-                local_dict.update(_PARSE_HINTS[hint])
+        hints = tuple(hints)
+    else:
+        hints = ()
+
+    if native is None:
+        native = USE_NATIVE_PARSER
+
+    return _parse_expr_cached(expression_str, frozenset(local_dict.items()), hints, bool(native))
+
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_expr_cached(expression_str, local_items, hints, native):
+    """Parse an expression for parse_expr(...), remembering the result.
+
+       The arguments must all be hashable: 'local_items' should be a frozenset of
+       the local dictionary's items and 'hints' should be a tuple. Failed parses
+       raise an exception, and so are not remembered.
+    """
+    local_dict = dict(local_items)
+
+    # If there are parse hints, add them to the local dictionary:
+    for hint in hints:
+        if hint in _PARSE_HINTS:
+            local_dict.update(_PARSE_HINTS[hint])
 
     # FIXME: Avoid parsing issues with notation for Python longs.
     # E.g. the string '2L' should not be interpreted as "two stored as a long".
@@ -217,10 +241,15 @@ def parse_expr(expression_str, *, local_dict=None, hints=None):
     expression_str = re.sub(r'([0-9])([lL])', r'\g<1> \g<2>', expression_str)
 
     try:
+        if native:
+            return parse_native(expression_str, local_dict, _GLOBAL_DICT)
         code = sympy_parser.stringify_expr(expression_str, local_dict, _GLOBAL_DICT, _TRANSFORMS)
         ef_code = evaluateFalse(code)
         code_compiled = compile(ef_code, '<string>', 'eval')
         return sympy_parser.eval_expr(code_compiled, local_dict, _GLOBAL_DICT)
     except (tokenize.TokenError, SyntaxError, TypeError, AttributeError, sympy.SympifyError) as e:
-        print(("ERROR: {0} - {1}".format(type(e).__name__, str(e))).strip(":- "))
+        _log.info("%s: %s", type(e).__name__, e)
         raise ParsingException
+    except ExpressionTooComplexException as e:
+        _log.info("%s", e)
+        raise
@@ -0,0 +1,564 @@
+import operator
+import re
+import token
+import tokenize
+
+import sympy
+from sympy.core.basic import Basic
+from sympy.parsing import sympy_parser
+
+from . import ExpressionTooComplexException
+from .utils import ComplexityGuard
+
+__all__ = ["parse_native"]
+
+
+# The same regular expressions the Python tokenizer uses, so that numbers and
+# names are split up in exactly the same places:
+_NUMBER_REGEX = re.compile(tokenize.Number)
+_NAME_REGEX = re.compile(tokenize.Name)
+_WHITESPACE_REGEX = re.compile(tokenize.Whitespace)
+# Longer operators must be tried first, so that '**' is not read as '*', '*':
+_OPERATOR_REGEX = re.compile("|".join(map(re.escape, sorted(token.EXACT_TOKEN_TYPES, reverse=True))))
+
+# Kinds of token:
+_VALUE = 0     # A number or a symbol, already converted to a sympy object.
+_NAME = 1      # A name from the local or global dictionary which is not callable.
+_FUNCTION = 2  # A name from the local or global dictionary which is callable.
+_OP = 3        # An operator or bracket.
+_END = 4       # The end of the input.
+
+_OPEN = (_OP, "(")
+_CLOSE = (_OP, ")")
+_TIMES = (_OP, "*")
+_POWER = (_OP, "**")
+_COMMA = (_OP, ",")
+_END_TOKEN = (_END, None)
+_BRACKETS = {"(", ")", ","}
+
+# Kinds of syntax tree node:
+_VALUE_NODE = 0
+_NAME_NODE = 1
+_CALL_NODE = 2
+_BINARY_NODE = 3
+_UNARY_NODE = 4
+_COMPARE_NODE = 5
+_TUPLE_NODE = 6
+
+_COMPARISONS = {"==", "!=", "<", "<=", ">", ">="}
+_RELATIONS = {"<", "<=", ">", ">="}
+_SYMPY_CLASSES = {"+": "Add", "-": "Add", "*": "Mul", "/": "Mul", "**": "Pow"}
+# Operators which the parse_expr(...) transformations leave to Python:
+_PYTHON_OPERATORS = {
+    "+": operator.add, "-": operator.sub, "*": operator.mul, "/": operator.truediv,
+    "**": operator.pow, "//": operator.floordiv, "%": operator.mod,
+    "==": operator.eq, "!=": operator.ne, "<": operator.lt, "<=": operator.le,
+    ">": operator.gt, ">=": operator.ge
+}
+# Functions which cannot accept the 'evaluate=False' argument:
+_NO_EVALUATE_FUNCTIONS = {"Integer", "Float", "Symbol", "factorial"}
+
+_MINUS_ONE = sympy.Integer(-1)
+
+
+def parse_native(expression_str, local_dict, global_dict):
+    """Parse a string straight into an unevaluated sympy expression.
+
+       This gives the same result as tokenising the string, applying the
+       transformations used by maths_parser.parse_expr(...), transforming the
+       syntax tree with evaluateFalse(...) and then evaluating it; but it does
+       it directly, without generating, compiling or evaluating any Python code.
+       Only names in the dictionaries, numbers and the operators of arithmetic
+       and comparison are understood, anything else raises a SyntaxError.
+       Symbols which would be split into digits also raise a SyntaxError,
+       where the original approach fails to find a 'Number' function.
+       Expressions which are too complex raise an ExpressionTooComplexException
+       before they are converted, see ComplexityGuard.
+        - 'local_dict' is a dictionary of names to sympy objects which takes
+          precedence over 'global_dict', the whitelist of allowed names.
+    """
+    tokens = _tokenize(expression_str, local_dict, global_dict)
+    if any(tok[0] == _FUNCTION and next_tok == _POWER for tok, next_tok in zip(tokens, tokens[1:])):
+        tokens = _function_exponentiation(tokens)
+    tokens = _merge_operators(tokens)
+    try:
+        tree = _Parser(tokens).parse()
+        _check_complexity(tree, ComplexityGuard())
+        return _Converter(local_dict, global_dict).convert(tree)
+    except RecursionError:
+        raise ExpressionTooComplexException("Expression is too deeply nested!")
+
+
+#####
+# Tokenising:
+#####
+
+def _tokenize(string, local_dict, global_dict):
+    """Split a string into tokens, converting numbers and symbols into sympy objects.
+
+       This combines the effect of the auto_number, auto_symbol, convert_xor,
+       split_symbols and implicit_multiplication transformations; a '*' is
+       added wherever implicit multiplication would add one.
+    """
+    tokens = []
+    position = 0
+    length = len(string)
+    depth = 0
+    while True:
+        position = _WHITESPACE_REGEX.match(string, position).end()
+        if position >= length:
+            break
+        match = _NUMBER_REGEX.match(string, position)
+        if match is not None:
+            _add_number(match.group(), tokens, local_dict, global_dict)
+        else:
+            match = _NAME_REGEX.match(string, position)
+            if match is not None:
+                _add_name(match.group(), tokens, local_dict, global_dict)
+            else:
+                match = _OPERATOR_REGEX.match(string, position)
+                if match is None:
+                    raise SyntaxError("Unexpected character '{}'".format(string[position]))
+                operator_str = match.group()
+                if operator_str == "(":
+                    depth += 1
+                elif operator_str == ")":
+                    depth -= 1
+                    if depth < 0:
+                        raise SyntaxError("Unmatched ')'")
+                _add_token((_OP, "**" if operator_str == "^" else operator_str), tokens)
+        position = match.end()
+    if depth > 0:
+        raise SyntaxError("Mismatched parentheses")
+    tokens.append(_END_TOKEN)
+    return tokens
+
+
+def _add_token(tok, tokens):
+    """Add a token, preceded by a '*' if it is implicitly multiplied by the last token."""
+    if tokens:
+        last_tok = tokens[-1]
+        if (last_tok[0] in (_VALUE, _NAME) or last_tok == _CLOSE) and (tok[0] in (_VALUE, _NAME, _FUNCTION) or tok == _OPEN):
+            tokens.append(_TIMES)
+    tokens.append(tok)
+
+
+def _add_number(number, tokens, local_dict, global_dict):
+    """Add the tokens for a number, like the auto_number transformation."""
+    imaginary = number.endswith(("j", "J"))
+    if imaginary:
+        number = number[:-1]
+    if "." in number or (("e" in number or "E" in number) and not number.startswith(("0x", "0X"))):
+        _add_token((_VALUE, sympy.Float(number)), tokens)
+    else:
+        try:
+            value = int(number, 0)
+        except ValueError:
+            raise SyntaxError("Integer '{}...' is too long".format(number[:20]))
+        ComplexityGuard.check_integer(value)
+        _add_token((_VALUE, sympy.Integer(value)), tokens)
+    if imaginary:
+        tokens.append(_TIMES)
+        _add_name("I", tokens, local_dict, global_dict)
+
+
+def _add_name(name, tokens, local_dict, global_dict):
+    """Add the tokens for a name, like the auto_symbol and split_symbols transformations."""
+    if name in local_dict or (name in global_dict and _is_function_like(global_dict[name])):
+        _add_token(_name_token(name, local_dict, global_dict), tokens)
+    elif sympy_parser._token_splittable(name):
+        for char in name:
+            if char in local_dict or char in global_dict:
+                _add_token(_name_token(char, local_dict, global_dict), tokens)
+            elif char.isdigit():
+                raise SyntaxError("Cannot split '{}' into symbols and numbers".format(name))
+            else:
+                _add_token((_VALUE, sympy.Symbol(char)), tokens)
+    else:
+        _add_token((_VALUE, sympy.Symbol(name)), tokens)
+
+
+def _is_function_like(obj):
+    """Whether a global object should be left alone by auto_symbol, rather than made a Symbol."""
+    return isinstance(obj, (Basic, type)) or callable(obj)
+
+
+def _name_token(name, local_dict, global_dict):
+    """Return the token for a name in the dictionaries, noting whether it can be called."""
+    if sympy_parser._token_callable((tokenize.NAME, name), local_dict, global_dict):
+        return (_FUNCTION, name)
+    return (_NAME, name)
+
+
+def _exponent_ended(tok, next_tok, exponent):
+    """Return whether the exponent of a function, consumed up to 'tok', ends there.
+
+       A '*' added by implicit multiplication, like in ')*(', is removed from
+       the end of 'exponent'.
+    """
+    # Only want to stop after hitting ')':
+    if tok == _CLOSE and next_tok == _OPEN:
+        return True
+    # If implicit multiplication was used, we may have ')*(' instead:
+    if tok == _TIMES and next_tok == _OPEN:
+        del exponent[-1]
+        return True
+    return False
+
+
+def _function_exponentiation(tokens):
+    """Move exponents of functions after their arguments, e.g. 'sin**2(x)' to 'sin(x)**2'.
+
+       This is a direct copy of the function_exponentiation transformation,
+       which must run after implicit multiplication has added its '*'s.
+    """
+    result = []
+    exponent = []
+    consuming_exponent = False
+    level = 0
+    for tok, next_tok in zip(tokens, tokens[1:]):
+        if tok[0] in (_NAME, _FUNCTION) and next_tok == _POWER:
+            if tok[0] == _FUNCTION:
+                consuming_exponent = True
+        elif consuming_exponent:
+            exponent.append(tok)
+            consuming_exponent = not _exponent_ended(tok, next_tok, exponent)
+            continue
+        elif exponent and not consuming_exponent:
+            if tok == _OPEN:
+                level += 1
+            elif tok == _CLOSE:
+                level -= 1
+            if level == 0:
+                result.append(tok)
+                result.extend(exponent)
+                exponent = []
+                continue
+        result.append(tok)
+    # An unfinished exponent ends up after the end of the input, where it is ignored:
+    result.extend(exponent)
+    result.append(_END_TOKEN)
+    return result
+
+
+def _merge_operators(tokens):
+    """Join up adjacent operators, like 'x * * y', into single operators.
+
+       The original approach turns tokens back into a string before parsing
+       them, so that adjacent operators are read again as one, e.g. '**'.
+    """
+    if not any(tok[0] == _OP and next_tok[0] == _OP and tok[1] not in _BRACKETS and next_tok[1] not in _BRACKETS
+               for tok, next_tok in zip(tokens, tokens[1:])):
+        return tokens
+    result = []
+    run = ""
+    for tok in tokens:
+        if tok[0] == _OP and tok[1] not in _BRACKETS:
+            run += tok[1]
+            continue
+        if run:
+            result.extend((_OP, operator_str) for operator_str in _OPERATOR_REGEX.findall(run))
+            run = ""
+        result.append(tok)
+    return result
+
+
+#####
+# Parsing:
+#####
+
+class _Parser(object):
+    """A recursive descent parser for the subset of Python expressions allowed.
+
+       This produces a simple syntax tree of tuples, following Python's rules of
+       precedence and associativity so that the tree has the same shape as the
+       one Python would produce from the original transformed code.
+    """
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position]
+
+    def next(self):
+        tok = self.tokens[self.position]
+        self.position += 1
+        return tok
+
+    def expect(self, expected_tok):
+        tok = self.next()
+        if tok != expected_tok:
+            raise SyntaxError("Expected '{}' but found {}".format(expected_tok[1], self.describe(tok)))
+
+    @staticmethod
+    def describe(tok):
+        if tok[0] == _END:
+            return "the end of the expression"
+        return "'{}'".format(tok[1])
+
+    def parse(self):
+        """Parse all of the tokens into a syntax tree."""
+        if self.peek()[0] == _END:
+            raise SyntaxError("Empty expression")
+        tree = self.parse_expression_list(_END_TOKEN)
+        if self.peek()[0] != _END:
+            raise SyntaxError("Unexpected {}".format(self.describe(self.peek())))
+        return tree
+
+    def parse_expression_list(self, closing_tok):
+        """Parse comma separated expressions, returning a tuple node if there is a comma."""
+        items = [self.parse_comparison()]
+        if self.peek() != _COMMA:
+            return items[0]
+        while self.peek() == _COMMA:
+            self.next()
+            if self.peek() == closing_tok:
+                break
+            items.append(self.parse_comparison())
+        return (_TUPLE_NODE, items)
+
+    def parse_comparison(self):
+        left = self.parse_arithmetic()
+        tok = self.peek()
+        if tok[0] != _OP or tok[1] not in _COMPARISONS:
+            return left
+        self.next()
+        right = self.parse_arithmetic()
+        next_tok = self.peek()
+        if next_tok[0] == _OP and next_tok[1] in _COMPARISONS:
+            raise TypeError("Cannot parse nested inequalities!")
+        return (_COMPARE_NODE, tok[1], left, right)
+
+    def parse_arithmetic(self):
+        left = self.parse_term()
+        while self.peek() in ((_OP, "+"), (_OP, "-")):
+            operator_str = self.next()[1]
+            left = (_BINARY_NODE, operator_str, left, self.parse_term())
+        return left
+
+    def parse_term(self):
+        left = self.parse_factor()
+        while self.peek() in ((_OP, "*"), (_OP, "/"), (_OP, "//"), (_OP, "%")):
+            operator_str = self.next()[1]
+            left = (_BINARY_NODE, operator_str, left, self.parse_factor())
+        return left
+
+    def parse_factor(self):
+        if self.peek() in ((_OP, "+"), (_OP, "-")):
+            operator_str = self.next()[1]
+            return (_UNARY_NODE, operator_str, self.parse_factor())
+        return self.parse_power()
+
+    def parse_power(self):
+        base = self.parse_atom()
+        if self.peek() == _POWER:
+            self.next()
+            return (_BINARY_NODE, "**", base, self.parse_factor())
+        return base
+
+    def parse_atom(self):
+        tok = self.next()
+        kind = tok[0]
+        if kind == _VALUE:
+            return (_VALUE_NODE, tok[1])
+        elif kind == _NAME:
+            return (_NAME_NODE, tok[1])
+        elif kind == _FUNCTION:
+            if self.peek() != _OPEN:
+                return (_NAME_NODE, tok[1])
+            self.next()
+            args = []
+            while self.peek() != _CLOSE:
+                args.append(self.parse_comparison())
+                if self.peek() != _COMMA:
+                    break
+                self.next()
+            self.expect(_CLOSE)
+            return (_CALL_NODE, tok[1], args)
+        elif tok == _OPEN:
+            if self.peek() == _CLOSE:
+                self.next()
+                return (_TUPLE_NODE, [])
+            tree = self.parse_expression_list(_CLOSE)
+            self.expect(_CLOSE)
+            return tree
+        raise SyntaxError("Unexpected {}".format(self.describe(tok)))
+
+
+def _check_complexity(node, guard, depth=0):
+    """Check a syntax tree with a ComplexityGuard, like ComplexityGuard.check_syntax_tree(...).
+
+       Returns the number of powers stacked on top of each other in the node,
+       and roughly how many digits it has if it is just numbers, or else None.
+    """
+    guard.add_node(depth)
+    kind = node[0]
+    if kind in (_BINARY_NODE, _COMPARE_NODE):
+        children = node[2:]
+    elif kind == _UNARY_NODE:
+        children = [node[2]]
+    elif kind == _CALL_NODE:
+        children = node[2]
+    elif kind == _TUPLE_NODE:
+        children = node[1]
+    else:
+        children = []
+    checked = [_check_complexity(child, guard, depth if kind == child[0] == _BINARY_NODE and child is node[2] else depth + 1)
+               for child in children]
+    if kind == _BINARY_NODE and node[1] == "**":
+        return guard.check_power(checked[1][0] + 1, checked[0][1], checked[1][1])
+    elif kind == _BINARY_NODE:
+        return 0, guard.operation_digits(node[1], [digits for _, digits in checked])
+    elif kind == _UNARY_NODE:
+        return checked[0]
+    elif kind == _VALUE_NODE and isinstance(node[1], sympy.Number):
+        return 0, guard.number_digits(float(node[1]))
+    return 0, None
+
+
+#####
+# Conversion to SymPy:
+#####
+
+class _Pending(object):
+    """A call to Add or Mul which has not been made yet.
+
+       Nested calls to the same class are flattened into one, as the
+       EvaluateFalseTransformer does, so these are only made once it is known
+       they will not be flattened into their parent.
+    """
+    __slots__ = ("name", "args")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+
+class _Converter(object):
+    """Convert a syntax tree into sympy objects, exactly as evaluateFalse(...) would.
+
+       Arithmetic is converted to unevaluated Add, Mul and Pow objects, relations
+       to unevaluated Eq and Rel objects and functions are called with
+       'evaluate=False'. Floor division and modulo are left to Python, as they are
+       not transformed.
+    """
+    def __init__(self, local_dict, global_dict):
+        self.local_dict = local_dict
+        self.global_dict = global_dict
+
+    def lookup(self, name):
+        """Find a name, preferring the local dictionary as 'eval' does."""
+        if name in self.local_dict:
+            return self.local_dict[name]
+        return self.global_dict[name]
+
+    def convert(self, node):
+        """Convert a syntax tree into a sympy object."""
+        return self.finish(self.transform(node))
+
+    def finish(self, result):
+        """Make any pending call to Add or Mul."""
+        if isinstance(result, _Pending):
+            return self.lookup(result.name)(*[self.finish(arg) for arg in result.args], evaluate=False)
+        return result
+
+    @staticmethod
+    def flatten(args, name):
+        """Denest calls to the same class as their parent, e.g. Mul(x, Mul(y, z))."""
+        result = []
+        for arg in args:
+            if isinstance(arg, _Pending) and arg.name == name:
+                result.extend(_Converter.flatten(arg.args, name))
+            else:
+                result.append(arg)
+        return result
+
+    def transform(self, node):
+        """Convert a syntax tree node, leaving any outermost Add or Mul pending."""
+        kind = node[0]
+        if kind == _VALUE_NODE:
+            return node[1]
+        elif kind == _NAME_NODE:
+            return self.lookup(node[1])
+        elif kind == _CALL_NODE:
+            return self.transform_call(node)
+        elif kind == _BINARY_NODE:
+            return self.transform_binary(node)
+        elif kind == _UNARY_NODE:
+            operand = self.transform(node[2])
+            if node[1] == "-":
+                # Replace all uses of unary minus with multiplication by minus one:
+                return _Pending("Mul", self.flatten([_MINUS_ONE, operand], "Mul"))
+            return +self.finish(operand)
+        elif kind == _COMPARE_NODE:
+            return self.transform_compare(node)
+        elif kind == _TUPLE_NODE:
+            return tuple(self.convert(item) for item in node[1])
+        raise SyntaxError("Unknown syntax")
+
+    def transform_call(self, node):
+        """Convert a function call, with 'evaluate=False' unless the function does not take it."""
+        _, name, arg_nodes = node
+        args = [self.transform(arg) for arg in arg_nodes]
+        if name in ("Add", "Mul"):
+            return _Pending(name, args)
+        args = [self.finish(arg) for arg in args]
+        if name in _NO_EVALUATE_FUNCTIONS:
+            return self.lookup(name)(*args)
+        return self.lookup(name)(*args, evaluate=False)
+
+    def transform_compare(self, node):
+        """Convert a comparison into an unevaluated Eq or Rel, or leave it to Python if it is neither."""
+        _, operator_str, left_node, right_node = node
+        left = self.convert(left_node)
+        right = self.convert(right_node)
+        if operator_str == "==":
+            return self.lookup("Eq")(left, right, evaluate=False)
+        elif operator_str in _RELATIONS:
+            return self.lookup("Rel")(left, right, operator_str, evaluate=False)
+        return _PYTHON_OPERATORS[operator_str](left, right)
+
+    def transform_binary(self, node):
+        """Convert arithmetic, following _EvaluateFalseTransformer.sympy_visit_BinOp(...)."""
+        _, operator_str, left_node, right_node = node
+        if operator_str not in _SYMPY_CLASSES:
+            # Operators which are not transformed leave the whole subtree to Python:
+            return self.evaluate(node)
+        sympy_class = _SYMPY_CLASSES[operator_str]
+        right = self.transform(right_node)
+        left = self.transform(left_node)
+        left_unary = left_node[0] == _UNARY_NODE
+        right_unary = right_node[0] == _UNARY_NODE
+        if left_unary and not right_unary and sympy_class == "Mul":
+            left, right = right, left
+        if operator_str == "-":
+            right = _Pending("Mul", self.flatten([_MINUS_ONE, right], "Mul"))
+        elif operator_str == "/":
+            if left_unary:
+                if right_unary:
+                    left, right = right, left
+                left = self.lookup("Pow")(self.finish(left), _MINUS_ONE, evaluate=False)
+            else:
+                right = self.lookup("Pow")(self.finish(right), _MINUS_ONE, evaluate=False)
+        if sympy_class == "Pow":
+            return self.lookup("Pow")(self.finish(left), self.finish(right), evaluate=False)
+        return _Pending(sympy_class, self.flatten([left, right], sympy_class))
+
+    def evaluate(self, node):
+        """Evaluate a syntax tree node with ordinary Python semantics."""
+        kind = node[0]
+        if kind == _VALUE_NODE:
+            return node[1]
+        elif kind == _NAME_NODE:
+            return self.lookup(node[1])
+        elif kind == _CALL_NODE:
+            return self.lookup(node[1])(*[self.evaluate(arg) for arg in node[2]])
+        elif kind in (_BINARY_NODE, _COMPARE_NODE):
+            return _PYTHON_OPERATORS[node[1]](self.evaluate(node[2]), self.evaluate(node[3]))
+        elif kind == _UNARY_NODE:
+            operand = self.evaluate(node[2])
+            return -operand if node[1] == "-" else +operand
+        elif kind == _TUPLE_NODE:
+            return tuple(self.evaluate(item) for item in node[1])
+        raise SyntaxError("Unknown syntax")
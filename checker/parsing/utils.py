@@ -1,4 +1,5 @@
 import ast
+import math
 import re
 import tokenize
 import unicodedata
@@ -6,6 +7,8 @@ import unicodedata
 from sympy.parsing import sympy_parser
 from sympy.core.basic import Basic
 
+from . import UnsafeInputException, ExpressionTooComplexException
+
 
 #####
 # Process Unicode characters into equivalent allowed characters:
@@ -15,72 +18,307 @@ from sympy.core.basic import Basic
 _NUMBERS = {"ZERO": 0, "ONE": 1, "TWO": 2, "THREE": 3, "FOUR": 4, "FIVE": 5, "SIX": 6, "SEVEN": 7, "EIGHT": 8, "NINE": 9}
 _FRACTIONS = {"HALF": 2, "THIRD": 3, "QUARTER": 4, "FIFTH": 5, "SIXTH": 6, "SEVENTH": 7, "EIGHTH": 8, "NINTH": 9, "TENTH": 10}
 _FRACTIONS.update({"{}S".format(key): value for key, value in _FRACTIONS.items() if key != "HALF"})
+# Operators with Unicode names, and their allowed equivalents:
+_OPERATOR_NAMES = {"MULTIPLICATION SIGN": "*", "ASTERISK OPERATOR": "*", "DIVISION SIGN": "/", "DIVISION SLASH": "/",
+                   "LESS-THAN OR EQUAL TO": "<=", "LESS-THAN OR SLANTED EQUAL TO": "<=",
+                   "GREATER-THAN OR EQUAL TO": ">=", "GREATER-THAN OR SLANTED EQUAL TO": ">=",
+                   "LOGICAL AND": "&", "N-ARY LOGICAL AND": "&", "LOGICAL OR": "|", "N-ARY LOGICAL OR": "|",
+                   "XOR": "^", "CIRCLED PLUS": "^", "NOT SIGN": "~"}
 # Major uppercase and lowercase Greek letters, excluding 'GREEK SMALL LETTER FINAL SIGMA' (\u03C2):
 _GREEK_LETTERS_REGEX = r"[\u0391-\u03A9\u03B1-\u03C1\u03C3-\u03C9]"
 
 
-def process_unicode_chars(match_object):
-    """Clean a string of Unicode characters into allowed characters if possible."""
-    result = ""
-    prev_name = None
-    for char in match_object.group(0):
-        name = unicodedata.name(char, None)
-
-        if name is None:
-            result += char
-        elif name.startswith("SUPERSCRIPT") and name.split()[1] in _NUMBERS:
-            number = name.split()[1]
-            # Check if this is a continuation of a exponent, or a new one.
-            if prev_name is not None and prev_name.startswith("SUPERSCRIPT"):
-                result += "{0:d}".format(_NUMBERS[number])
-            else:
-                result += "**{0:d}".format(_NUMBERS[number])
-        elif name.startswith("SUBSCRIPT") and name.split()[1] in _NUMBERS:
-            number = name.split()[1]
-            # Check if this is a continuation of a subscript, or a new one.
-            if prev_name is not None and prev_name.startswith("SUBSCRIPT"):
-                result += "{0:d}".format(_NUMBERS[number])
-            else:
-                result += "_{0:d}".format(_NUMBERS[number])
-        elif name.startswith("VULGAR FRACTION"):
-            numerator_name = name.split()[2]
-            denominator_name = name.split()[3]
-            if numerator_name in _NUMBERS and denominator_name in _FRACTIONS:
-                result += "({0:d}/{1:d})".format(_NUMBERS[numerator_name], _FRACTIONS[denominator_name])
-            else:
-                result += char
-        elif name in ["MULTIPLICATION SIGN", "ASTERISK OPERATOR"]:
-            result += "*"
-        elif name in ["DIVISION SIGN", "DIVISION SLASH"]:
-            result += "/"
-        elif name in ["LESS-THAN OR EQUAL TO", "LESS-THAN OR SLANTED EQUAL TO"]:
-            result += "<="
-        elif name in ["GREATER-THAN OR EQUAL TO", "GREATER-THAN OR SLANTED EQUAL TO"]:
-            result += ">="
-        elif name in ["LOGICAL AND", "N-ARY LOGICAL AND"]:
-            result += "&"
-        elif name in ["LOGICAL OR", "N-ARY LOGICAL OR"]:
-            result += "|"
-        elif name in ["XOR", "CIRCLED PLUS"]:
-            result += "^"
-        elif name == "NOT SIGN":
-            result += "~"
-        elif re.match(_GREEK_LETTERS_REGEX, char):
-            # There are more Greek letters with names like the below than usually
-            # supported by maths systems. The regex is a quick way to filter by Unicode
-            # codepoint.
-            if name.startswith("GREEK CAPITAL LETTER"):
-                result += "({})".format(name.replace("GREEK CAPITAL LETTER ", "").title())
-            elif name.startswith("GREEK SMALL LETTER"):
-                result += "({})".format(name.replace("GREEK SMALL LETTER ", "").lower())
-            else:
-                # Something is wrong, skip character:
-                result += char
+# Every character with an ASCII equivalent is in one of these ranges of codepoints: Latin-1,
+# Greek, and the punctuation, super/subscript, number form and mathematical operator blocks:
+_UNICODE_RANGES = [(0x0080, 0x0400), (0x2000, 0x2B00)]
+
+
+def _ascii_equivalent(char, name):
+    """Return the allowed characters equivalent to a single Unicode character, or None.
+
+       Superscript and subscript digits are returned as plain digits, since
+       whether they start a new exponent or subscript depends on the previous
+       character.
+    """
+    if name.startswith(("SUPERSCRIPT", "SUBSCRIPT")) and name.split()[1] in _NUMBERS:
+        return "{0:d}".format(_NUMBERS[name.split()[1]])
+    elif name.startswith("VULGAR FRACTION"):
+        numerator_name = name.split()[2]
+        denominator_name = name.split()[3]
+        if numerator_name in _NUMBERS and denominator_name in _FRACTIONS:
+            return "({0:d}/{1:d})".format(_NUMBERS[numerator_name], _FRACTIONS[denominator_name])
+    elif name in _OPERATOR_NAMES:
+        return _OPERATOR_NAMES[name]
+    elif re.match(_GREEK_LETTERS_REGEX, char):
+        # There are more Greek letters with names like the below than usually
+        # supported by maths systems. The regex is a quick way to filter by Unicode
+        # codepoint.
+        if name.startswith("GREEK CAPITAL LETTER"):
+            return "({})".format(name.replace("GREEK CAPITAL LETTER ", "").title())
+        elif name.startswith("GREEK SMALL LETTER"):
+            return "({})".format(name.replace("GREEK SMALL LETTER ", "").lower())
+    return None
+
+
+def _build_unicode_tables():
+    """Build the tables used by normalise_unicode(...), once at import time.
+
+       Returns a translation table of characters to their ASCII equivalents,
+       and a regular expression matching the superscript and subscript digits
+       which start a new exponent or subscript.
+    """
+    table = {}
+    superscripts, subscripts = [], []
+    superscript_digits, subscript_digits = [], []
+    for start, stop in _UNICODE_RANGES:
+        for codepoint in range(start, stop):
+            char = chr(codepoint)
+            name = unicodedata.name(char, None)
+            if name is None:
+                continue
+            replacement = _ascii_equivalent(char, name)
+            if replacement is not None:
+                table[codepoint] = replacement
+            if name.startswith("SUPERSCRIPT"):
+                superscripts.append(char)
+                if replacement is not None:
+                    superscript_digits.append(char)
+            elif name.startswith("SUBSCRIPT"):
+                subscripts.append(char)
+                if replacement is not None:
+                    subscript_digits.append(char)
+    # A digit continues an exponent (or subscript) if it follows any superscript (or subscript) character:
+    script_start_regex = re.compile(r"(?P<exponent>(?<![{0}])(?=[{1}]))|(?<![{2}])(?=[{3}])".format(
+        *["".join(map(re.escape, chars)) for chars in [superscripts, superscript_digits, subscripts, subscript_digits]]))
+    return table, script_start_regex
+
+
+_UNICODE_TABLE, _SCRIPT_START_REGEX = _build_unicode_tables()
+
+
+def _script_start(match_object):
+    """Start a new exponent or subscript before a superscript or subscript digit."""
+    return "**" if match_object.group("exponent") is not None else "_"
+
+
+def normalise_unicode(string):
+    """Swap any known safe Unicode characters in a string with their ASCII equivalents.
+
+       Superscript digits become exponents, e.g. 'x\u00B2' to 'x**2', and subscript
+       digits become subscripts, e.g. 'v\u2081' to 'v_1'. Unknown characters are
+       left alone.
+    """
+    if string.isascii():
+        return string
+    string = _SCRIPT_START_REGEX.sub(_script_start, string)
+    return string.translate(_UNICODE_TABLE)
+
+
+#####
+# Clean strings of unsafe input:
+#####
+
+# Full stops are only allowed between numbers, or before a number for cases like (.5):
+_DOT_BETWEEN_NON_NUMBERS_REGEX = re.compile(r'([^0-9])\.([^0-9])')
+_DOT_BEFORE_NON_NUMBER_REGEX = re.compile(r'(.?)\.([^0-9])')
+
+
+class StringCleaner(object):
+    """Clean untrusted strings in a single scan, using one compiled regular expression.
+
+       Runs of characters not in the whitelist are either rejected or replaced by
+       a space, and single equals signs are doubled. If 'fix_dots_and_keywords',
+       full stops are also only allowed next to numbers, 'lambda' (which can't
+       be overridden) becomes 'lamda' and double underscores (which exploits
+       need) are removed. The result is exactly that of making each of these
+       replacements to the whole string in turn.
+        - 'allowed_character_list' is a list of regular expression character
+          ranges, like ["\x20", "\x61-\x7A"], of the allowed characters.
+    """
+    def __init__(self, allowed_character_list, *, fix_dots_and_keywords=False):
+        allowed = "".join(allowed_character_list)
+        unsafe = r"[^{}]+".format(allowed)
+        self._unsafe_regex = re.compile(unsafe)
+        patterns = [r"(?P<unsafe>{})".format(unsafe)]
+        if fix_dots_and_keywords:
+            # Full stops separated by at most one character (or run of unsafe characters)
+            # affect each other's replacement, so must be replaced together:
+            gap = r"(?:(?!\.)[{0}]|{1})".format(allowed, unsafe)
+            patterns.append(r"(?P<dots>\.(?:{}?\.)*)".format(gap))
+            patterns.append(r"(?P<lambda>[lL]ambda)")
+            patterns.append(r"(?P<underscores>__)")
+        patterns.append(r"(?P<equals>(?<![=<>])=(?![=<>]))")
+        self._regex = re.compile("|".join(patterns))
+
+    def clean(self, string, *, reject_unsafe_input):
+        """Clean a string, raising an UnsafeInputException for unsafe input if 'reject_unsafe_input'."""
+        if reject_unsafe_input:
+            return self._regex.sub(self._replace_rejecting, string)
+        return self._regex.sub(self._replace, string)
+
+    def _replace_rejecting(self, match_object):
+        return self._replace(match_object, reject_unsafe_input=True)
+
+    def _replace(self, match_object, reject_unsafe_input=False):
+        """Return the replacement for one match of the combined regular expression."""
+        kind = match_object.lastgroup
+        if kind == "unsafe":
+            if reject_unsafe_input:
+                raise UnsafeInputException("Unexpected input characters provided!")
+            return " "
+        elif kind == "dots":
+            return self._replace_dots(match_object, reject_unsafe_input)
+        elif kind == "lambda":
+            return match_object.group()[0] + "amda"
+        elif kind == "underscores":
+            return " "
         else:
-            result += char
+            return "=="
 
-        prev_name = name
-    return result
+    def _replace_dots(self, match_object, reject_unsafe_input):
+        """Replace a group of full stops using the original regular expressions.
+
+           The replacements only depend on the characters between the full stops
+           and the characters either side, after unsafe characters are replaced.
+        """
+        dots = match_object.group()
+        if self._unsafe_regex.search(dots) is not None:
+            if reject_unsafe_input:
+                raise UnsafeInputException("Unexpected input characters provided!")
+            dots = self._unsafe_regex.sub(" ", dots)
+        string = match_object.string
+        start, end = match_object.span()
+        before = string[start - 1] if start > 0 else ""
+        after = string[end] if end < len(string) else ""
+        if self._unsafe_regex.match(before):
+            before = " "
+        if self._unsafe_regex.match(after):
+            after = " "
+        context = before + dots + after
+        context = _DOT_BETWEEN_NON_NUMBERS_REGEX.sub(r'\g<1> \g<2>', context)
+        context = _DOT_BEFORE_NON_NUMBER_REGEX.sub(r'\g<1> \g<2>', context)
+        # Any equals sign between full stops must be a single one:
+        return context[len(before):len(context) - len(after)].replace("=", "==")
+
+
+#####
+# Limit the complexity of expressions:
+#####
+
+# Expressions larger than these limits are rejected before any sympy objects are
+# built, since simplifying or evaluating them could stall the checker. Numbers,
+# symbols, operators and function calls each count as one node; chains of binary
+# operators like 'a + b + c' only count as one level of nesting:
+MAX_EXPRESSION_NODES = 1000
+MAX_EXPRESSION_DEPTH = 100
+MAX_INTEGER_DIGITS = 100
+# How many powers may be raised to powers, e.g. '9^9^9' is a tower of height 2; and
+# roughly how many digits a power of numbers, which sympy works out exactly, may have:
+MAX_POWER_TOWER_HEIGHT = 2
+MAX_POWER_DIGITS = 10000
+
+# Calls in the transformed code which are really just literal numbers or symbols:
+_LITERAL_CLASSES = {"Integer", "Float", "Rational", "Symbol"}
+_NUMBER_CLASSES = {"Integer", "Float", "Rational"}
+_AST_OPERATORS = {ast.Add: "+", ast.Sub: "-", ast.Mult: "*", ast.Div: "/"}
+
+
+class ComplexityGuard(object):
+    """Count the nodes of an expression as it is checked, raising an exception once over budget.
+
+       A new guard must be used for each expression. Every limit raises an
+       ExpressionTooComplexException, which is a kind of ParsingException.
+    """
+    def __init__(self):
+        self.nodes = 0
+
+    def add_node(self, depth):
+        """Count one more node, at a depth of 'depth' nodes below the top of the expression."""
+        self.nodes += 1
+        if self.nodes > MAX_EXPRESSION_NODES:
+            raise ExpressionTooComplexException("Expression has more than {} parts!".format(MAX_EXPRESSION_NODES))
+        if depth > MAX_EXPRESSION_DEPTH:
+            raise ExpressionTooComplexException("Expression is nested more than {} deep!".format(MAX_EXPRESSION_DEPTH))
+
+    @staticmethod
+    def check_integer(value):
+        """Reject integers with too many digits."""
+        if abs(value) >= 10 ** MAX_INTEGER_DIGITS:
+            raise ExpressionTooComplexException("Integer has more than {} digits!".format(MAX_INTEGER_DIGITS))
+
+    @staticmethod
+    def number_digits(value):
+        """Return roughly how many digits a literal number has, for check_power(...).
+
+           Numbers smaller than one count the digits after the decimal point.
+        """
+        value = abs(value)
+        return abs(math.log10(value)) if 0 < value < float("inf") else 0
+
+    @staticmethod
+    def operation_digits(operator_str, digits):
+        """Return at most how many digits an arithmetic operation on numbers has.
+
+           For both integers and fractions, this is at most the total number of
+           digits of the numbers, and one more when adding them.
+            - 'operator_str' is the operator, like "+".
+            - 'digits' are those of each operand, or None for one which is not
+              just numbers, when None is returned.
+        """
+        if None in digits or operator_str not in ("+", "-", "*", "/"):
+            return None
+        return sum(digits) + (1 if operator_str in ("+", "-") else 0)
+
+    @staticmethod
+    def check_power(height, base_digits, exponent_digits):
+        """Reject towers of powers which are too high, or powers of numbers with too many digits.
+
+           Powers of numbers like '9^9^9' are worked out exactly by sympy, which
+           might take for ever, so even a low tower may be too large.
+           Returns the height and digits of the power, like check_syntax_tree(...).
+            - 'height' is the number of powers stacked in this power.
+            - 'base_digits' and 'exponent_digits' are the digits of the base and
+              exponent, or None for either which is not just numbers.
+        """
+        if height > MAX_POWER_TOWER_HEIGHT:
+            raise ExpressionTooComplexException("Powers are nested more than {} high!".format(MAX_POWER_TOWER_HEIGHT))
+        if base_digits is None or exponent_digits is None:
+            return height, None
+        # The exponent is at most 10 ** exponent_digits, but any more than 10 ** 100 is too large:
+        digits = base_digits * 10 ** min(exponent_digits, 100)
+        if digits > MAX_POWER_DIGITS:
+            raise ExpressionTooComplexException("Power has more than {} digits!".format(MAX_POWER_DIGITS))
+        return height, digits
+
+    def check_syntax_tree(self, node, depth=0):
+        """Check a node of the Python syntax tree from sympy_parser.stringify_expr(...).
+
+           Returns the number of powers stacked on top of each other in the node,
+           and roughly how many digits it has if it is just numbers, or else None.
+        """
+        self.add_node(depth)
+        if isinstance(node, ast.Call):
+            if isinstance(node.func, ast.Name) and node.func.id in _LITERAL_CLASSES:
+                digits = 0 if node.func.id in _NUMBER_CLASSES else None
+                for arg in node.args:
+                    if isinstance(arg, ast.Constant) and type(arg.value) is int:
+                        self.check_integer(arg.value)
+                    if digits is not None and isinstance(arg, ast.Constant):
+                        digits += self.number_digits(float(arg.value))
+                return 0, digits
+            children = node.args
+        else:
+            children = [child for child in ast.iter_child_nodes(node) if isinstance(child, ast.expr)]
+        # Chains like 'a + b + c' are nested on the left, but are flattened by sympy:
+        checked = [self.check_syntax_tree(child, depth if child is getattr(node, "left", None) and isinstance(child, ast.BinOp) else depth + 1)
+                   for child in children]
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow):
+            return self.check_power(checked[1][0] + 1, checked[0][1], checked[1][1])
+        elif isinstance(node, ast.BinOp):
+            return 0, self.operation_digits(_AST_OPERATORS.get(type(node.op)), [digits for _, digits in checked])
+        elif isinstance(node, ast.UnaryOp):
+            return checked[0]
+        return 0, None
 
 
 #####
@@ -96,11 +334,17 @@ def evaluateFalse(s):
 
        Unlike the built-in evaluateFalse(...), we want to use a slightly more
        sophisticated EvaluateFalseTransformer and make operators AND functions
-       evaluate=False.
+       evaluate=False. Expressions which are too complex raise an
+       ExpressionTooComplexException, see ComplexityGuard.
         - 's' should be a string of Python code for the maths abstract syntax tree.
     """
-    node = ast.parse(s)
-    node = _EvaluateFalseTransformer().visit(node)
+    try:
+        node = ast.parse(s)
+        for statement in node.body:
+            ComplexityGuard().check_syntax_tree(statement.value)
+        node = _EvaluateFalseTransformer().visit(node)
+    except RecursionError:
+        raise ExpressionTooComplexException("Expression is too deeply nested!")
     # node is a Module, we want an Expression
     node = ast.Expression(node.body[0].value)
 
@@ -0,0 +1,268 @@
+import sympy
+from sympy.logic.boolalg import Xnor
+
+
+__all__ = ["sat_difference"]
+
+
+# After how many conflicts should the solver give up?
+MAX_SAT_CONFLICTS = 100000
+# How quickly the activity of variables not in recent conflicts decays:
+_ACTIVITY_DECAY = 0.95
+
+
+# How to encode each logical operator, given the literals of its arguments:
+_OPERATIONS = {
+    sympy.And: lambda encoder, args: encoder._and(args),
+    sympy.Or: lambda encoder, args: encoder._or(args),
+    sympy.Xor: lambda encoder, args: encoder._xor(args),
+    sympy.Not: lambda encoder, args: -args[0],
+    sympy.Nand: lambda encoder, args: -encoder._and(args),
+    sympy.Nor: lambda encoder, args: -encoder._or(args),
+    Xnor: lambda encoder, args: -encoder._xor(args),
+    sympy.Implies: lambda encoder, args: encoder._or([-args[0], args[1]]),
+    # All the arguments are True, or all are False:
+    sympy.Equivalent: lambda encoder, args: encoder._or([encoder._and(args), encoder._and([-arg for arg in args])]),
+    sympy.ITE: lambda encoder, args: encoder._or([encoder._and([args[0], args[1]]), encoder._and([-args[0], args[2]])]),
+}
+
+
+class _TseitinEncoder(object):
+    """Convert boolean expressions into clauses, with one new variable per subexpression.
+
+       Variables are numbered from 1, and a literal is a variable or its negative.
+       Each clause is a list of literals, at least one of which must be True.
+       The clauses are satisfiable exactly when the expressions are.
+    """
+    def __init__(self):
+        self.n_variables = 0
+        self.clauses = []
+        self.symbols = {}  # symbol: variable
+        self._literals = {}  # sympy expression: literal
+        self._true = None
+
+    def _new_variable(self):
+        self.n_variables += 1
+        return self.n_variables
+
+    def _constant(self, value):
+        if self._true is None:
+            self._true = self._new_variable()
+            self.clauses.append([self._true])
+        return self._true if value else -self._true
+
+    def _and(self, literals):
+        gate = self._new_variable()
+        for literal in literals:
+            self.clauses.append([-gate, literal])
+        self.clauses.append([gate] + [-literal for literal in literals])
+        return gate
+
+    def _or(self, literals):
+        return -self._and([-literal for literal in literals])
+
+    def _xor(self, literals):
+        result = literals[0]
+        for literal in literals[1:]:
+            gate = self._new_variable()
+            self.clauses.extend([[-gate, result, literal], [-gate, -result, -literal],
+                                 [gate, -result, literal], [gate, result, -literal]])
+            result = gate
+        return result
+
+    def literal(self, expr):
+        """Return the literal which is True exactly when a sympy boolean expression is."""
+        literal = self._literals.get(expr)
+        if literal is not None:
+            return literal
+        if expr is sympy.true or expr is sympy.false:
+            return self._constant(expr is sympy.true)
+        if isinstance(expr, sympy.Symbol):
+            literal = self.symbols[expr] = self._new_variable()
+            self._literals[expr] = literal
+            return literal
+
+        operation = _OPERATIONS.get(type(expr))
+        if operation is None:
+            raise TypeError("Cannot encode '{}' as clauses!".format(type(expr).__name__))
+        literal = operation(self, [self.literal(arg) for arg in expr.args])
+        self._literals[expr] = literal
+        return literal
+
+
+class _Solver(object):
+    """A conflict driven clause learning SAT solver.
+
+       Uses unit propagation with two watched literals per clause, learns the
+       first unique implication point clause from each conflict and backjumps,
+       and branches on the most active variable.
+        - 'n_variables' is the number of variables, numbered from 1.
+        - 'clauses' is a list of lists of literals, which may be modified.
+    """
+    def __init__(self, n_variables, clauses):
+        self.n_variables = n_variables
+        self.clauses = clauses
+        self._values = {}  # literal: True or False, for both literals of assigned variables
+        self._levels = [0] * (n_variables + 1)
+        self._reasons = [None] * (n_variables + 1)
+        self._trail = []
+        self._trail_limits = []
+        self._propagated = 0
+        self._watches = {literal: [] for v in range(1, n_variables + 1) for literal in (v, -v)}
+        self._activity = [0.0] * (n_variables + 1)
+        self._bump = 1.0
+
+    def _assign(self, literal, reason):
+        self._values[literal] = True
+        self._values[-literal] = False
+        self._levels[abs(literal)] = len(self._trail_limits)
+        self._reasons[abs(literal)] = reason
+        self._trail.append(literal)
+
+    def _add_clause(self, clause):
+        """Watch a clause, returning False if it is already unsatisfiable."""
+        clause[:] = dict.fromkeys(clause)
+        if len(clause) == 1:
+            value = self._values.get(clause[0])
+            if value is None:
+                self._assign(clause[0], clause)
+            return value is not False
+        self._watches[clause[0]].append(clause)
+        self._watches[clause[1]].append(clause)
+        return True
+
+    def _propagate(self):
+        """Make every assignment forced by the clauses, returning a conflicting clause or None."""
+        values = self._values
+        while self._propagated < len(self._trail):
+            false_literal = -self._trail[self._propagated]
+            self._propagated += 1
+            watchers = self._watches[false_literal]
+            kept = []
+            for i, clause in enumerate(watchers):
+                # Keep the literal which has just become False second:
+                if clause[0] == false_literal:
+                    clause[0], clause[1] = clause[1], clause[0]
+                if values.get(clause[0]) is True:
+                    kept.append(clause)
+                    continue
+                # Watch another literal which isn't False if possible:
+                for k in range(2, len(clause)):
+                    if values.get(clause[k]) is not False:
+                        clause[1], clause[k] = clause[k], clause[1]
+                        self._watches[clause[1]].append(clause)
+                        break
+                else:
+                    kept.append(clause)
+                    if values.get(clause[0]) is False:
+                        kept.extend(watchers[i + 1:])
+                        self._watches[false_literal] = kept
+                        return clause
+                    self._assign(clause[0], clause)
+            self._watches[false_literal] = kept
+        return None
+
+    def _analyse(self, conflict):
+        """Return the clause learnt from a conflict, and the level to backjump to."""
+        level = len(self._trail_limits)
+        learnt = [None]
+        seen = set()
+        at_level = 0
+        index = len(self._trail) - 1
+        clause = conflict
+        literal = None
+        while True:
+            for other in (clause if literal is None else clause[1:]):
+                variable = abs(other)
+                if variable not in seen and self._levels[variable] > 0:
+                    seen.add(variable)
+                    self._activity[variable] += self._bump
+                    if self._levels[variable] == level:
+                        at_level += 1
+                    else:
+                        learnt.append(other)
+            # The most recent assignment involved in the conflict:
+            while abs(self._trail[index]) not in seen:
+                index -= 1
+            literal = self._trail[index]
+            index -= 1
+            at_level -= 1
+            if at_level == 0:
+                break
+            clause = self._reasons[abs(literal)]
+        learnt[0] = -literal
+        self._bump /= _ACTIVITY_DECAY
+        if len(learnt) == 1:
+            return learnt, 0
+        # Watch the literal assigned at the highest level after the backjump:
+        highest = max(range(1, len(learnt)), key=lambda i: self._levels[abs(learnt[i])])
+        learnt[1], learnt[highest] = learnt[highest], learnt[1]
+        return learnt, self._levels[abs(learnt[1])]
+
+    def _backjump(self, level):
+        if len(self._trail_limits) > level:
+            for literal in self._trail[self._trail_limits[level]:]:
+                del self._values[literal], self._values[-literal]
+            del self._trail[self._trail_limits[level]:]
+            del self._trail_limits[level:]
+            self._propagated = len(self._trail)
+
+    def _decide(self):
+        """Return the unassigned variable with the highest activity, or None if all are assigned."""
+        best = None
+        for variable in range(1, self.n_variables + 1):
+            if variable not in self._values and (best is None or self._activity[variable] > self._activity[best]):
+                best = variable
+        return best
+
+    def solve(self):
+        """Return a satisfying assignment as a dict of variables to True or False, or None if unsatisfiable.
+
+           Raises a TypeError if there are more than MAX_SAT_CONFLICTS conflicts.
+        """
+        for clause in self.clauses:
+            if not self._add_clause(clause):
+                return None
+        conflicts = 0
+        while True:
+            conflict = self._propagate()
+            if conflict is not None:
+                if not self._trail_limits:
+                    return None
+                conflicts += 1
+                if conflicts > MAX_SAT_CONFLICTS:
+                    raise TypeError("Too many conflicts for the SAT solver!")
+                learnt, level = self._analyse(conflict)
+                self._backjump(level)
+                self._add_clause(learnt)
+                if len(learnt) > 1:
+                    self._assign(learnt[0], learnt)
+                continue
+            variable = self._decide()
+            if variable is None:
+                return {v: self._values[v] for v in range(1, self.n_variables + 1)}
+            self._trail_limits.append(len(self._trail))
+            self._assign(-variable, None)
+
+
+def sat_difference(test_expr, target_expr):
+    """Compare two boolean expressions by deciding whether they can ever differ.
+
+       The expressions differ exactly when Xor(test_expr, target_expr) is
+       satisfiable, which is decided by a SAT solver on its Tseitin encoding.
+       Returns None if the expressions are equivalent, otherwise a dict of one
+       assignment of their symbols to True or False for which they differ.
+       Raises a TypeError if either is not a simple boolean expression, or if
+       the solver gives up.
+        - 'test_expr' should be the untrusted sympy expression to check.
+        - 'target_expr' should be the trusted sympy expression to match against.
+    """
+    encoder = _TseitinEncoder()
+    difference = encoder._xor([encoder.literal(test_expr), encoder.literal(target_expr)])
+    encoder.clauses.append([difference])
+    model = _Solver(encoder.n_variables, encoder.clauses).solve()
+    if model is None:
+        return None
+    assignment = {symbol: False for symbol in test_expr.free_symbols | target_expr.free_symbols}
+    assignment.update({symbol: model[variable] for symbol, variable in encoder.symbols.items()})
+    return assignment
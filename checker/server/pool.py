@@ -0,0 +1,263 @@
+import multiprocessing
+import os
+import signal
+import threading
+
+from checker import maths, logic
+from checker.logs import get_logger, configure_logging, flush_logging
+from checker.utils import TimeLimit, TimeLimitException
+
+
+__all__ = ["TimeoutException", "WorkerCrashException", "CheckerPool", "get_pool"]
+
+# How many checker subprocesses should each server process keep ready?
+# Gunicorn's default 'sync' workers only handle one request at a time, so one is enough.
+CHECKER_POOL_SIZE = 1
+# How many setup tasks, like registered targets, should be remembered to replay to other subprocesses,
+# and how many seconds may replaying each take? (This is not part of the time allowed for a check.)
+MAX_SETUP_TASKS = 1000
+SETUP_TASK_TIMEOUT = 1
+
+_log = get_logger("pool")
+
+# The functions a checker subprocess is allowed to run, by name:
+_TASKS = {
+    "maths": maths.check,
+    "maths_batch": maths.check_batch,
+    "maths_register": maths.prepare_target,
+    "maths_install": maths.install_target_forms,
+    "logic": logic.check,
+}
+# The setup tasks, which return a (result, state) tuple, and the tasks which install
+# that state in a process:
+_SETUP_TASKS = {
+    "maths_register": "maths_install",
+}
+
+
+class TimeoutException(Exception):
+    """An exception to be raised if a check takes too long to finish."""
+    pass
+
+
+class WorkerCrashException(Exception):
+    """An exception to be raised if a checker subprocess dies unexpectedly."""
+    pass
+
+
+def _run_task(task, args, kwargs, timeout):
+    """Run a named task in this checker subprocess, returning a (success, value) tuple.
+
+       The task runs under a TimeLimit of 'timeout' seconds, the time the pool
+       waits for it, so that it can tell how long it has left from
+       TimeLimit.remaining(). One which overruns is reported as a TimeoutException,
+       unless the pool has already killed this subprocess.
+    """
+    try:
+        with TimeLimit(timeout):
+            return True, _TASKS[task](*args, **kwargs)
+    except TimeLimitException:
+        return False, TimeoutException("Check took longer than {} seconds!".format(timeout))
+    except Exception as e:
+        return False, e
+
+
+def _worker_main(connection, configure=False):
+    """The main loop of a checker subprocess.
+
+       Receive (task, args, kwargs, timeout) tuples down the pipe, run them, and
+       send back a (success, value) tuple where the value is the result or the
+       exception raised. Stops when the pipe is closed.
+        - 'configure' says whether logging must be configured, since the
+          subprocess was not forked from a process which already had.
+    """
+    # A forked subprocess inherits its parent's signal handlers; a Gunicorn worker's
+    # would stop it dying when it is told to at exit, and the worker would wait forever:
+    for name in ["SIGTERM", "SIGHUP", "SIGQUIT", "SIGUSR1", "SIGUSR2", "SIGCHLD"]:
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    if configure:
+        configure_logging()
+    while True:
+        try:
+            task, args, kwargs, timeout = connection.recv()
+        except (EOFError, OSError):
+            break
+        result = _run_task(task, args, kwargs, timeout)
+        try:
+            connection.send(result)
+        except Exception:
+            # The exception (or, unlikely, the result) could not be pickled:
+            connection.send((False, RuntimeError(repr(result[1]))))
+    flush_logging()
+
+
+class CheckerPool(object):
+    """A supervised pool of checker subprocesses which enforces hard timeouts.
+
+       Unlike a SIGALRM based timeout, a subprocess can be stopped even whilst
+       running NumPy or SymPy C code: any subprocess that overruns its deadline is
+       killed and replaced with a fresh one. New subprocesses are started as soon
+       as an old one is killed, so that one is ready before the next request.
+       Where possible subprocesses are forked, so they start with all modules
+       already imported. Setup tasks given to register(...) are run once, and
+       what they prepared is installed in every subprocess, including those
+       started to replace killed ones.
+        - 'size' is the number of subprocesses to keep running.
+    """
+    def __init__(self, size=CHECKER_POOL_SIZE):
+        self.size = size
+        self.pid = os.getpid()
+        if "fork" in multiprocessing.get_all_start_methods():
+            self._context = multiprocessing.get_context("fork")
+        else:
+            # Windows does not support fork, so workers must import everything again:
+            self._context = multiprocessing.get_context("spawn")
+        self._idle = []
+        self._available = threading.Condition()
+        self._setup_tasks = []  # The install tasks to replay, or None for any which failed.
+        self._setup_done = dict()  # How many install tasks each subprocess has run, by pid.
+        for _ in range(size):
+            self._idle.append(self._start_worker())
+
+    def _start_worker(self):
+        """Start a new checker subprocess, returning the process and its pipe."""
+        parent_connection, child_connection = self._context.Pipe()
+        configure = self._context.get_start_method() != "fork"
+        process = self._context.Process(target=_worker_main, args=(child_connection, configure), daemon=True)
+        process.start()
+        child_connection.close()
+        # A forked subprocess inherits everything already installed in this process:
+        self._setup_done[process.pid] = len(self._setup_tasks) if not configure else 0
+        return process, parent_connection
+
+    def _stop_worker(self, worker):
+        """Kill a checker subprocess, no matter what it is doing."""
+        process, connection = worker
+        connection.close()
+        if process.is_alive():
+            process.kill()
+        process.join()
+        self._setup_done.pop(process.pid, None)
+
+    def _replay_setup(self, worker):
+        """Run any install tasks a checker subprocess has not yet run, returning the subprocess.
+
+           Each may take SETUP_TASK_TIMEOUT seconds. One which fails is never
+           replayed again, so that it cannot break every later check; and if the
+           subprocess had to be killed, it is replaced.
+        """
+        while self._setup_done[worker[0].pid] < len(self._setup_tasks):
+            process, connection = worker
+            index = self._setup_done[process.pid]
+            self._setup_done[process.pid] = index + 1
+            setup = self._setup_tasks[index]
+            if setup is None:
+                continue
+            try:
+                connection.send(setup + (SETUP_TASK_TIMEOUT,))
+                if not connection.poll(SETUP_TASK_TIMEOUT):
+                    raise TimeoutException("Setup took longer than {} seconds!".format(SETUP_TASK_TIMEOUT))
+                success, value = connection.recv()
+            except (TimeoutException, EOFError, OSError) as e:
+                success, value = False, e
+                self._stop_worker(worker)
+                worker = self._start_worker()
+            if not success:
+                _log.error("Setup task '%s' failed, no longer replaying it: %s", setup[0], repr(value))
+                self._setup_tasks[index] = None
+        return worker
+
+    def _acquire(self):
+        """Wait for an idle checker subprocess."""
+        with self._available:
+            while not self._idle:
+                self._available.wait()
+            return self._idle.pop()
+
+    def _release(self, worker):
+        """Return a checker subprocess to the pool."""
+        with self._available:
+            self._idle.append(worker)
+            self._available.notify()
+
+    def run(self, task, *args, timeout, **kwargs):
+        """Run a named task in a checker subprocess and return its result.
+
+           Any exception raised by the task is re-raised here. If the task does
+           not finish within 'timeout' seconds, the subprocess is killed and
+           replaced, and a TimeoutException is raised. The task can see how long
+           it has left with TimeLimit.remaining().
+            - 'task' should be a key of _TASKS, with 'args' and 'kwargs' the
+              arguments to call that function with.
+        """
+        worker = self._acquire()
+        try:
+            worker = self._replay_setup(worker)
+            process, connection = worker
+            connection.send((task, args, kwargs, timeout))
+            if not connection.poll(timeout):
+                self._stop_worker(worker)
+                worker = self._start_worker()
+                raise TimeoutException("Check took longer than {} seconds!".format(timeout))
+            success, value = connection.recv()
+        except (EOFError, OSError) as e:
+            # The subprocess died, perhaps from running out of memory:
+            self._stop_worker(worker)
+            worker = self._start_worker()
+            raise WorkerCrashException("Checker subprocess died unexpectedly!") from e
+        finally:
+            self._release(worker)
+        if not success:
+            raise value
+        return value
+
+    def register(self, task, *args, timeout, **kwargs):
+        """Run a named setup task once, install what it prepared everywhere, and return its result.
+
+           The task is run like run(...), and returns a (result, state) tuple,
+           where the state is None if it failed. Only if it succeeded is the
+           state installed, by the task named in _SETUP_TASKS: at once in this
+           process, so that subprocesses forked later inherit it; and in the
+           running subprocesses before their next task. Installing should be
+           quick and safe to repeat. At most MAX_SETUP_TASKS are remembered to
+           install in running subprocesses; after that, only new ones get them.
+           Setup only reaches the subprocesses of this pool, and so of one server
+           process.
+            - the arguments are as for run(...).
+        """
+        result, state = self.run(task, *args, timeout=timeout, **kwargs)
+        if state is None:
+            return result
+        install = _SETUP_TASKS[task]
+        with self._available:
+            _TASKS[install](state)
+            if len(self._setup_tasks) < MAX_SETUP_TASKS:
+                self._setup_tasks.append((install, (state,), dict()))
+            else:
+                _log.warning("Too many setup tasks, not replaying '%s'!", task)
+        return result
+
+    def close(self):
+        """Stop all the checker subprocesses."""
+        with self._available:
+            for worker in self._idle:
+                self._stop_worker(worker)
+            self._idle = []
+
+
+_POOL = None
+
+
+def get_pool():
+    """Return the checker pool for this process, starting it if necessary.
+
+       The pool must be created lazily in each server process: with 'preload_app'
+       the app is imported before Gunicorn forks its workers, and subprocesses
+       and pipes must not be shared between them.
+    """
+    global _POOL
+    if _POOL is None or _POOL.pid != os.getpid():
+        _POOL = CheckerPool()
+    return _POOL
@@ -1,61 +1,30 @@
-import signal
+import time
 
-from flask import Flask, request, jsonify, abort
+from flask import Flask, Response, request, jsonify, abort
 from werkzeug.exceptions import default_exceptions
 from werkzeug.exceptions import HTTPException
 
-from checker import maths, logic
+from checker.logs import get_logger, configure_logging
+from checker.metrics import configure_metrics, count_timeout, prometheus_text
+from checker.server.pool import get_pool, TimeoutException, WorkerCrashException
 
 
 __all__ = ["app"]
 
-MAX_REQUEST_COMPUTATION_TIME = 2  # How many seconds should we spend on a single request?
+MAX_REQUEST_COMPUTATION_TIME = 2  # How many seconds should we spend on a single check?
+MAX_BATCH_SIZE = 100  # How many tests may be checked in one batch request?
+BATCH_CHUNK_SIZE = 10  # How many tests of a batch should each task in a checker subprocess check?
+# How many seconds should we spend on a whole batch? (Gunicorn kills workers taking 30 seconds.)
+MAX_BATCH_COMPUTATION_TIME = 20
 
+_log = get_logger("server")
+# Log as set by the environment, see checker.logs; forked worker processes inherit this,
+# and with 'preload_app' they all share the directory for metrics, see checker.metrics:
+configure_logging()
+configure_metrics()
 
-app = Flask(__name__)
-
-
-class TimeoutException(Exception):
-    """An exception to be raised if simplification takes too long to finish."""
-    pass
 
-
-class TimeoutProtection(object):
-    """A custom class to abort long-running code.
-
-       The timeout cannot interrupt libraries running external C code, and so
-       care must be taken. See http://stackoverflow.com/a/22348885 for source.
-       On platforms which do not support SIGALRM (notably Windows), the code will
-       run without timeout protection and merely print a warning to the console.
-        - 'duration' is the number of seconds to allow the code to run for before
-          raising a TimeoutException.
-    """
-    def __init__(self, duration=10):
-        self.duration = duration
-        self.timeout_allowed = True
-        try:
-            signal.SIGALRM
-        except AttributeError:
-            self.timeout_allowed = False
-
-    @staticmethod
-    def handle_timeout(signal_number, frame):
-        """The callback function to handle the signal being raised."""
-        raise TimeoutException()
-
-    def __enter__(self):
-        """Allows a 'with' block. If can set an alarm, do so."""
-        if self.timeout_allowed:
-            signal.signal(signal.SIGALRM, TimeoutProtection.handle_timeout)
-            signal.alarm(self.duration)
-        else:
-            # We can't use SIGALRM
-            print("WARN: Timeout Unsupported!")
-
-    def __exit__(self, _type, value, traceback):
-        """Cancels alarm after 'with' block exits."""
-        if self.timeout_allowed:
-            signal.alarm(0)
+app = Flask(__name__)
 
 
 def _make_json_error(ex):
@@ -70,6 +39,41 @@ def _make_json_error(ex):
     return response
 
 
+def _failed_request(e, **request_fields):
+    """Log why a request could not be checked, and describe the failure in the usual response shape.
+
+       Timeouts are counted in the metrics; a crashed subprocess has already been replaced.
+        - 'e' is the TimeoutException or WorkerCrashException raised by the pool.
+        - 'request_fields' are echoed back, so that clients can tell which request failed.
+    """
+    if isinstance(e, TimeoutException):
+        _log.error("%s - Request took too long to process, aborting!", type(e).__name__)
+        count_timeout()
+        return dict(**request_fields, error="Request took too long to process!")
+    _log.error("%s - Checker subprocess died while processing request!", type(e).__name__)
+    return dict(**request_fields, error="Request could not be processed!")
+
+
+def _check_batch_chunk(test_strs, target_str, deadline, **kwargs):
+    """Check some tests of a batch with one task in a checker subprocess, returning their results.
+
+       Each test may take MAX_REQUEST_COMPUTATION_TIME seconds, enforced by check_batch(...)
+       itself; so one which takes too long only fails itself. But if the subprocess
+       has to be killed, because the batch has run past 'deadline' or a test could
+       not be interrupted, or dies, every test of the chunk fails.
+        - 'deadline' is the time.monotonic() by which the whole batch must finish.
+        - 'kwargs' are passed on to check_batch(...).
+    """
+    remaining_time = deadline - time.monotonic()
+    try:
+        if remaining_time <= 0:
+            raise TimeoutException("Batch took longer than {} seconds!".format(MAX_BATCH_COMPUTATION_TIME))
+        return get_pool().run("maths_batch", test_strs, target_str, time_limit=MAX_REQUEST_COMPUTATION_TIME,
+                              timeout=min(MAX_REQUEST_COMPUTATION_TIME * len(test_strs), remaining_time), **kwargs)
+    except (TimeoutException, WorkerCrashException) as e:
+        return [_failed_request(e, target=target_str, test=test_str) for test_str in test_strs]
+
+
 @app.route('/check', methods=["POST"])
 @app.route('/check/maths', methods=["POST"])
 def check_maths():
@@ -77,10 +81,7 @@ def check_maths():
     body = request.get_json(force=True)
 
     if not (("test" in body) and ("target" in body)):
-        print("=" * 50)
-        print("ERROR: Ill-formed request!")
-        print(body)
-        print("=" * 50)
+        _log.warning("Ill-formed request: %s", body)
         abort(400)  # Probably want to just abort with a '400 BAD REQUEST'
 
     target_str = body.get("target")
@@ -90,34 +91,88 @@ def check_maths():
     _empty_input = (target_str == "") or (test_str == "")
     _unprintable_input = not (target_str.isprintable() and test_str.isprintable())
     if _empty_input or _unprintable_input:
-        print("=" * 50)
         if description is not None:
-            print(description)
-            print("=" * 50)
-        print("ERROR: {} string in request!".format("Unprintable" if _unprintable_input else "Empty"))
-        print("=" * 50)
+            _log.info("Description: %s", description)
+        _log.warning("%s string in request!", "Unprintable" if _unprintable_input else "Empty")
         abort(400)  # Probably want to just abort with a '400 BAD REQUEST'
 
     symbols = body.get("symbols")
     check_symbols = str(body.get("check_symbols", "true")).lower() == "true"
+    wrong_answers = body.get("wrong_answers")
+    timings = str(body.get("timings", "false")).lower() == "true"
+    if not (wrong_answers is None or isinstance(wrong_answers, dict)):
+        _log.warning("Ill-formed request! 'wrong_answers' must map answers to feedback.")
+        abort(400)
 
     # To reduce computation issues on single-threaded server, institute a timeout
-    # for requests. If it takes longer than this to process, return an error.
-    # This cannot interrupt numpy's computation, so care must be taken in selecting
-    # a value for MAX_REQUEST_COMPUTATION_TIME.
+    # for requests. The check runs in a subprocess which is killed if it takes
+    # longer than this to process, and an error is returned.
+    try:
+        response_dict = get_pool().run("maths", test_str, target_str, symbols=symbols, check_symbols=check_symbols,
+                                       description=description, wrong_answers=wrong_answers, timings=timings,
+                                       timeout=MAX_REQUEST_COMPUTATION_TIME)
+        return jsonify(**response_dict)
+    except (TimeoutException, WorkerCrashException) as e:
+        return jsonify(**_failed_request(e, target=target_str, test=test_str))
+
+
+@app.route('/check/maths/batch', methods=["POST"])
+def check_maths_batch():
+    """Check the equivalence of many mathematical expressions against one target."""
+    body = request.get_json(force=True)
+
+    if not (("tests" in body) and ("target" in body) and isinstance(body.get("tests"), list)):
+        _log.warning("Ill-formed request: %s", body)
+        abort(400)  # Probably want to just abort with a '400 BAD REQUEST'
+
+    target_str = body.get("target")
+    test_strs = body.get("tests")
+    description = body.get("description")
+
+    _empty_input = (target_str == "") or (len(test_strs) == 0)
+    _too_many_input = len(test_strs) > MAX_BATCH_SIZE
+    _non_string_input = not all(isinstance(test_str, str) for test_str in test_strs)
+    _unprintable_input = not (target_str.isprintable() and (_non_string_input or all(test_str.isprintable() for test_str in test_strs)))
+    if _empty_input or _too_many_input or _non_string_input or _unprintable_input:
+        if description is not None:
+            _log.info("Description: %s", description)
+        _log.warning("%s input in request!", "Empty" if _empty_input else "Too much" if _too_many_input
+                     else "Non-string" if _non_string_input else "Unprintable")
+        abort(400)  # Probably want to just abort with a '400 BAD REQUEST'
+
+    symbols = body.get("symbols")
+    check_symbols = str(body.get("check_symbols", "true")).lower() == "true"
+
+    # The tests are checked in chunks, each in one task, so that the target is only parsed
+    # once per chunk; but once the batch has taken too long, the tests not yet checked fail:
+    deadline = time.monotonic() + MAX_BATCH_COMPUTATION_TIME
+    results = []
+    for start in range(0, len(test_strs), BATCH_CHUNK_SIZE):
+        results.extend(_check_batch_chunk(test_strs[start:start + BATCH_CHUNK_SIZE], target_str, deadline,
+                                          symbols=symbols, check_symbols=check_symbols,
+                                          description=description if start == 0 else None))
+    return jsonify(target=target_str, results=results)
+
+
+@app.route('/register/maths', methods=["POST"])
+def register_maths():
+    """Precompute the canonical forms of a mathematical target which will be checked often, in this worker."""
+    body = request.get_json(force=True)
+
+    target_str = body.get("target")
+    if not isinstance(target_str, str) or target_str == "" or not target_str.isprintable():
+        _log.warning("Ill-formed request: %s", body)
+        abort(400)  # Probably want to just abort with a '400 BAD REQUEST'
+
+    symbols = body.get("symbols")
+
+    # Registration simplifies the target, so can take as long as a check:
     try:
-        with TimeoutProtection(MAX_REQUEST_COMPUTATION_TIME):
-            response_dict = maths.check(test_str, target_str, symbols=symbols, check_symbols=check_symbols, description=description)
-            return jsonify(**response_dict)
-    except TimeoutException as e:
-        print("ERROR: {} - Request took too long to process, aborting!".format(type(e).__name__))
-        print("=" * 50)
-        error_dict = dict(
-            target=target_str,
-            test=test_str,
-            error="Request took too long to process!",
-            )
-        return jsonify(**error_dict)
+        response_dict = get_pool().register("maths_register", target_str, symbols=symbols,
+                                            timeout=MAX_REQUEST_COMPUTATION_TIME)
+        return jsonify(**response_dict)
+    except (TimeoutException, WorkerCrashException) as e:
+        return jsonify(**_failed_request(e, target=target_str))
 
 
 @app.route('/check/logic', methods=["POST"])
@@ -126,10 +181,7 @@ def check_endpoint():
     body = request.get_json(force=True)
 
     if not (("test" in body) and ("target" in body)):
-        print("=" * 50)
-        print("ERROR: Ill-formed request!")
-        print(body)
-        print("=" * 50)
+        _log.warning("Ill-formed request: %s", body)
         abort(400)  # Probably want to just abort with a '400 BAD REQUEST'
 
     target_str = body.get("target")
@@ -139,33 +191,33 @@ def check_endpoint():
     _empty_input = (target_str == "") or (test_str == "")
     _unprintable_input = not (target_str.isprintable() and test_str.isprintable())
     if _empty_input or _unprintable_input:
-        print("=" * 50)
         if description is not None:
-            print(description)
-            print("=" * 50)
-        print("ERROR: {} string in request!".format("Unprintable" if _unprintable_input else "Empty"))
-        print("=" * 50)
+            _log.info("Description: %s", description)
+        _log.warning("%s string in request!", "Unprintable" if _unprintable_input else "Empty")
         abort(400)  # Probably want to just abort with a '400 BAD REQUEST'
 
     check_symbols = str(body.get("check_symbols", "true")).lower() == "true"
+    timings = str(body.get("timings", "false")).lower() == "true"
 
     # To reduce computation issues on single-threaded server, institute a timeout
-    # for requests. If it takes longer than this to process, return an error.
-    # This cannot interrupt numpy's computation, so care must be taken in selecting
-    # a value for MAX_REQUEST_COMPUTATION_TIME.
+    # for requests. The check runs in a subprocess which is killed if it takes
+    # longer than this to process, and an error is returned.
     try:
-        with TimeoutProtection(MAX_REQUEST_COMPUTATION_TIME):
-            response_dict = logic.check(test_str, target_str, check_symbols=check_symbols, description=description)
-            return jsonify(**response_dict)
-    except TimeoutException as e:
-        print("ERROR: {} - Request took too long to process, aborting!".format(type(e).__name__))
-        print("=" * 50)
-        error_dict = dict(
-            target=target_str,
-            test=test_str,
-            error="Request took too long to process!",
-            )
-        return jsonify(**error_dict)
+        response_dict = get_pool().run("logic", test_str, target_str, check_symbols=check_symbols,
+                                       description=description, timings=timings,
+                                       timeout=MAX_REQUEST_COMPUTATION_TIME)
+        return jsonify(**response_dict)
+    except (TimeoutException, WorkerCrashException) as e:
+        return jsonify(**_failed_request(e, target=target_str, test=test_str))
+
+
+@app.route('/metrics', methods=["GET"])
+def metrics():
+    """Report how long each stage of checking has taken, for Prometheus.
+
+       The metrics of every server process and checker subprocess are added up.
+    """
+    return Response(prometheus_text(), mimetype="text/plain; version=0.0.4")
 
 
 @app.route('/', methods=["GET"])
@@ -0,0 +1,126 @@
+import os
+import tempfile
+import time
+import unittest
+
+from sympy import symbols, cos, sin
+
+from checker import cache
+from checker.utils import EqualityType, known_equal_pair
+
+
+#####
+# Test the stores of known pairs:
+#####
+class TestLRUCache(unittest.TestCase):
+
+    def test_least_recently_used_evicted(self):
+        print("\n\n\n" + " Test LRU Cache Eviction ".center(75, "#"))
+        lru = cache.LRUCache(2)
+        lru["a"] = 1
+        lru["b"] = 2
+        self.assertEqual(lru.get("a"), 1)  # Now "b" is the least recently used.
+        lru["c"] = 3
+
+        self.assertTrue("b" not in lru, 'Expected "b" to be evicted!')
+        self.assertTrue("a" in lru and "c" in lru, "Expected recently used entries to be kept!")
+        self.assertIsNone(lru.get("b"))
+        self.assertEqual(lru.stats(), dict(size=2, bytes=0, hits=1, misses=1, evictions=1))
+        print("   PASS   ".center(75, "#"))
+
+    def test_memory_bound_and_expiry(self):
+        print("\n\n\n" + " Test LRU Cache Memory Bound and Expiry ".center(75, "#"))
+        x, y = symbols("x y")
+        small_pair = (x, y)
+        large_pair = (sin(x)**2 + cos(y)**2, 1 + x*y)
+        lru = cache.LRUCache(100, max_bytes=cache.approximate_size(large_pair))
+        lru[small_pair] = EqualityType.SYMBOLIC
+        lru[large_pair] = EqualityType.NUMERIC
+        self.assertTrue(small_pair not in lru, "Expected memory bound to evict the oldest pair!")
+        self.assertEqual(known_equal_pair(lru, large_pair[1], large_pair[0]), (True, EqualityType.NUMERIC))
+
+        expiring = cache.LRUCache(100, ttl=-1)
+        expiring[small_pair] = EqualityType.SYMBOLIC
+        self.assertTrue(small_pair not in expiring, "Expected expired pair to be forgotten!")
+        print("   PASS   ".center(75, "#"))
+
+
+class TestSQLiteCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "known_pairs.sqlite")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_known_pairs_stored(self):
+        print("\n\n\n" + " Test Known Pairs Stored in SQLite ".center(75, "#"))
+        x = symbols("x")
+        target_expr = sin(x)**2
+        test_expr = 1 - cos(x)**2
+        known_pairs = cache.SQLiteCache(self.path, "maths")
+
+        self.assertEqual(known_equal_pair(known_pairs, test_expr, target_expr), (False, EqualityType.KNOWN))
+        known_pairs[(target_expr, test_expr)] = EqualityType.SYMBOLIC
+        self.assertTrue((target_expr, test_expr) in known_pairs, "Expected pair to be known!")
+        self.assertFalse((test_expr, target_expr) in known_pairs, "Expected reversed pair not to be known!")
+        self.assertEqual(known_equal_pair(known_pairs, test_expr, target_expr), (True, EqualityType.SYMBOLIC))
+        print("   PASS   ".center(75, "#"))
+
+    def test_known_pairs_shared(self):
+        print("\n\n\n" + " Test Known Pairs Shared Between Caches ".center(75, "#"))
+        x, y = symbols("x y")
+        pair = (x + y, y + x)
+        cache.SQLiteCache(self.path, "maths")[pair] = EqualityType.NUMERIC
+
+        # A new cache using the same file, as another worker or after a restart would:
+        self.assertEqual(cache.SQLiteCache(self.path, "maths").get(pair), EqualityType.NUMERIC)
+        # But pairs from different checkers are kept separate:
+        self.assertTrue(pair not in cache.SQLiteCache(self.path, "logic"), "Expected namespaces to be separate!")
+        print("   PASS   ".center(75, "#"))
+
+    def test_known_pairs_expire(self):
+        print("\n\n\n" + " Test Known Pairs Expire from SQLite ".center(75, "#"))
+        x, y = symbols("x y")
+        pair = (x * y, y * x)
+        known_pairs = cache.LRUCache(100, ttl=60, backend=cache.SQLiteCache(self.path, "maths"))
+        known_pairs[pair] = EqualityType.SYMBOLIC
+        # A new cache using the same file, as another worker would, reads recent pairs:
+        self.assertEqual(cache.LRUCache(100, ttl=60, backend=cache.SQLiteCache(self.path, "maths")).get(pair),
+                         EqualityType.SYMBOLIC)
+
+        # But a pair which has expired is not read back from the backend:
+        expiring = cache.LRUCache(100, ttl=-1, backend=cache.SQLiteCache(self.path, "maths"))
+        expiring[pair] = EqualityType.SYMBOLIC
+        self.assertTrue(pair not in expiring, "Expected expired pair to be forgotten!")
+        self.assertIsNone(expiring.get(pair), "Expected expired pair to be a miss!")
+        self.assertEqual(expiring.stats()["misses"], 1)
+        print("   PASS   ".center(75, "#"))
+
+    def test_expired_pairs_deleted(self):
+        print("\n\n\n" + " Test Expired Known Pairs are Deleted from SQLite ".center(75, "#"))
+        x, y = symbols("x y")
+        old_pair, new_pair = (x * y, y * x), (x + y, y + x)
+        cache.SQLiteCache(self.path, "maths")[old_pair] = EqualityType.SYMBOLIC
+        cache.SQLiteCache(self.path, "logic")[old_pair] = EqualityType.SYMBOLIC
+        # Without a ttl, nothing is deleted:
+        forever = cache.SQLiteCache(self.path, "maths")
+        forever[new_pair] = EqualityType.SYMBOLIC
+        self.assertEqual(len(forever), 2)
+
+        # A write with a ttl deletes the expired pairs of its own namespace only:
+        expiring = cache.SQLiteCache(self.path, "maths", ttl=60)
+        with expiring._lock:
+            expiring._connect().execute("UPDATE known_pairs SET stored_at = ? WHERE pair = ?",
+                                        (time.time() - 120, expiring._key(old_pair)))
+        expiring[new_pair] = EqualityType.SYMBOLIC
+        self.assertEqual(len(expiring), 1)
+        self.assertIsNone(expiring.get(old_pair), "Expected the expired pair to be deleted!")
+        self.assertEqual(expiring.get(new_pair), EqualityType.SYMBOLIC)
+        self.assertEqual(len(cache.SQLiteCache(self.path, "logic")), 1)
+        print("   PASS   ".center(75, "#"))
+
+
+if __name__ == '__main__':
+    unittest.main()
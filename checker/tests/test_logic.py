@@ -299,5 +299,112 @@ class TestErrorBehaviour(unittest.TestCase):
         print("   PASS   ".center(75, "#"))
 
 
+#####
+# These tests check the methods used to decide equivalence directly.
+#####
+class TestEquivalenceMethods(unittest.TestCase):
+
+    def test_truth_tables(self):
+        print("\n\n\n" + " Test Truth Tables Decide Equivalence ".center(75, "#"))
+        import string
+        from checker.truth_tables import truth_table_difference, MAX_TRUTH_TABLE_VARIABLES
+        equivalent_pairs = [("A & (B | C)", "(A & B) | (A & C)"), ("A ^ B ^ C", "C ^ (A ^ B)"), ("A >> B", "~A | B"),
+                            ("A & ~A", "False"), ("A == (B == C)", "(A ^ B) ^ C"),
+                            ("A & B & C & D & E & F & G & H | J", "(A | J) & (B & C & D & E & F & G & H | J)")]
+        for test_str, target_str in equivalent_pairs:
+            difference = truth_table_difference(parsing.parse_expr(test_str), parsing.parse_expr(target_str))
+            print("'{}' == '{}': {}".format(test_str, target_str, difference))
+            self.assertIsNone(difference, "Expected '{}' to be equivalent to '{}'!".format(test_str, target_str))
+
+        test_expr, target_expr = parsing.parse_expr("A & (B | ~C)"), parsing.parse_expr("A & (B | C)")
+        difference = truth_table_difference(test_expr, target_expr)
+        print("Counterexample: {}".format(difference))
+        self.assertNotEqual(bool(test_expr.subs(difference)), bool(target_expr.subs(difference)))
+
+        too_many_variables = parsing.parse_expr(" | ".join(string.ascii_uppercase[:MAX_TRUTH_TABLE_VARIABLES + 1]))
+        with self.assertRaises(TypeError):
+            truth_table_difference(too_many_variables, too_many_variables)
+
+        response = api.check(*equivalent_pairs[-1])
+        self.assertTrue(response["equal"] == "true", 'Expected "equal" to be "true", got "{}"!'.format(response["equal"]))
+        self.assertTrue(response["equality_type"] == "symbolic",
+                        'Expected "equality_type" to be "symbolic", got "{}"!'.format(response["equality_type"]))
+        print("   PASS   ".center(75, "#"))
+
+    def test_binary_decision_diagrams(self):
+        print("\n\n\n" + " Test Binary Decision Diagrams Decide Equivalence ".center(75, "#"))
+        from checker.bdd import BDD
+        bdd = BDD()
+        equivalent_pairs = [("A & (B | C)", "(A & B) | (A & C)"), ("A ^ B ^ C", "C ^ (A ^ B)"), ("A >> B", "~A | B"),
+                            ("A & ~A", "False"), ("A == (B == C)", "(A ^ B) ^ C")]
+        for test_str, target_str in equivalent_pairs:
+            test_node, target_node = bdd.node(parsing.parse_expr(test_str)), bdd.node(parsing.parse_expr(target_str))
+            print("'{}': {}, '{}': {}".format(test_str, test_node, target_str, target_node))
+            self.assertEqual(test_node, target_node, "Expected '{}' to be equivalent to '{}'!".format(test_str, target_str))
+
+        # Nodes are reused, not built again:
+        size = len(bdd)
+        bdd.node(parsing.parse_expr("(A & B) | (C & A)"))
+        self.assertEqual(len(bdd), size, "Expected no new nodes for an equivalent expression!")
+
+        # Remembered expressions are bounded too, even those which add no new nodes:
+        import sympy
+        from checker import bdd as bdd_module
+        A, B = sympy.symbols("A B")
+        max_expressions = bdd_module.MAX_BDD_EXPRESSIONS
+        bdd_module.MAX_BDD_EXPRESSIONS = 50
+        try:
+            for n in range(200):
+                expr = A
+                for bit in "{:08b}".format(n):
+                    expr = sympy.Implies(expr, B, evaluate=False) if bit == "1" else sympy.Implies(B, expr, evaluate=False)
+                bdd.node(expr)
+        finally:
+            bdd_module.MAX_BDD_EXPRESSIONS = max_expressions
+        self.assertTrue(len(bdd._expressions) <= 50 + 8, "Expected remembered expressions to be bounded!")
+
+        test_expr, target_expr = parsing.parse_expr("A & (B | ~C)"), parsing.parse_expr("A & (B | C)")
+        difference = bdd.difference(test_expr, target_expr)
+        print("Counterexample: {}".format(difference))
+        self.assertNotEqual(bool(test_expr.subs(difference)), bool(target_expr.subs(difference)))
+
+        # Twenty variables, too many for truth tables:
+        test_str = " | ".join("({} & {})".format(a, b) for a, b in zip("ABCDEFGHJK", "LMNPQRSTUV"))
+        target_str = "~(" + " & ".join("(~{} | ~{})".format(a, b) for a, b in zip("ABCDEFGHJK", "LMNPQRSTUV")) + ")"
+        response = api.check(test_str, target_str)
+        self.assertTrue(response["equal"] == "true", 'Expected "equal" to be "true", got "{}"!'.format(response["equal"]))
+        self.assertTrue(response["equality_type"] == "symbolic",
+                        'Expected "equality_type" to be "symbolic", got "{}"!'.format(response["equality_type"]))
+        print("   PASS   ".center(75, "#"))
+
+    def test_sat_solver(self):
+        print("\n\n\n" + " Test SAT Solver Decides Equivalence ".center(75, "#"))
+        import string
+        from checker.sat import sat_difference
+        equivalent_pairs = [("A & (B | C)", "(A & B) | (A & C)"), ("A ^ B ^ C", "C ^ (A ^ B)"), ("A >> B", "~A | B"),
+                            ("A & ~A", "False"), ("A == (B == C)", "(A ^ B) ^ C"), ("A | True", "B | ~B")]
+        for test_str, target_str in equivalent_pairs:
+            difference = sat_difference(parsing.parse_expr(test_str), parsing.parse_expr(target_str))
+            print("'{}' == '{}': {}".format(test_str, target_str, difference))
+            self.assertIsNone(difference, "Expected '{}' to be equivalent to '{}'!".format(test_str, target_str))
+
+        test_expr, target_expr = parsing.parse_expr("A & (B | ~C)"), parsing.parse_expr("A & (B | C)")
+        difference = sat_difference(test_expr, target_expr)
+        print("Counterexample: {}".format(difference))
+        self.assertNotEqual(bool(test_expr.subs(difference)), bool(target_expr.subs(difference)))
+
+        # Forty variables, too many for truth tables or binary decision diagrams:
+        # Since (a | b) is ~(~a & ~b), and there are an even number of terms, the negations cancel:
+        names = string.ascii_letters[:40]
+        test_str = " ^ ".join("({} | {})".format(a, b) for a, b in zip(names[::2], names[1::2]))
+        target_str = " ^ ".join("(~{} & ~{})".format(a, b) for a, b in zip(names[::2], names[1::2]))
+        self.assertEqual(api.equivalence_method(parsing.parse_expr(test_str), parsing.parse_expr(target_str)), "SAT solver")
+        response = api.check(test_str, target_str)
+        self.assertTrue(response["equal"] == "true", 'Expected "equal" to be "true", got "{}"!'.format(response["equal"]))
+        self.assertTrue(response["equality_type"] == "symbolic",
+                        'Expected "equality_type" to be "symbolic", got "{}"!'.format(response["equality_type"]))
+        print("   PASS   ".center(75, "#"))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -246,7 +246,7 @@ class TestExactMatching(unittest.TestCase):
 class TestSymbolicMatching(unittest.TestCase):
 
     def test_simplify_fractions_symbolic(self):
-        print("\n\n\n" + " Test Fractions can be Simplified for Symbolic not Exact Match ".center(75, "#"))
+        print("\n\n\n" + " Test Fractions can be Simplified for Identity not Exact Match ".center(75, "#"))
         test_str = "(2*x*y*x)/(2*x*y*y)"
         target_str = "x/y"
         symbols = None
@@ -257,11 +257,12 @@ class TestSymbolicMatching(unittest.TestCase):
         self.assertTrue(response["equal"] == "true", 'Expected "equal" to be "true", got "{}"!'.format(response["equal"]))
         self.assertTrue("equality_type" in response, 'Key "equality_type" not in response!')
         self.assertTrue(response["equality_type"] in EQUALITY_TYPES, 'Unexpected "equality_type": "{}"!'.format(response["equality_type"]))
-        self.assertTrue(response["equality_type"] == "symbolic", 'For these expressions, expected "equality_type" to be "symbolic", got "{}"!'.format(response["equality_type"]))
+        self.assertTrue(response["equality_type"] == "identity",
+                        'For these expressions, expected "equality_type" to be "identity", got "{}"!'.format(response["equality_type"]))
         print("   PASS   ".center(75, "#"))
 
     def test_brackets_expand_symbolic(self):
-        print("\n\n\n" + " Test Brackets can be Expanded for Symbolic Match ".center(75, "#"))
+        print("\n\n\n" + " Test Brackets can be Expanded for Identity Match ".center(75, "#"))
         test_str = "(x + 1)(x + 1)"
         target_str = "x**2 + 2*x + 1"
         symbols = None
@@ -272,7 +273,8 @@ class TestSymbolicMatching(unittest.TestCase):
         self.assertTrue(response["equal"] == "true", 'Expected "equal" to be "true", got "{}"!'.format(response["equal"]))
         self.assertTrue("equality_type" in response, 'Key "equality_type" not in response!')
         self.assertTrue(response["equality_type"] in EQUALITY_TYPES, 'Unexpected "equality_type": "{}"!'.format(response["equality_type"]))
-        self.assertTrue(response["equality_type"] == "symbolic", 'For these expressions, expected "equality_type" to be "symbolic", got "{}"!'.format(response["equality_type"]))
+        self.assertTrue(response["equality_type"] == "identity",
+                        'For these expressions, expected "equality_type" to be "identity", got "{}"!'.format(response["equality_type"]))
         print("   PASS   ".center(75, "#"))
 
     def test_sqrt_x_squared(self):
@@ -302,7 +304,8 @@ class TestSymbolicMatching(unittest.TestCase):
         self.assertTrue(response["equal"] == "true", 'Expected "equal" to be "true", got "{}"!'.format(response["equal"]))
         self.assertTrue("equality_type" in response, 'Key "equality_type" not in response!')
         self.assertTrue(response["equality_type"] in EQUALITY_TYPES, 'Unexpected "equality_type": "{}"!'.format(response["equality_type"]))
-        self.assertTrue(response["equality_type"] == "symbolic", 'For these expressions, expected "equality_type" to be "symbolic", got "{}"!'.format(response["equality_type"]))
+        self.assertTrue(response["equality_type"] == "identity",
+                        'For these expressions, expected "equality_type" to be "identity", got "{}"!'.format(response["equality_type"]))
         print("   PASS   ".center(75, "#"))
 
     def test_main_trig_functions_symbolic(self):
@@ -362,7 +365,8 @@ class TestSymbolicMatching(unittest.TestCase):
         self.assertTrue(response["equal"] == "true", 'Expected "equal" to be "true", got "{}"!'.format(response["equal"]))
         self.assertTrue("equality_type" in response, 'Key "equality_type" not in response!')
         self.assertTrue(response["equality_type"] in EQUALITY_TYPES, 'Unexpected "equality_type": "{}"!'.format(response["equality_type"]))
-        self.assertTrue(response["equality_type"] == "symbolic", 'For these expressions, expected "equality_type" to be "symbolic", got "{}"!'.format(response["equality_type"]))
+        self.assertTrue(response["equality_type"] == "identity",
+                        'For these expressions, expected "equality_type" to be "identity", got "{}"!'.format(response["equality_type"]))
         print("   PASS   ".center(75, "#"))
 
     def test_unary_minus_fraction(self):
@@ -377,7 +381,8 @@ class TestSymbolicMatching(unittest.TestCase):
         self.assertTrue(response["equal"] == "true", 'Expected "equal" to be "true", got "{}"!'.format(response["equal"]))
         self.assertTrue("equality_type" in response, 'Key "equality_type" not in response!')
         self.assertTrue(response["equality_type"] in EQUALITY_TYPES, 'Unexpected "equality_type": "{}"!'.format(response["equality_type"]))
-        self.assertTrue(response["equality_type"] == "symbolic", 'For these expressions, expected "equality_type" to be "symbolic", got "{}"!'.format(response["equality_type"]))
+        self.assertTrue(response["equality_type"] == "identity",
+                        'For these expressions, expected "equality_type" to be "identity", got "{}"!'.format(response["equality_type"]))
         print("   PASS   ".center(75, "#"))
 
 
@@ -477,6 +482,7 @@ class TestDerivativeSupport(unittest.TestCase):
     def setUp(self):
         # This must run for tearDown() to run . . .
         api.KNOWN_PAIRS = dict()  # Ensure that results aren't cached for these specific tests!
+        api.KNOWN_UNEQUAL_PAIRS = dict()
 
     def tearDown(self):
         # Ensure that we always set this back to False, even if tests fail!
@@ -593,7 +599,8 @@ class TestSymbolParsingAndSplitting(unittest.TestCase):
         self.assertTrue(response["equal"] == "true", 'Expected "equal" to be "true", got "{}"!'.format(response["equal"]))
         self.assertTrue("equality_type" in response, 'Key "equality_type" not in response!')
         self.assertTrue(response["equality_type"] in EQUALITY_TYPES, 'Unexpected "equality_type": "{}"!'.format(response["equality_type"]))
-        self.assertTrue(response["equality_type"] == "symbolic", 'For these expressions, expected "equality_type" to be "symbolic", got "{}"!'.format(response["equality_type"]))
+        self.assertTrue(response["equality_type"] == "identity",
+                        'For these expressions, expected "equality_type" to be "identity", got "{}"!'.format(response["equality_type"]))
         print("   PASS   ".center(75, "#"))
 
     def test_custom_symbols_accepted(self):
@@ -681,6 +688,147 @@ class TestOthers(unittest.TestCase):
         self.assertTrue("error" not in response, 'Unexpected "error" in response!')
         print("   PASS   ".center(75, "#"))
 
+    def test_batch_check(self):
+        print("\n\n\n" + " Test Batch Checking Against One Target ".center(75, "#"))
+        test_strs = ["x**2 + 2*x + 1", "(x + 1)^2", "(x + 1)*(x - 1)", "x + ", "", "y + 1"]
+        target_str = "(x + 1)**2"
+        symbols = None
+        responses = api.check_batch(test_strs, target_str, symbols=symbols)
+
+        self.assertTrue(len(responses) == len(test_strs), "Expected one response per test string!")
+        for response, test_str in zip(responses, test_strs):
+            single_response = api.check(test_str, target_str, symbols=symbols)
+            for key in ["equal", "error", "syntax_error", "incorrect_symbols"]:
+                self.assertEqual(response.get(key), single_response.get(key),
+                                 'Expected "{}" to match check() for "{}"!'.format(key, test_str))
+
+        # Each test which takes too long fails alone:
+        test_strs = ["x**7 + 5*x", "(x + 1)^2"]
+        responses = api.check_batch(test_strs, target_str, time_limit=1E-6)
+        self.assertEqual(responses[0], dict(target=target_str, test=test_strs[0], error="Request took too long to process!"))
+        self.assertEqual(len(responses), len(test_strs), "Expected one response per test string!")
+        print("   PASS   ".center(75, "#"))
+
+    def test_known_unequal_pairs(self):
+        print("\n\n\n" + " Test Unequal Pairs Remembered ".center(75, "#"))
+        test_str = "x**2 + 2*x + 2"
+        target_str = "(x + 1)**2"
+        symbols = None
+        response = api.check(test_str, target_str, symbols=symbols)
+        self.assertTrue(response["equal"] == "false", 'Expected "equal" to be "false", got "{}"!'.format(response["equal"]))
+        self.assertTrue(len(api.KNOWN_UNEQUAL_PAIRS) > 0, "Expected unequal pair to be remembered!")
+
+        repeated_response = api.check(test_str, target_str, symbols=symbols)
+        self.assertEqual(response, repeated_response, "Expected same response for known unequal pair!")
+        print("   PASS   ".center(75, "#"))
+
+    def test_response_cache_ignores_spaces(self):
+        print("\n\n\n" + " Test Identical Requests Use Cached Response ".center(75, "#"))
+        symbols = "x"
+        target_str = "x ** 2 + x"
+        response = api.check("x(x + 1)", target_str, symbols=symbols)
+        self.assertTrue(response["equal"] == "true", 'Expected "equal" to be "true", got "{}"!'.format(response["equal"]))
+
+        hits = api.RESPONSE_CACHE.hits
+        repeated_response = api.check(" x ( x  + 1 ) ", target_str, symbols=symbols)
+        self.assertEqual(api.RESPONSE_CACHE.hits, hits + 1, "Expected response to come from the cache!")
+        self.assertEqual(repeated_response.pop("test"), " x ( x  + 1 ) ", "Expected the request's own test string!")
+        response.pop("test")
+        self.assertEqual(response, repeated_response, "Expected same response for identical request!")
+
+        # A cached response is not used if the settings have changed since:
+        api.CONCURRENT_EQUALITY = True
+        try:
+            hits = api.RESPONSE_CACHE.hits
+            api.check("x(x + 1)", target_str, symbols=symbols)
+            self.assertEqual(api.RESPONSE_CACHE.hits, hits, "Expected settings to be part of the cache key!")
+        finally:
+            api.CONCURRENT_EQUALITY = False
+
+        # But spaces can matter; "2 3" is not "23":
+        self.assertTrue(api.check("2 3", "23")["equal"] == "false", "Expected significant spaces to be kept!")
+        print("   PASS   ".center(75, "#"))
+
+    def test_anticipated_wrong_answers(self):
+        print("\n\n\n" + " Test Anticipated Wrong Answers Matched ".center(75, "#"))
+        target_str = "x^2 + 1"
+        wrong_answers = {"x^2 - 1": "wrong_sign", "x^2 + 2x + 1": "not_a_square", "sin(x)^2": "trig", "x^2 = 1": "equation"}
+
+        response = api.check("(x + 1)^2", target_str, wrong_answers=wrong_answers)
+        self.assertTrue(response["equal"] == "false", 'Expected "equal" to be "false", got "{}"!'.format(response["equal"]))
+        self.assertTrue(response["matched_answer"] == "x^2 + 2x + 1", "Expected to match the anticipated answer!")
+        self.assertTrue(response["feedback"] == "not_a_square", 'Expected feedback "not_a_square", got "{}"!'.format(response["feedback"]))
+        response = api.check("1 - cos(x)^2", target_str, wrong_answers=wrong_answers)
+        self.assertTrue(response["feedback"] == "trig", 'Expected feedback "trig", got "{}"!'.format(response.get("feedback")))
+
+        # Correct answers, and wrong answers which were not anticipated, get no feedback:
+        response = api.check("1 + x^2", target_str, wrong_answers=wrong_answers)
+        self.assertTrue(response["equal"] == "true" and "feedback" not in response, "Expected no feedback for a correct answer!")
+        response = api.check("x^2 + 2", target_str, wrong_answers=wrong_answers)
+        self.assertTrue(response["equal"] == "false" and "feedback" not in response, "Expected no feedback for an unknown answer!")
+
+        # Only answers with the same fingerprint need checking:
+        x = api.parse_expression("x")
+        self.assertEqual(api.numeric_fingerprint((x + 1)**2), api.numeric_fingerprint(x**2 + 2*x + 1))
+        self.assertNotEqual(api.numeric_fingerprint((x + 1)**2), api.numeric_fingerprint(x**2 + 2*x + 1 + 1E-3))
+        index = api.AnswerIndex(wrong_answers, {})
+        candidates = index.candidates(api.parse_expression("(x + 1)^2"))
+        self.assertEqual([answer for answer, _, _ in candidates], ["x^2 + 2x + 1", "x^2 = 1"])
+        print("   PASS   ".center(75, "#"))
+
+    def test_logging_levels(self):
+        print("\n\n\n" + " Test Logging is Level-Gated and Lazy ".center(75, "#"))
+        import logging
+        from checker import logs
+
+        class Description(object):
+            formatted = 0
+
+            def __str__(self):
+                Description.formatted += 1
+                return "Question 1"
+
+        with self.assertLogs("checker", level="INFO") as captured:
+            response = api.check("2x + 2", "2(x + 1)", description=Description())
+        self.assertTrue(response["equal"] == "true", "Expected the expressions to be equal!")
+        messages = [record.getMessage() for record in captured.records]
+        self.assertIn("Description: Question 1", messages)
+        self.assertIn("Equality: True (identity)", messages)
+
+        # Nothing is formatted for messages below the level being logged:
+        formatted = Description.formatted
+        logger = logging.getLogger("checker")
+        level = logger.level
+        logger.setLevel(logging.WARNING)
+        try:
+            api.check("3x + 3", "3(x + 1)", description=Description())
+        finally:
+            logger.setLevel(level)
+        self.assertEqual(Description.formatted, formatted, "Expected the description not to be formatted!")
+
+        self.assertEqual(logs._parse_stage_levels("maths.numeric=debug, logic = WARNING,"),
+                         {"maths.numeric": "DEBUG", "logic": "WARNING"})
+        print("   PASS   ".center(75, "#"))
+
+    def test_request_timings(self):
+        print("\n\n\n" + " Test Timings are Returned only when Requested ".center(75, "#"))
+        test_str = "cosh(y)^2 - sinh(y)^2"
+        target_str = "1"
+        response = api.check(test_str, target_str, symbols="y", check_symbols=False, timings=True)
+        self.assertTrue(response["equal"] == "true", "Expected the expressions to be equal!")
+        stages = response["timings"]["stages"]
+        self.assertTrue(all(isinstance(duration, int) for duration in stages.values()))
+        self.assertIn("parse", stages)
+        self.assertTrue(stages["total"] >= stages["parse"], "Expected the total to include every stage!")
+        self.assertEqual(response["timings"]["caches"]["responses"], "miss")
+
+        # The same request again is answered from the cache, and without timings if not asked:
+        response = api.check(test_str, target_str, symbols="y", check_symbols=False, timings=True)
+        self.assertEqual(response["timings"]["caches"], {"responses": "hit"})
+        response = api.check(test_str, target_str, symbols="y", check_symbols=False)
+        self.assertTrue(response["equal"] == "true" and "timings" not in response, "Expected no timings!")
+        print("   PASS   ".center(75, "#"))
+
 
 #####
 # These tests are for specific parts of the main checking code and may more easily
@@ -758,11 +906,264 @@ class TestSubroutines(unittest.TestCase):
         self.assertTrue(equal, "Expected expressions to be found numerically equal!")
         print("   PASS   ".center(75, "#"))
 
+    def test_rational_identity(self):
+        print("\n\n\n" + " Test Identity of Polynomials and Rational Functions ".center(75, "#"))
+        from sympy import symbols, sin, Float, Integer, Rational
+        x, y = symbols('x,y')
+        identical_pairs = [((x + 1)**2, x**2 + 2*x + 1),
+                           ((x**2 - y**2) / (x - y), x + y),
+                           (Rational(1, 3) * x**-2, 1 / (3 * x * x)),
+                           ((x + 1)**50 - (x + 1)**50, Integer(0))]
+        different_pairs = [((x + 1)**2, x**2 + 1),
+                           (x**60, x**61 / x**2),
+                           (x + 2**200, x + 2**200 + 3**100)]
+        undecided_pairs = [(sin(x), x), (Float(0.5) * x, x / 2), (x**y, x), (x**(10**15), x),
+                           (api.parse_expression("1/(x - x)"), Integer(1))]
+
+        for test_expr, target_expr in identical_pairs:
+            print("'{}' == '{}'".format(test_expr, target_expr))
+            self.assertTrue(api.identity_equality(test_expr, target_expr) is True)
+        for test_expr, target_expr in different_pairs:
+            print("'{}' != '{}'".format(test_expr, target_expr))
+            self.assertTrue(api.identity_equality(test_expr, target_expr) is False)
+        for test_expr, target_expr in undecided_pairs:
+            print("'{}' ? '{}'".format(test_expr, target_expr))
+            self.assertTrue(api.identity_equality(test_expr, target_expr) is None)
+
+        response = api.check("(x + 1)(x - 1)", "x^2 + 1")
+        self.assertTrue(response["equal"] == "false", 'Expected "equal" to be "false", got "{}"!'.format(response["equal"]))
+        self.assertTrue(response["equality_type"] == "identity",
+                        'Expected "equality_type" to be "identity", got "{}"!'.format(response["equality_type"]))
+        print("   PASS   ".center(75, "#"))
+
+    def test_numeric_prescreen(self):
+        print("\n\n\n" + " Test Wrong Answers Rejected by Numeric Prescreen ".center(75, "#"))
+        from checker.parsing import maths_parser
+        different_strs = [("sin(x)", "cos(x)"), ("ln(x)", "log(x)"), ("2 sin(x)cos(x)", "sin(x)"),
+                          ("sqrt(x + y)", "sqrt(x) + sqrt(y)"), ("Derivative(y, x) + 1", "Derivative(y, x)")]
+        equal_strs = [("sin(x)^2 + cos(x)^2 - 1", "0"), ("cosh(30x)^2 - sinh(30x)^2", "1"),
+                      ("10^99 + sin(x) - 10^99", "sin(x)"), ("3.14159265358979 x", "pi x"),
+                      ("sqrt(x^2)", "x"), ("asec(x)", "asec(x)"), ("1/(x - x)", "1")]
+        hints = ["constant_pi"]
+
+        for test_str, target_str in different_strs:
+            test_expr = maths_parser.parse_expr(test_str, hints=hints)
+            target_expr = maths_parser.parse_expr(target_str, hints=hints)
+            self.assertFalse(api.numeric_prescreen(test_expr, target_expr),
+                             "Expected '{}' and '{}' to clearly differ!".format(test_str, target_str))
+        for test_str, target_str in equal_strs:
+            test_expr = maths_parser.parse_expr(test_str, hints=hints)
+            target_expr = maths_parser.parse_expr(target_str, hints=hints)
+            self.assertTrue(api.numeric_prescreen(test_expr, target_expr),
+                            "Expected '{}' and '{}' not to be rejected!".format(test_str, target_str))
+
+        # A prescreen which runs out of time rejects nothing:
+        time_limit = api.PRESCREEN_TIME_LIMIT
+        api.PRESCREEN_TIME_LIMIT = 1E-6
+        try:
+            test_expr, target_expr = maths_parser.parse_expr("sin(x)"), maths_parser.parse_expr("cos(x)")
+            self.assertTrue(api.numeric_prescreen(test_expr, target_expr), "Expected an inconclusive prescreen!")
+        finally:
+            api.PRESCREEN_TIME_LIMIT = time_limit
+
+        response = api.check("cos(x)^2 - sin(x)^2", "cos(x)^2 + sin(x)^2")
+        self.assertTrue(response["equal"] == "false", 'Expected "equal" to be "false", got "{}"!'.format(response["equal"]))
+        self.assertTrue(response["equality_type"] == "numeric",
+                        'Expected "equality_type" to be "numeric", got "{}"!'.format(response["equality_type"]))
+        print("   PASS   ".center(75, "#"))
+
+    def test_compiled_evaluation(self):
+        print("\n\n\n" + " Test Compiled Expressions Match Lambdify ".center(75, "#"))
+        import numpy
+        from sympy import symbols, lambdify, sin, cos, exp, log, sqrt, sec, acot, Abs, I, pi, zoo, sign
+        from checker.evaluator import NUMPY_MISSING_FN, NUMPY_COMPLEX_FN, compile_expression
+        x, y = symbols('x,y')
+        exprs = [x**2 * sin(y) + cos(x) / y, exp(-x) * log(y) + sqrt(x + y), sec(x) + acot(y), Abs(x - y) * pi,
+                 x**-2 + y**(1 / sqrt(3)), (x + I * y)**3, log(x, 2) * Abs(I * x), sign(x - y) + y]
+        domain = numpy.random.random_sample((2, 25))
+
+        for expr in exprs:
+            for complexify in [False, True]:
+                print("'{}' (complex: {})".format(expr, complexify))
+                args = domain + 0j if complexify else domain
+                modules = [NUMPY_COMPLEX_FN if complexify else NUMPY_MISSING_FN, "numpy"]
+                expected = lambdify([x, y], expr, modules)(*args)
+                values = compile_expression(expr, [x, y], complexify=complexify)(*args)
+                self.assertTrue(numpy.allclose(values, expected, rtol=1E-12, equal_nan=True), "Expected values to match lambdify!")
+        # Complex infinity should be Not a Number:
+        self.assertTrue(numpy.all(numpy.isnan(compile_expression(zoo * x, [x, y])(*domain))))
+        # Constants must be complex for complex arguments:
+        self.assertTrue(numpy.isfinite(compile_expression((-2 + 0 * x)**(x + 0.5), [x], complexify=True)(0.5 + 0j)))
+        # The same expression should only be compiled once:
+        self.assertTrue(compile_expression(x**2 * sin(y) + cos(x) / y, [x, y]) is compile_expression(exprs[0], [x, y]))
+        print("   PASS   ".center(75, "#"))
+
+    def test_numeric_sample_points_reused(self):
+        print("\n\n\n" + " Test Numeric Sample Points and Target Values Reused ".center(75, "#"))
+        import numpy
+        from sympy import symbols, sin, cos
+        from checker.evaluator import sample_points
+        x, y = symbols('x,y')
+        points = sample_points(3, 25)
+        self.assertTrue(points.shape == (3, 25) and numpy.all((points >= 0) & (points < 1)), "Expected points in [0, 1)!")
+        self.assertTrue(numpy.array_equal(sample_points(2, 25), points[:2]), "Expected the same points for fewer dimensions!")
+
+        target_expr = sin(x) * cos(x) + x
+        api.TARGET_VALUES.clear()
+        self.assertTrue(api.numeric_equality(sin(2 * x) / 2 + x, target_expr))
+        target_values = api.TARGET_VALUES.get((target_expr, False))
+        self.assertTrue(target_values is not None, "Expected target values to be cached!")
+        # Extra test variables must not change the target's sample points:
+        self.assertTrue(api.numeric_equality(sin(2 * x) / 2 + x * (sin(y)**2 + cos(y)**2), target_expr))
+        self.assertTrue(api.TARGET_VALUES.get((target_expr, False)) is target_values, "Expected target values to be reused!")
+        self.assertFalse(api.numeric_equality(sin(2 * x) + x, target_expr))
+        print("   PASS   ".center(75, "#"))
+
+    def test_symbolic_stages(self):
+        print("\n\n\n" + " Test Symbolic Equality Stops at the Cheapest Stage ".center(75, "#"))
+        from sympy import symbols, sin, cos, exp
+        from checker.utils import TimeLimit, TimeLimitException
+        x = symbols('x')
+        settled_pairs = [(sin(x) * (x + 1), x * sin(x) + sin(x), "expand"),
+                         ((sin(x)**2 - 1) / (sin(x) - 1), sin(x) + 1, "cancel"),
+                         (sin(x)**2 + cos(x)**2, 1 + 0 * x, "trigsimp")]
+        for test_expr, target_expr, stage in settled_pairs:
+            counts = api.SYMBOLIC_STAGE_COUNTS.copy()
+            self.assertTrue(api.symbolic_equality(test_expr, target_expr), "Expected a symbolic match!")
+            self.assertEqual(api.SYMBOLIC_STAGE_COUNTS[stage], counts[stage] + 1, "Expected a match after '{}'!".format(stage))
+        counts = api.SYMBOLIC_STAGE_COUNTS.copy()
+        self.assertFalse(api.symbolic_equality(exp(x), x))
+        self.assertEqual(api.SYMBOLIC_STAGE_COUNTS["none"], counts["none"] + 1)
+
+        # Once the shared budget of the cheaper stages is spent, only 'simplify' is left:
+        time_limit = api.SYMBOLIC_STAGES_TIME_LIMIT
+        api.SYMBOLIC_STAGES_TIME_LIMIT = 0
+        try:
+            counts = api.SYMBOLIC_STAGE_COUNTS.copy()
+            self.assertTrue(api.symbolic_equality(sin(x) * (x + 2), x * sin(x) + 2 * sin(x)), "Expected a symbolic match!")
+            self.assertEqual(api.SYMBOLIC_STAGE_COUNTS["simplify"], counts["simplify"] + 1, "Expected a match after 'simplify'!")
+        finally:
+            api.SYMBOLIC_STAGES_TIME_LIMIT = time_limit
+        # An enclosing TimeLimit, like the request's deadline in a checker subprocess, shrinks the budget:
+        self.assertIsNone(TimeLimit.remaining())
+        with TimeLimit(1):
+            self.assertTrue(0 < TimeLimit.remaining() <= 1)
+
+        with self.assertRaises(TimeLimitException):
+            with TimeLimit(0.01):
+                while True:
+                    pass
+        print("   PASS   ".center(75, "#"))
+
+    def test_nested_time_limits(self):
+        print("\n\n\n" + " Test Nested Time Limits Keep the Outer Timer ".center(75, "#"))
+        import signal
+        from checker.utils import TimeLimit, TimeLimitException
+        with self.assertRaises(TimeLimitException):
+            with TimeLimit(0.2):
+                with TimeLimit(0.05):
+                    pass
+                remaining = signal.getitimer(signal.ITIMER_REAL)[0]
+                self.assertTrue(0 < remaining <= 0.2, "Expected the outer timer to be restored!")
+                while True:
+                    pass
+        # An inner limit longer than the outer one must not extend it:
+        with self.assertRaises(TimeLimitException):
+            with TimeLimit(0.05):
+                with TimeLimit(10):
+                    while True:
+                        pass
+        self.assertEqual(signal.getitimer(signal.ITIMER_REAL)[0], 0)
+        print("   PASS   ".center(75, "#"))
+
+    def test_registered_targets(self):
+        print("\n\n\n" + " Test Registered Targets Use Canonical Forms ".center(75, "#"))
+        from sympy import symbols, sin, cos
+        x, y = symbols('x y')
+        response = api.register_target("(x + y)^3 sin(x) = y")
+        self.assertTrue(response["registered"] == "true", "Expected the target to be registered!")
+        target_expr = (x + y)**3 * sin(x)
+        self.assertTrue(target_expr in api.REGISTERED_TARGETS, "Expected each side to be registered!")
+        self.assertTrue(y in api.REGISTERED_TARGETS, "Expected each side to be registered!")
+
+        counts = api.SYMBOLIC_STAGE_COUNTS.copy()
+        test_expr = (x**3 + 3 * x**2 * y + 3 * x * y**2 + y**3) * sin(x)
+        self.assertTrue(api.symbolic_equality(test_expr, target_expr), "Expected a symbolic match!")
+        self.assertEqual(api.SYMBOLIC_STAGE_COUNTS["canonical"], counts["canonical"] + 1,
+                         "Expected a match from the canonical forms!")
+        test_expr = (x + y)**3 * sin(x) * (sin(y)**2 + cos(y)**2)
+        self.assertTrue(api.symbolic_equality(test_expr, target_expr), "Expected a symbolic match!")
+        self.assertFalse(api.symbolic_equality((x + y)**3 * cos(x), target_expr), "Expected expressions to differ!")
+
+        response = api.check("y = sin(x) (y + x)^3", "(x + y)^3 sin(x) = y")
+        self.assertTrue(response["equal"] == "true", "Expected the equations to be equal!")
+        self.assertTrue("error" in api.register_target("(x + "), "Expected an error for an unparseable target!")
+
+        # Preparing a target is time limited, and one too complex is not registered:
+        time_limit = api.TARGET_FORMS_TIME_LIMIT
+        api.TARGET_FORMS_TIME_LIMIT = 1E-4
+        try:
+            response, forms = api.prepare_target("(x + y)^40 - (y + 1)^40")
+        finally:
+            api.TARGET_FORMS_TIME_LIMIT = time_limit
+        self.assertTrue("error" in response and forms is None, "Expected an error for a target too complex!")
+        self.assertFalse((x + y)**40 - (y + 1)**40 in api.REGISTERED_TARGETS, "Expected the target not to be registered!")
+        print("   PASS   ".center(75, "#"))
+
+    def test_stage_metrics(self):
+        print("\n\n\n" + " Test Stage Durations and Decisions are Recorded ".center(75, "#"))
+        from checker import metrics
+        before = metrics.collect()
+        response = api.check("(x + 2)^2", "x^2 + 4x + 4")
+        self.assertTrue(response["equal"] == "true", "Expected the expressions to be equal!")
+        after = metrics.collect()
+        for stage in ["maths.check", "maths.cleanup", "maths.parse", "maths.known_pairs", "maths.identity"]:
+            count = metrics._STAGE_OFFSETS[stage] + len(metrics.BUCKETS) + 2
+            self.assertGreater(after[count], before[count], "Expected stage '{}' to be timed!".format(stage))
+        decision = metrics._DECISION_OFFSETS[("maths", "identity", True)]
+        self.assertEqual(after[decision], before[decision] + 1, "Expected the decision to be counted!")
+
+        text = metrics.prometheus_text(after)
+        self.assertIn('checker_decisions_total{{checker="maths",equality_type="identity",equal="true"}} {}'.format(
+            int(after[decision])), text)
+        self.assertIn('checker_stage_duration_seconds_bucket{stage="maths.check",le="+Inf"}', text)
+        print("   PASS   ".center(75, "#"))
+
+    def test_concurrent_equality(self):
+        print("\n\n\n" + " Test Concurrent Symbolic and Numeric Equality ".center(75, "#"))
+        from sympy import symbols, sin, cos, tan
+        x = symbols('x')
+        # Numeric equality can't check a constant, but symbolic equality can:
+        test_expr, target_expr = cos(2 * x) + 2 * sin(x)**2, sin(x)**2 + cos(x)**2
+        api.CONCURRENT_EQUALITY = True
+        try:
+            api.KNOWN_PAIRS.clear()
+            equal, equality_type = api.expr_equality(test_expr, target_expr)
+            self.assertTrue(equal and equality_type == EqualityType.SYMBOLIC, "Expected a symbolic match!")
+            self.assertTrue(api.KNOWN_PAIRS.get((target_expr, test_expr)) == EqualityType.SYMBOLIC,
+                            "Expected the symbolic match to be remembered!")
+
+            equal, equality_type = api.expr_equality(tan(x)**2 + 1, 1 / cos(x)**2)
+            self.assertTrue(equal, "Expected expressions to be found equal!")
+            equal, equality_type = api.expr_equality(tan(x)**2, 1 / cos(x)**2)
+            self.assertFalse(equal, "Expected expressions to be found unequal!")
+
+            response = api.check("cos(2x) + 2sin(x)^2 + x", "x + 1")
+            self.assertTrue(response["equal"] == "true", 'Expected "equal" to be "true", got "{}"!'.format(response["equal"]))
+        finally:
+            api.CONCURRENT_EQUALITY = False
+        print("   PASS   ".center(75, "#"))
+
     def test_numeric_range_issue(self):
         print("\n\n\n" + " Test if Numeric Range Checked ".center(75, "#"))
-        test_str = "1/x"
-        target_str = "1/x**20"
-        response = api.check(test_str, target_str)
+        test_str = "sin(x)/x"
+        target_str = "sin(x)/x**20"
+        # The prescreen would correctly find these unequal before numeric testing:
+        api.NUMERIC_PRESCREEN = False
+        try:
+            response = api.check(test_str, target_str)
+        finally:
+            api.NUMERIC_PRESCREEN = True
 
         self.assertTrue("error" in response, 'Expected "error" in response!')
         self.assertTrue("Too Large Range" in response["error"], 'Expected warning about numeric range "{}"!'.format(response["error"]))
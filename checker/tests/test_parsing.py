@@ -69,12 +69,83 @@ class TestMathsParsing(unittest.TestCase):
         print("Expression has symbols:   {}".format(test_expr.free_symbols))
         print("   PASS   ".center(75, "#"))
 
+    def test_parse_cache(self):
+        print("\n\n\n" + " Test Parsed Expressions Reused ".center(75, "#"))
+        from sympy import Symbol
+        test_str = "sin(kx)/kx"
+        local_dict = {"kx": Symbol("kx")}
+
+        test_expr = maths_parser.parse_expr(test_str, local_dict=local_dict)
+        hits = maths_parser._parse_expr_cached.cache_info().hits
+        repeated_expr = maths_parser.parse_expr(test_str, local_dict=dict(local_dict))
+        print("Test expression: '{}'".format(test_expr))
+
+        self.assertTrue(repeated_expr is test_expr, "Expected the parsed expression to be reused!")
+        self.assertEqual(maths_parser._parse_expr_cached.cache_info().hits, hits + 1)
+        # But different symbols must give a different parse:
+        split_expr = maths_parser.parse_expr(test_str)
+        self.assertTrue(len(split_expr.free_symbols) == 2, "Expected 'kx' to be split without the local dict!")
+        print("   PASS   ".center(75, "#"))
+
+    def test_native_parser(self):
+        print("\n\n\n" + " Test Native Parser Matches parse_expr(...) ".center(75, "#"))
+        from sympy import Basic, srepr
+
+        def identical(a, b):
+            # Unevaluated expressions must have exactly the same arguments in the same order:
+            if type(a) is not type(b):
+                return False
+            if isinstance(a, tuple):
+                return len(a) == len(b) and all(map(identical, a, b))
+            if isinstance(a, Basic) and (a.args or b.args):
+                return len(a.args) == len(b.args) and all(map(identical, a.args, b.args))
+            return a == b and srepr(a) == srepr(b)
+
+        test_strs = ["2L + 2log(2)", "sin(kx)/kx", "e**(i * pi)", "-x/y", "-x/-y", "x/-y", "-x*y", "a-b-c",
+                     "--x", "+x*y", "x**-2", "2**3**4", "2x^2y", "1/2x", "(x+1)(x-1)", "sin(x)cos(x)", "2sin(x)",
+                     "sin^2(x)", "sin**(2)(x)", "sin^-1(x)", "x == y", "x >= y", "log(x, 2)", "factorial(x)",
+                     "diff(x**2, x)", "Derivative(sin(x), x, 2)", "thetax", "x_1y", "0x1f", "1e5", ".5", "2j",
+                     "7//2", "x* *y", "abs(-x) + Sqrt(x)", "x, y", "(x,)"]
+        parse_hints = ["constant_pi", "constant_e", "imaginary_i"]
+        for test_str in test_strs:
+            expr = maths_parser.parse_expr(test_str, hints=parse_hints, native=False)
+            native_expr = maths_parser.parse_expr(test_str, hints=parse_hints, native=True)
+            print("'{}' => '{}'".format(test_str, native_expr))
+            self.assertTrue(identical(expr, native_expr), "Expected '{}' to parse identically!".format(test_str))
+
+        bad_strs = ["sin x", "x < y < z", "x = y", "x[1]", "sin(,)", "(x", "x)", "x2", "Factorial(5)"]
+        for bad_str in bad_strs:
+            with self.assertRaises(maths_parser.ParsingException):
+                maths_parser.parse_expr(bad_str, native=True)
+        print("Native parser gives identical expressions and rejects bad input.")
+        print("   PASS   ".center(75, "#"))
+
+    def test_complexity_guard(self):
+        print("\n\n\n" + " Test Overly Complex Expressions Rejected ".center(75, "#"))
+        from checker.parsing import ExpressionTooComplexException
+        complex_strs = ["9^9^9^9", "x" + "+x" * 2000, "sin(" * 120 + "x" + ")" * 120, "-" * 3000 + "x",
+                        "1" * 150, "0x" + "f" * 100, "x^(y^(z^w))", "9^9^9", "(1/2)^(9^9)"]
+        for complex_str in complex_strs:
+            for native in [False, True]:
+                with self.assertRaises(ExpressionTooComplexException):
+                    maths_parser.parse_expr(complex_str, native=native)
+        print("Overly complex expressions rejected.")
+
+        allowed_strs = ["2^3^4", "x" + "+x" * 250, "sin(" * 50 + "x" + ")" * 50, "1" * 50, "e^(-x^2)", "10^1000",
+                        "x^(9^9)"]
+        for allowed_str in allowed_strs:
+            for native in [False, True]:
+                self.assertIsNotNone(maths_parser.parse_expr(allowed_str, native=native))
+        print("Large but reasonable expressions allowed.")
+        print("   PASS   ".center(75, "#"))
+
     def test_unicode_substitution(self):
         print("\n\n\n" + " Test cleanup_string(...) Swaps Unicode ".center(75, "#"))
         maths_values = {
             "\u00BD": "(1/2)",
             "a\u00B2 + b\u00B9\u2070": "a**2 + b**10",
             "v\u2081 + v\u2081\u2081": "v_1 + v_11",
+            "x\u00B2\u2081\u2082 + y\u207B\u00B9": "x**2_12 + y 1",
             "\u00D7": "*",
             "\u00F7": "/",
             "\u003C \u003E": "< >",
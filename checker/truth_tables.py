@@ -0,0 +1,106 @@
+import numpy
+import sympy
+from sympy.logic.boolalg import Xnor
+
+
+__all__ = ["MAX_TRUTH_TABLE_VARIABLES", "truth_table", "truth_table_difference"]
+
+
+# Above how many variables are truth tables too large to build? Each needs 2**n bits:
+MAX_TRUTH_TABLE_VARIABLES = 12
+
+# Every bit of a column set, and the repeating patterns of the first six variables within each 64 bit word:
+_ALL_ONES = numpy.uint64(0xFFFFFFFFFFFFFFFF)
+_WORD_PATTERNS = [0xAAAAAAAAAAAAAAAA, 0xCCCCCCCCCCCCCCCC, 0xF0F0F0F0F0F0F0F0,
+                  0xFF00FF00FF00FF00, 0xFFFF0000FFFF0000, 0xFFFFFFFF00000000]
+
+# How to combine the columns of the arguments of each logical operator:
+_OPERATIONS = {
+    sympy.And: lambda args: numpy.bitwise_and.reduce(args),
+    sympy.Or: lambda args: numpy.bitwise_or.reduce(args),
+    sympy.Xor: lambda args: numpy.bitwise_xor.reduce(args),
+    sympy.Not: lambda args: ~args[0],
+    sympy.Nand: lambda args: ~numpy.bitwise_and.reduce(args),
+    sympy.Nor: lambda args: ~numpy.bitwise_or.reduce(args),
+    Xnor: lambda args: ~numpy.bitwise_xor.reduce(args),
+    sympy.Implies: lambda args: ~args[0] | args[1],
+    # All the arguments are True, or all are False:
+    sympy.Equivalent: lambda args: numpy.bitwise_and.reduce(args) | ~numpy.bitwise_or.reduce(args),
+    sympy.ITE: lambda args: (args[0] & args[1]) | (~args[0] & args[2]),
+}
+
+
+def _variable_columns(symbols):
+    """Return the truth table column of each symbol, the number of words and a mask of the valid bits.
+
+       Row 'r' of the table, stored in bit r % 64 of word r // 64, is the
+       assignment where symbol 'i' is True when bit 'i' of 'r' is set.
+    """
+    n_rows = 2 ** len(symbols)
+    n_words = max(1, n_rows // 64)
+    columns = {}
+    for i, symbol in enumerate(symbols):
+        if i < len(_WORD_PATTERNS):
+            columns[symbol] = numpy.full(n_words, _WORD_PATTERNS[i], dtype=numpy.uint64)
+        else:
+            words_set = (numpy.arange(n_words) >> (i - len(_WORD_PATTERNS))) & 1
+            columns[symbol] = numpy.where(words_set, _ALL_ONES, numpy.uint64(0))
+    mask = numpy.uint64((1 << n_rows) - 1) if n_rows < 64 else _ALL_ONES
+    return columns, n_words, mask
+
+
+def _evaluate(expr, columns, n_words, memo):
+    """Evaluate a boolean expression on every row of the truth table at once."""
+    if expr in memo:
+        return memo[expr]
+    if expr in columns:
+        return columns[expr]
+    if expr is sympy.true:
+        return numpy.full(n_words, _ALL_ONES)
+    if expr is sympy.false:
+        return numpy.zeros(n_words, dtype=numpy.uint64)
+
+    operation = _OPERATIONS.get(type(expr))
+    if operation is None:
+        raise TypeError("Cannot build a truth table containing '{}'!".format(type(expr).__name__))
+    result = operation([_evaluate(arg, columns, n_words, memo) for arg in expr.args])
+    memo[expr] = result
+    return result
+
+
+def truth_table(expr, symbols):
+    """Return the truth table of a boolean expression as a packed array of bits.
+
+       The table is a numpy array of uint64 words, with one bit for each possible
+       assignment of the symbols and with any unused bits cleared. Expressions
+       containing anything other than symbols, True, False and logical operators
+       raise a TypeError.
+        - 'expr' should be a sympy boolean expression.
+        - 'symbols' should be a list of every symbol in the expression, in the
+          order which defines the rows of the table.
+    """
+    columns, n_words, mask = _variable_columns(symbols)
+    return _evaluate(expr, columns, n_words, {}) & mask
+
+
+def truth_table_difference(test_expr, target_expr):
+    """Compare the truth tables of two boolean expressions.
+
+       Returns None if the expressions are equivalent, otherwise a dict of one
+       assignment of their symbols to True or False for which they differ.
+       Raises a TypeError if either is not a simple boolean expression, or if
+       there are more than MAX_TRUTH_TABLE_VARIABLES symbols.
+        - 'test_expr' should be the untrusted sympy expression to check.
+        - 'target_expr' should be the trusted sympy expression to match against.
+    """
+    symbols = sorted(test_expr.free_symbols | target_expr.free_symbols, key=str)
+    if len(symbols) > MAX_TRUTH_TABLE_VARIABLES:
+        raise TypeError("Too many variables for a truth table!")
+    difference = truth_table(test_expr, symbols) ^ truth_table(target_expr, symbols)
+    differing_words = numpy.flatnonzero(difference)
+    if len(differing_words) == 0:
+        return None
+    word = int(differing_words[0])
+    bits = int(difference[word])
+    row = 64 * word + (bits & -bits).bit_length() - 1
+    return {symbol: bool((row >> i) & 1) for i, symbol in enumerate(symbols)}
@@ -1,29 +1,165 @@
+import re
+import signal
+import threading
+import time
 from enum import Enum
 
+from .logs import get_logger
+
+
+# Spaces next to brackets and commas, or repeated spaces, never change the meaning of an input:
+_REPEATED_SPACES_REGEX = re.compile(r" {2,}")
+_BRACKET_SPACES_REGEX = re.compile(r" ?([(),]) ?")
+
+_known_log = get_logger("known")
+_symbols_log = get_logger("symbols")
+
 
 class EqualityType(Enum):
     KNOWN = "known"
     NUMERIC = "numeric"
+    IDENTITY = "identity"
     SYMBOLIC = "symbolic"
     EXACT = "exact"
 
 
+class TimeLimitException(BaseException):
+    """An exception to be raised when code runs for longer than its TimeLimit.
+
+       This is not an Exception, so that code which catches every Exception,
+       as some of sympy does, cannot carry on regardless.
+    """
+    pass
+
+
+class TimeLimit(object):
+    """Abort code which takes too long, raising a TimeLimitException in a 'with' block.
+
+       Uses SIGALRM, so cannot interrupt libraries running external C code, and
+       only works in the main thread. On platforms without SIGALRM (notably
+       Windows) and in other threads, the code will run without a time limit.
+       Any previous handler for SIGALRM is restored afterwards, as is any
+       enclosing TimeLimit's timer, less the time spent inside this block; an
+       enclosing timer which would expire first is left to fire as it would have.
+        - 'duration' is the number of seconds (which need not be a whole number)
+          to allow the code to run for, or None for no limit.
+    """
+    def __init__(self, duration):
+        self.duration = duration
+        self.limit_allowed = (duration is not None and hasattr(signal, "SIGALRM")
+                              and threading.current_thread() is threading.main_thread())
+        self._previous_handler = None
+        self._outer_remaining = 0
+        self._start_time = None
+
+    @staticmethod
+    def handle_timeout(signal_number, frame):
+        """The callback function to handle the signal being raised."""
+        raise TimeLimitException()
+
+    @staticmethod
+    def remaining():
+        """Return how many seconds are left before the innermost TimeLimit expires, or None if there is none."""
+        if not hasattr(signal, "SIGALRM") or threading.current_thread() is not threading.main_thread():
+            return None
+        return signal.getitimer(signal.ITIMER_REAL)[0] or None
+
+    def __enter__(self):
+        if self.limit_allowed:
+            self._previous_handler = signal.signal(signal.SIGALRM, TimeLimit.handle_timeout)
+            self._outer_remaining = signal.getitimer(signal.ITIMER_REAL)[0]
+            self._start_time = time.monotonic()
+            if not self._outer_remaining or self.duration < self._outer_remaining:
+                signal.setitimer(signal.ITIMER_REAL, self.duration)
+        return self
+
+    def __exit__(self, _type, value, traceback):
+        if self.limit_allowed:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, self._previous_handler)
+            if self._outer_remaining:
+                remaining = self._outer_remaining - (time.monotonic() - self._start_time)
+                if remaining > 0:
+                    signal.setitimer(signal.ITIMER_REAL, remaining)
+                elif _type is None or not issubclass(_type, TimeLimitException):
+                    # The outer timer ran out while this one was active, but nothing is yet on its way out to it:
+                    signal.setitimer(signal.ITIMER_REAL, 1e-6)
+
+
 def known_equal_pair(known_pairs, test_expr, target_expr):
-    """In lieu of any real persistent cache of known pairs, just use a dict for now!
+    """Checks if the two expressions are known pairs from previous testing.
 
-       Checks if the two expressions are known pairs from previous testing; this
-       should reduce calls to 'simplify' and the numeric testing, both of which
-       are computationally costly and slow.
+       This should reduce calls to 'simplify' and the numeric testing, both of
+       which are computationally costly and slow.
+        - 'known_pairs' can be any store of known pairs supporting 'get', such as
+          a dict or a cache from the 'cache' module, mapping (target_expr, test_expr)
+          pairs to the EqualityType they were found equal by.
     """
-    print("[[KNOWN PAIR CHECK]]")
-    pair = (target_expr, test_expr)
-    if pair in known_pairs:
-        print("Known Pair from {} equality!".format(known_pairs[pair].value))
-        return (True, known_pairs[pair])
+    equality_type = known_pairs.get((target_expr, test_expr))
+    if equality_type is not None:
+        _known_log.debug("Known Pair from %s equality!", equality_type.value)
+        return (True, equality_type)
     else:
         return (False, EqualityType.KNOWN)
 
 
+def known_unequal_pair(known_unequal_pairs, test_expr, target_expr):
+    """Checks if the two expressions are known to be unequal from previous testing.
+
+       Common wrong answers are submitted over and over again; remembering them
+       avoids all of the equality checking stages for these too.
+        - 'known_unequal_pairs' is a store like that for known_equal_pair(...), mapping
+          pairs to the EqualityType of the stage that found them unequal.
+    """
+    equality_type = known_unequal_pairs.get((target_expr, test_expr))
+    if equality_type is not None:
+        _known_log.debug("Known Unequal Pair from %s equality!", equality_type.value)
+        return (True, equality_type)
+    else:
+        return (False, EqualityType.KNOWN)
+
+
+def response_cache_key(test_str, target_str, symbols, check_symbols, *settings):
+    """Return a key for caching the response to a check, or None if uncacheable.
+
+       Inputs which differ only in insignificant spaces get the same key, so that
+       resubmissions of the same answer can be answered without any parsing.
+       Only ASCII spaces are ignored; other whitespace is not allowed in input
+       and so must reach the usual checking to be rejected.
+        - the first four arguments should be those passed to check(...).
+        - 'settings' are any other values the response depends upon, such as
+          module level flags.
+    """
+    if not (isinstance(test_str, str) and isinstance(target_str, str)):
+        return None
+    if symbols is not None:
+        if isinstance(symbols, str):
+            symbols = symbols.split(",")
+        symbols = tuple(sorted(set(str(s).strip() for s in symbols)))
+    return (_normalise_spaces(test_str), _normalise_spaces(target_str), symbols, bool(check_symbols)) + settings
+
+
+def echo_request(cached_response, test_str, target_str, cleanup_string):
+    """Return a copy of a cached response, echoing the strings of this request.
+
+       Requests which differ only in insignificant spaces share a response, but
+       each should get back its own strings, cleaned up as they would have been.
+        - 'test_str' and 'target_str' should be the strings passed to check(...).
+        - 'cleanup_string' should be the parser's function for cleaning up input.
+    """
+    response = dict(cached_response)
+    for key, string in (("test", test_str), ("target", target_str)):
+        if key in response:
+            response[key] = cleanup_string(string, reject_unsafe_input=True)
+    return response
+
+
+def _normalise_spaces(string):
+    """Remove spaces from a string where they cannot be significant."""
+    string = _REPEATED_SPACES_REGEX.sub(" ", string.strip(" "))
+    return _BRACKET_SPACES_REGEX.sub(r"\g<1>", string)
+
+
 def contains_incorrect_symbols(test_expr, target_expr):
     """Test if the entered expression contains exactly the same symbols as the target.
 
@@ -34,21 +170,20 @@ def contains_incorrect_symbols(test_expr, target_expr):
         - 'test_expr' should be the untrusted sympy expression to check symbols from.
         - 'target_expr' should be the trusted sympy expression to match symbols to.
     """
-    print("[[SYMBOL CHECK]]")
     if test_expr.free_symbols != target_expr.free_symbols:
-        print("Symbol mismatch between test and target!")
+        _symbols_log.debug("Symbol mismatch between test and target!")
         result = dict()
         missing = ",".join(map(str, list(target_expr.free_symbols.difference(test_expr.free_symbols))))
         extra = ",".join(map(str, list(test_expr.free_symbols.difference(target_expr.free_symbols))))
         missing = missing.replace("lamda", "lambda").replace("Lamda", "Lambda")
         extra = extra.replace("lamda", "lambda").replace("Lamda", "Lambda")
         if len(missing) > 0:
-            print("Test Expression missing: {}".format(missing))
+            _symbols_log.debug("Test Expression missing: %s", missing)
             result["missing"] = missing
         if len(extra) > 0:
-            print("Test Expression has extra: {}".format(extra))
+            _symbols_log.debug("Test Expression has extra: %s", extra)
             result["extra"] = extra
-        print("Not Equal: Enforcing strict symbol match for correctness!")
+        _symbols_log.debug("Not Equal: Enforcing strict symbol match for correctness!")
         return result
     else:
         return None
@@ -62,6 +197,8 @@ def eq_type_order(eq_types):
     """
     if EqualityType.NUMERIC in eq_types:
         return EqualityType.NUMERIC
+    elif EqualityType.IDENTITY in eq_types:
+        return EqualityType.IDENTITY
     elif EqualityType.SYMBOLIC in eq_types:
         return EqualityType.SYMBOLIC
     elif EqualityType.EXACT in eq_types:
@@ -0,0 +1,112 @@
+"""Check that the single pass cleanup_string(...) functions give exactly the same
+   output as the original step by step cleanup, and measure how much faster they are.
+
+   Run from this folder with: python benchmark_cleanup.py
+"""
+import sys
+import os
+import json
+import random
+import re
+import timeit
+
+# Hack to allow using the "checker" module from the parent folder without
+# installing it globally:
+sys.path.insert(0, '..')
+
+from checker.parsing import maths_parser, logic_parser, UnsafeInputException
+from checker.parsing.utils import normalise_unicode
+
+
+#####
+# The original cleanup, one replacement at a time:
+#####
+
+def original_maths_cleanup_string(string, *, reject_unsafe_input):
+    string = normalise_unicode(string)
+    string = re.sub(maths_parser.UNSAFE_CHARACTERS_REGEX, '?', string)
+    if reject_unsafe_input:
+        if "?" in string:
+            raise UnsafeInputException("Unexpected input characters provided!")
+    else:
+        string = string.replace("?", " ")
+    string = re.sub(r'([^0-9])\.([^0-9])', r'\g<1> \g<2>', string)
+    string = re.sub(r'(.?)\.([^0-9])', r'\g<1> \g<2>', string)
+    string = string.replace("lambda", "lamda").replace("Lambda", "Lamda")
+    string = string.replace("__", " ")
+    string = re.sub(r'(?<![=<>])=(?![=<>])', '==', string)
+    return string
+
+
+def original_logic_cleanup_string(string, *, reject_unsafe_input):
+    string = normalise_unicode(string)
+    string = re.sub(logic_parser.UNSAFE_CHARACTERS_REGEX, '?', string)
+    if reject_unsafe_input:
+        if "?" in string:
+            raise UnsafeInputException("Unexpected input characters provided!")
+    else:
+        string = string.replace("?", " ")
+    string = re.sub(r'(?<![=<>])=(?![=<>])', '==', string)
+    return string
+
+
+#####
+# Inputs:
+#####
+
+def corpus_strings(checker_type=None):
+    """Every expression in the test cases, or just those for one type of checker."""
+    testcases_filepath = os.path.join(os.path.dirname(os.path.realpath(__file__)), "test_cases.json")
+    with open(testcases_filepath) as testcases_file:
+        test_cases = json.load(testcases_file)
+    strings = []
+    for test_case, test_details in test_cases.items():
+        if checker_type is not None and test_details["type"] != checker_type:
+            continue
+        strings.append(test_case)
+        strings.extend(test_details["shouldMatch"])
+    return strings
+
+
+def random_strings(count, seed=0):
+    """Short random strings made mostly of the characters the cleanup cares about."""
+    rng = random.Random(seed)
+    pieces = list(".=<>_ ()*+-/^&|~015xy") + ["lambda", "Lambda", "__", "..", "×", "²", "?", "☢", "\n", "ab"]
+    return ["".join(rng.choice(pieces) for _ in range(rng.randint(0, 12))) for _ in range(count)]
+
+
+def run(function, string, reject_unsafe_input):
+    try:
+        return function(string, reject_unsafe_input=reject_unsafe_input)
+    except UnsafeInputException:
+        return UnsafeInputException
+
+
+def check_identical(new_function, original_function, strings):
+    for string in strings:
+        for reject_unsafe_input in [True, False]:
+            new = run(new_function, string, reject_unsafe_input)
+            original = run(original_function, string, reject_unsafe_input)
+            if new != original:
+                raise AssertionError("Different output for {!r}: {!r} not {!r}".format(string, new, original))
+
+
+def time_function(function, strings):
+    def clean_all():
+        for string in strings:
+            run(function, string, False)
+    return min(timeit.repeat(clean_all, number=5, repeat=5))
+
+
+if __name__ == '__main__':
+    corpus = corpus_strings()
+    fuzz = random_strings(50000)
+    for name, new_function, original_function in [
+            ("maths", maths_parser.cleanup_string, original_maths_cleanup_string),
+            ("logic", logic_parser.cleanup_string, original_logic_cleanup_string)]:
+        check_identical(new_function, original_function, corpus + fuzz)
+        print("{}: identical output for {} strings".format(name, len(corpus) + len(fuzz)))
+        new_time = time_function(new_function, corpus_strings(name))
+        original_time = time_function(original_function, corpus_strings(name))
+        print("{}: {:.1f} ms, originally {:.1f} ms ({:.2f}x faster)".format(
+            name, 1000 * new_time, 1000 * original_time, original_time / new_time))